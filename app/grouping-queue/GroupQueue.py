@@ -1,9 +1,6 @@
-from utils import QueueGrouper, UserGroup, ResourceFinder
+from utils import QueueGrouper, UserGroup, ResourceFinder, WaitingPool, QueueChannel, Admission, Handoff, SlackDispatcher
 from modals import GroupFormResponse
 
-from multiprocessing import Process, Queue
-from multiprocessing.connection import Listener, Client
-from queue import Empty as EmptyQueue
 from collections import deque
 import threading
 
@@ -12,7 +9,6 @@ import logging
 import os
 import time
 from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
 
 # WebClient instantiates a client that can call API methods
 # When using Bolt, you can use either `app.client` or the `client` passed to listeners.
@@ -22,14 +18,21 @@ client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"))
 logging.basicConfig(filename="/app/logs/debug.log", filemode="w", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Host and Port pair for hosting the listener queue
+# Host and Port pair for hosting the listener queue, clients keep one connection open (utils.QueueChannel)
 HOST = "group-queue"
 PORT = 4000
-# Path to SQL scripts for constructing a temporary database
+AUTHKEY = b'password'
+# Path to SQL scripts for constructing the resource database, and the prebuilt database file (rebuilt when the script changes)
 DATABASE_PATH = "/app/sql/resource_database.sql"
+DATABASE_FILE = "/app/db/resource.db"
+HISTORY_FILE = "/app/db/seen_history.json"   # Problems already sent to each user, kept next to the database
 # Scheduling parameters, affect the rate at which requests are processed
 TIMER = 15                      # Seconds to wait between cycles
 TIMEOUT_THRESHOLD = 12          # Number of cycles to wait before sending feedback to user
+SOFT_CAP = 20000                # Waiting users at which new requests are turned away (nobody is dropped)
+QUEUE_CAPACITY = 100            # Requests waiting to be picked up by the worker, past this new ones are shed
+RETRY_AFTER = 5                 # Seconds a shed user is asked to wait before submitting again (request queue full)
+POOL_RETRY_AFTER = 60           # Same, when the waiting pool is full
 # Packet credentials and expected packet contents
 SECRET = "PASSWORD"
 PACKET_CONTENT = ("slack_id", "difficulty", "meeting_size", "topics")
@@ -37,107 +40,172 @@ PACKET_CONTENT = ("slack_id", "difficulty", "meeting_size", "topics")
 # Determine how to prioritize attributes of the form. For example, a weight of
 # {"a": 1, "b": 2} means that b will factor twice as much as a
 WEIGHTS = {"meeting_size": 6, "difficulty": 4, "topics": 1}
+# Matching backend. QueueGrouper.group_matcher is the pure Python reference, fastest at typical queue sizes
+# Opt-in: MatrixGrouper.group_matcher scores with NumPy (same decisions), only faster with thousands waiting
+# Opt-in: BucketGrouper.group_matcher skips pairs that can't get under the match threshold (same decisions)
+# Opt-in: GlobalGrouper.group_matcher merges the best pairs first instead of first-fit in queue order
+# Opt-in: ShardedGrouper.ShardedMatcher(key="meeting_size") splits the queue by an attribute and matches
+# the shards on a process pool, for heavy load on a machine with several cores (the pool is closed when the worker stops)
+GROUP_MATCHER = QueueGrouper.group_matcher
+MATCH_THRESHOLD = 0.22          # Highest compatibility score that still results in a merge
+COMPROMISE_FACTOR = 4           # How fast the match threshold relaxes for users that keep waiting
+# Opt-in: Incremental mode (True) matches each request on arrival, timeout/compromise aging still runs every
+# TIMER seconds. Arrivals always go through QueueGrouper.match_user (pure Python, one pass over the waiting pool
+# per request), GROUP_MATCHER only runs in the periodic cycle. Polling mode (False) only looks at new requests once per cycle
+INCREMENTAL = False
 
 # Thread A: Listen for server requests and handle immediate requests
-def listener_thread(receiver, user_req_queue: Queue):
+def listener_thread(server: QueueChannel.QueueServer, admission: Admission.AdmissionController):
     logger.debug("Listener Thread started")
-    while True:
-        with receiver.accept() as conn:
-            packet = conn.recv()
-            if packet["header"] == "user_queue_request" and packet["secret"] == SECRET:
-                # Filter out the packet content and put in user queue
-                user_req_queue.put({x: packet[x] for x in PACKET_CONTENT}, block=False)
-                conn.send(1)
-            elif packet["header"] == "check_queue_count" and packet["secret"] == SECRET:
-                # Check status of users waiting in the queue TODO: Not implemented yet until needed
-                conn.send(-1)
-            elif packet["secret"] != SECRET:
-                logger.warning("Request secret does not match with packet contents: " + str(packet))
-                conn.send(-1)
-            else:
-                logger.warning("Request does not exist with packet contents: " + str(packet))
-                conn.send(-1)
+    # Runs an asyncio event loop in this thread, every client connection is served concurrently on it
+    # and requests are answered with handle_packet. Stalled clients are timed out (see QueueChannel.QueueServer)
+    server.handler = lambda packet: handle_packet(packet, admission)
+    server.serve_forever()
+
+# Answer one request packet (see utils.Admission for the codes). Runs on the listener's event loop, must never block
+def handle_packet(packet, admission: Admission.AdmissionController):
+    if not isinstance(packet, dict):
+        logger.warning("Request is not a packet: " + str(packet))
+        return admission.reject()
+    if packet.get("header") == "user_queue_request" and packet.get("secret") == SECRET:
+        if any(x not in packet for x in PACKET_CONTENT):
+            logger.warning("Request is missing packet contents: " + str(packet))
+            return admission.reject()
+        # Filter out the packet content and put in user queue
+        # Backpressure: At capacity the request is turned away with a retry time, instead of losing it later
+        response = admission.admit({x: packet[x] for x in PACKET_CONTENT})
+        if response != Admission.ACCEPTED:
+            logger.warning("Queue is busy, turning away request from " + str(packet["slack_id"]) + ": " + str(admission.stats()))
+        return response
+    elif packet.get("header") == "check_queue_count" and packet.get("secret") == SECRET:
+        # Check status of users waiting in the queue TODO: Not implemented yet until needed
+        return Admission.REJECTED
+    elif packet.get("secret") != SECRET:
+        logger.warning("Request secret does not match with packet contents: " + str(packet))
+        return admission.reject()
+    else:
+        logger.warning("Request does not exist with packet contents: " + str(packet))
+        return admission.reject()
+
+# Convert a batch of (enqueue time, packet) pairs from the handoff, rejected packets are logged and left out
+def convert_requests(batch):
+    if len(batch) > 0:
+        logger.debug("Handing off " + str(len(batch)) + " requests, oldest waited " + str(time.monotonic() - batch[0][0]) + "s")
+    users, rejected = UserGroup.convert_batch(packet for queued, packet in batch)
+    for rejection in rejected:
+        logger.error(rejection["detail"] + ", packet: " + str(rejection["packet"]))
+        # TODO: Return a message back to the client
+    return users
+
+# Message groups on the exit queue (Single id means timeout, multiple people mean group matched)
+# Messages are handed to the dispatcher, the cycle doesn't wait for Slack
+def message_groups(exit_queue: list, resources: ResourceFinder.ResourceService, dispatcher: SlackDispatcher.SlackDispatcher):
+    # Suggest resources for every group at once from the resource database (or the in-memory index of it)
+    try:
+        res_lists = resources.suggest_resources([{"difficulty": group.difficulty, "topics": group.topic_dict(), "members": group.ids}
+                                                 for group in exit_queue])
+    except Exception as e:
+        logger.error(f"Resource Finder failed: {e}")
+        res_lists = [[] for group in exit_queue]
+    for group, res_list in zip(exit_queue, res_lists):
+        mail = json.dumps(GroupFormResponse.generate_response(group.to_group_form(), resources=res_list)["blocks"])
+        future = dispatcher.send_group(group.ids, mail, "CTI App sent you a message")
+        future.add_done_callback(lambda done, ids=group.ids: log_delivery(done, ids))
+    exit_queue.clear()
+
+def log_delivery(future, ids):
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Error messaging {ids}: {error}")
 
 # Thread B: Cron jobs, prevent listener from getting backed up
 # TODO: Illegitmate packets will crash this thread, you should add safeguards
-def worker_thread(user_req_queue: Queue, db_path, timer=TIMER):
+def worker_thread(user_req_queue: Handoff.Handoff, db_path, waiting_pool: WaitingPool.WaitingPool, timer=TIMER, incremental=INCREMENTAL,
+                  db_file=DATABASE_FILE, history_file=HISTORY_FILE, admission=None):
     # Set up the grouping queue
     logger.debug("Cron job thread started")
     UserGroup.UserGroup.reset() # Ensure that the UserGroup user list is clean for a new run
-    groups_waiting = deque(maxlen=300)
     
-    # Instantiate a temporary database for managing resources
-    db_conn = ResourceFinder.create_temporary_database(db_path)
-    while True:
-        start_time = time.time() # Track runtime to ensure cron jobs don't hold up the system
+    # Open the prebuilt database for managing resources (built on first start, or when the script changed)
+    # Recommendations are looked up in a table ranked ahead of time per (difficulty, topic),
+    # and problems a whole group has already been sent are skipped
+    resources = ResourceFinder.ResourceService(db_file, db_path, history=ResourceFinder.SeenHistory(history_file))
+    resources.refresh()
+    # Slack calls run on the dispatcher's own threads, within the Web API rate limits
+    dispatcher = SlackDispatcher.SlackDispatcher(client)
+    next_cycle = time.time() + timer
+    try:
+        while True:
+            # Incremental mode: Match each request as soon as it arrives, in between cycles
+            if incremental and time.time() < next_cycle:
+                # With nobody waiting there's nothing to age, so block until a request shows up
+                wait = next_cycle - time.time() if len(waiting_pool) > 0 else None
+                batch = user_req_queue.wait(timeout=wait)
+                # Requests that arrived in a burst are converted together
+                for user in convert_requests(batch):
+                    if len(waiting_pool) == 0:
+                        next_cycle = time.time() + timer # Start aging from the first arrival
+                    waiting_pool.reindex(QueueGrouper.match_user(user, waiting_pool, WEIGHTS, match_threshold=MATCH_THRESHOLD))
+                continue
+
+            start_time = time.time() # Track runtime to ensure cron jobs don't hold up the system
         
-        # Check for new users
-        logger.debug("Pulling new user requests into the system")
-        users_waiting = deque(maxlen=100)
-        try:
-            while True:
-                try:
-                    current_user = user_req_queue.get(block=False)
-                    users_waiting.append(UserGroup.convert_to_usergroup(current_user))
-                except UserGroup.DuplicateUserException:
-                    logger.error("User " + current_user["slack_id"] + " is already in the queue")
-                    # TODO: Return a message back to the client
-                except UserGroup.UserConversionFailedException:
-                    logger.error("User " + current_user["slack_id"] + "sent an invalid packet")
-                    # TODO: Return a message back to the client
-        except EmptyQueue: pass
+            # Check for new users (incremental mode already matched them on arrival)
+            users_waiting = deque()
+            if not incremental:
+                logger.debug("Pulling new user requests into the system")
+                users_waiting.extend(convert_requests(user_req_queue.drain()))
         
-        # Match users and increase group timeout
-        logger.debug("Matching groups together")
-        QueueGrouper.group_matcher(users_waiting, groups_waiting, WEIGHTS, compromise_factor=4, match_threshold=0.22)
+            # Match users and increase group timeout
+            logger.debug("Matching groups together")
+            groups_waiting = waiting_pool.to_deque()
+            GROUP_MATCHER(users_waiting, groups_waiting, WEIGHTS, compromise_factor=COMPROMISE_FACTOR, match_threshold=MATCH_THRESHOLD)
+            waiting_pool.replace(groups_waiting)
         
-        # Increase timeout, remove groups if they passed their expiration date
-        exit_queue = deque(maxlen=300)
-        groups_waiting.append(None)
-        while groups_waiting[0] is not None:
-            if groups_waiting[0].timeout < TIMEOUT_THRESHOLD:
-                groups_waiting[0].step()
-                groups_waiting.rotate(-1)
-            else:
-                groups_waiting[0].expire() # Remove users from the no-repeat set
-                exit_queue.append(groups_waiting.popleft())
-        groups_waiting.popleft()
+            # Increase timeout, remove groups if they passed their expiration date
+            exit_queue = waiting_pool.sweep(TIMEOUT_THRESHOLD)
         
-        # Message groups on the exit queue (Single id means timeout, multiple people mean group matched)
-        logger.debug("Sending messages to expired groups")
-        for group in exit_queue:
-            # Suggest resources for each group from the db_conn
-            try:
-                res_list = ResourceFinder.suggest_resource(db_conn, {"difficulty": group.attr["difficulty"], "topics": group.attr["topics"]})
-            except Exception as e:
-                logger.error(f"Resource Finder failed: {e}")
-                res_list = []
-            mail = json.dumps(GroupFormResponse.generate_response(group.to_group_form(), resources=res_list)["blocks"])
-            try:
-                result = client.conversations_open(token=os.environ.get("SLACK_BOT_TOKEN"), users=",".join(group.ids))
-                if result["ok"]:
-                    result = client.chat_postMessage(
-                        channel=result["channel"]["id"],
-                        blocks=mail,
-                        text="CTI App sent you a message"
-                    )
-            except SlackApiError as e:
-                logger.error(f"Error: {e}")
-        exit_queue.clear()
+            # Message groups on the exit queue (Single id means timeout, multiple people mean group matched)
+            logger.debug("Sending messages to expired groups")
+            sent = len(exit_queue)
+            if resources.refresh(): # Only rebuilds when the database file was replaced
+                logger.info("Resource database changed, recommendation table rebuilt")
+            message_groups(exit_queue, resources, dispatcher)
+            if sent > 0:
+                try:
+                    resources.history.save()
+                except OSError as e:
+                    logger.error(f"Could not save the seen-problem history: {e}")
         
-        # Determine wait time for next iteration
-        logger.debug("All jobs finished in cycle, waiting for next iteration...")
-        end_time = time.time() - start_time
-        if(end_time > timer): logger.warning("Cron job runtime exceeds the time allotted: " + str(end_time))
-        time.sleep(timer - min(timer, end_time))
+            logger.debug("Slack dispatcher: " + str(dispatcher.stats()))
+            if admission is not None:
+                logger.debug("Admission: " + str(admission.stats()))
+
+            # Determine wait time for next iteration
+            logger.debug("All jobs finished in cycle, waiting for next iteration...")
+            end_time = time.time() - start_time
+            if(end_time > timer): logger.warning("Cron job runtime exceeds the time allotted: " + str(end_time))
+            next_cycle = start_time + max(timer, end_time)
+            if not incremental:
+                time.sleep(timer - min(timer, end_time))
+    finally:
+        # A sharded matcher holds a process pool, stop it with the worker
+        if hasattr(GROUP_MATCHER, "close"):
+            GROUP_MATCHER.close()
+        dispatcher.close(wait=False)
+        resources.close()
+
 
 def main():
     # Create a server to handle user requests
-    listener = Listener((HOST, PORT), authkey=b'password')
-    incoming_users = Queue(maxsize=100) # Process incoming requests, 100 is a safe cap
+    listener = QueueChannel.QueueServer((HOST, PORT), AUTHKEY, handler=None)
+    incoming_users = Handoff.Handoff(QUEUE_CAPACITY) # Incoming requests, handed to the worker in batches
+    waiting_pool = WaitingPool.WaitingPool(soft_cap=SOFT_CAP) # Shared by both threads, only the worker modifies it
+    admission = Admission.AdmissionController(incoming_users, waiting_pool, RETRY_AFTER, POOL_RETRY_AFTER)
     # Start threads
-    request_accepter = threading.Thread(target=listener_thread, args=(listener, incoming_users))
-    cron_jobs = threading.Thread(target=worker_thread, args=(incoming_users, DATABASE_PATH, TIMER))
+    request_accepter = threading.Thread(target=listener_thread, args=(listener, admission))
+    cron_jobs = threading.Thread(target=worker_thread, args=(incoming_users, DATABASE_PATH, waiting_pool, TIMER),
+                                 kwargs={"admission": admission})
     request_accepter.start()
     cron_jobs.start()
     request_accepter.join()
@@ -2,6 +2,7 @@
 Template for notifying users of the group that they're part of
 # TODO: Modify allowable group forms so that the site url base can be changed
 """
+import json
 
 def generate_response(group_form, resources=[]):
     """Convert the group dictionaries generated from the matching process into Slack message blocks
@@ -58,6 +59,45 @@ def generate_response(group_form, resources=[]):
             blocks.append(link_block(res["title"], res["link"]))
     return {"blocks": blocks}
 
+def search_response(query, problems, page=0, more=False):
+    """Convert a page of problem search results into Slack message blocks
+    :param query: String the user searched for
+    :param problems: A list of problem dictionaries, see generate_response
+    :param page: Page number of the results, starting at 0
+    :param more: True if there's another page, adds a button that asks for it
+    :return: A dictionary formatted into a Slack message block
+    """
+    if len(problems) == 0:
+        m = "No problems found for *{}*".format(query) if page == 0 else "No more problems found for *{}*".format(query)
+        return {"blocks": [{"type": "section", "text": {"type": "mrkdwn", "text": m}}]}
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "Problems matching *{}* (page {}):".format(query, page + 1)
+            }
+        }
+    ]
+    for res in problems:
+        blocks.append(link_block(res["title"], res["link"], res["difficulty"], sorted(res["tags"])))
+    if more:
+        blocks.append({
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "More results"
+                    },
+                    "value": json.dumps({"query": query, "page": page + 1}),
+                    "action_id": "search-more"
+                }
+            ]
+        })
+    return {"blocks": blocks}
+
 def link_block(title, link, diff=0, tags=[], res_base="https://leetcode.com"):
     """Create a slack block for presenting resource links
     :param title: String that explains where the URL is going to
@@ -143,6 +143,7 @@ def resource_modal(ack, body, client):
         trigger_id=body["trigger_id"],
         view={
             "type": "modal",
+            "callback_id": "resource_view",
             "submit": {
                 "type": "plain_text",
                 "text": "Submit",
@@ -168,6 +169,24 @@ def resource_modal(ack, body, client):
                 },
                 {
                     "type": "input",
+                    "block_id": "resource_search",
+                    "optional": True,
+                    "label": {
+                        "type": "plain_text",
+                        "text": "Search the problem bank (titles and topics)",
+                    },
+                    "element": {
+                        "type": "plain_text_input",
+                        "action_id": "resource_search_value",
+                        "placeholder": {
+                            "type": "plain_text",
+                            "text": "i.e. binary tree",
+                        }
+                    }
+                },
+                {
+                    "type": "input",
+                    "optional": True,
                     "label": {
                         "type": "plain_text",
                         "text": "What course are you in now?",
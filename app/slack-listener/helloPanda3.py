@@ -6,8 +6,10 @@ from slack_bolt import App
 from dotenv import load_dotenv
 from pathlib import Path
 import random
-from modals import Modals
-from multiprocessing.connection import Client
+import json
+import threading
+from modals import Modals, GroupFormResponse
+from utils import ResourceFinder, QueueChannel, Admission
 
 # loads env variables
 env_path = Path('.') / '.env'
@@ -19,6 +21,33 @@ app = App(
     signing_secret=os.environ['SLACK_SIGNING_SECRET']
 )
 
+# One persistent connection to the grouping queue, shared by every handler (reconnects on its own)
+QUEUE_ADDRESS = ('group-queue', 4000)
+queue_client = QueueChannel.QueueClient(QUEUE_ADDRESS, authkey=b'password')
+
+# Problem search reads the resource database the grouping queue builds (shared docker volume)
+DATABASE_FILE = "/app/db/resource.db"
+SEARCH_PAGE_SIZE = 5
+resources = None
+resources_file = None           # (inode, mtime) of the database file the service was opened on
+resources_lock = threading.Lock()
+
+def resource_service():
+    # Opened on first use, the grouping queue may still be building the database when the app starts.
+    # The grouping queue rebuilds the database by replacing the file, pooled connections would keep reading
+    # the old one, so a new service is opened. The old one closes its connections once nobody holds it
+    global resources, resources_file
+    stat = os.stat(DATABASE_FILE)
+    with resources_lock:
+        if resources is None or resources_file != (stat.st_ino, stat.st_mtime_ns):
+            resources = ResourceFinder.ResourceService(DATABASE_FILE)
+            resources_file = (stat.st_ino, stat.st_mtime_ns)
+        return resources
+
+def search_blocks(query, page=0):
+    problems, more = resource_service().search_problems(query, page, SEARCH_PAGE_SIZE)
+    return GroupFormResponse.search_response(query, problems, page, more)["blocks"]
+
 # functionality
 @app.event("app_mention")
 def event_test(body, say):
@@ -43,15 +72,14 @@ def handle_submission(ack, body, client, view, logger):
 
     # Send data to queue and acknowledge
     try:
-        HOST = 'group-queue'            # Localhost
-        PORT = 4000                     # Port location of other program
-        with Client((HOST, PORT), authkey=b'password') as conn:
-            conn.send(group_dict)
-            response = conn.recv()
-        if response > 0:
+        code, retry_after = Admission.parse_response(queue_client.request(group_dict))
+        if code == Admission.ACCEPTED:
             m = "You will be placed in a group shortly. If this is your first time, please read our quick guide for getting started: "
             m += os.environ["MOCK_INTERVIEW_QUICK_GUIDE"]
             client.chat_postMessage(channel=group_dict["slack_id"], text=m)
+        elif code == Admission.BUSY:
+            m = "A lot of people are looking for a group right now, please submit the form again in {} seconds".format(retry_after)
+            client.chat_postMessage(channel=group_dict["slack_id"], text=m)
         else:
             client.chat_postMessage(channel=group_dict["slack_id"], text="Something went wrong, please report this issue to @NicolasGuerrero")
     except Exception as e:
@@ -71,6 +99,40 @@ def update_home_tab(client, event, logger):
 def open_resource_modal(ack, body, client):
     Modals.resource_modal(ack, body, client)
 
+@app.view("resource_view")
+def handle_resource_search(ack, body, client, view, logger):
+    ack()
+    query = view["state"]["values"]["resource_search"]["resource_search_value"]["value"]
+    if not query:
+        return
+    try:
+        client.chat_postMessage(channel=body["user"]["id"], blocks=search_blocks(query), text="Problem search results")
+    except Exception as e:
+        logger.exception(f"Problem search failed {e}")
+
+# Slash command: /problems <words>, results are only shown to the user who searched
+@app.command("/problems")
+def search_command(ack, respond, command, logger):
+    ack()
+    query = command.get("text", "").strip()
+    if not query:
+        respond(text="Usage: /problems <words from a title or topic>, i.e. /problems binary tree")
+        return
+    try:
+        respond(blocks=search_blocks(query), text="Problem search results")
+    except Exception as e:
+        logger.exception(f"Problem search failed {e}")
+        respond(text="Problem search is not available right now, please try again later")
+
+@app.action("search-more")
+def search_next_page(ack, respond, action, logger):
+    ack()
+    request = json.loads(action["value"])
+    try:
+        respond(blocks=search_blocks(request["query"], request["page"]), text="Problem search results", replace_original=True)
+    except Exception as e:
+        logger.exception(f"Problem search failed {e}")
+
 @app.action("group-button")
 def open_group_modal(ack, body, client):
     Modals.group_modal(ack, body, client)
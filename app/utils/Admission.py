@@ -0,0 +1,67 @@
+from queue import Full
+
+# Response codes sent back to the Slack app for a user_queue_request
+ACCEPTED = 1                    # The request is queued for matching
+REJECTED = -1                   # The request is invalid, sending it again won't help
+BUSY = 0                        # The queue is at capacity, sending it again after retry_after seconds may work
+
+def busy_response(retry_after):
+    '''Response for a request that was shed, the Slack app tells the user when to try again'''
+    return {"code": BUSY, "retry_after": retry_after}
+
+def parse_response(response):
+    '''
+    Read a response from the grouping queue
+    :param response: ACCEPTED, REJECTED or a busy_response dictionary
+    :return: (code, retry_after), retry_after is None unless the code is BUSY
+    '''
+    if isinstance(response, dict):
+        return response.get("code", REJECTED), response.get("retry_after")
+    return response, None
+
+class AdmissionController:
+    '''
+    AdmissionController: Decides whether a request gets into the grouping queue, and counts what was shed
+    Requests are turned away with a BUSY response (instead of failing) when the request queue is at
+    capacity or the waiting pool reached its soft cap, so overload spikes degrade into "try again later".
+
+    Instance Attributes:
+    :user_req_queue Handoff: Queue the accepted requests are put in (or a queue.Queue), its capacity is the admission capacity
+    :waiting_pool WaitingPool: Users waiting to be matched, checked with full() (None to skip)
+    :retry_after int: Seconds the user is asked to wait when the request queue is full
+    :pool_retry_after int: Seconds the user is asked to wait when the waiting pool is full
+    :counters dict(String=>int): Number of requests accepted, shed_queue (request queue full),
+        shed_pool (waiting pool full) and rejected (invalid)
+    '''
+    def __init__(self, user_req_queue, waiting_pool=None, retry_after=5, pool_retry_after=60):
+        self.user_req_queue = user_req_queue
+        self.waiting_pool = waiting_pool
+        self.retry_after = retry_after
+        self.pool_retry_after = pool_retry_after
+        self.counters = {"accepted": 0, "shed_queue": 0, "shed_pool": 0, "rejected": 0}
+
+    def admit(self, request):
+        '''
+        Put a validated request in the queue unless the system is at capacity, never blocks
+        :return: ACCEPTED, or a busy_response dictionary
+        '''
+        if self.waiting_pool is not None and self.waiting_pool.full():
+            self.counters["shed_pool"] += 1
+            return busy_response(self.pool_retry_after)
+        try:
+            self.user_req_queue.put_nowait(request)
+        except Full:
+            self.counters["shed_queue"] += 1
+            return busy_response(self.retry_after)
+        self.counters["accepted"] += 1
+        return ACCEPTED
+
+    def reject(self):
+        '''Count a request that failed validation'''
+        self.counters["rejected"] += 1
+        return REJECTED
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["shed"] = stats["shed_queue"] + stats["shed_pool"]
+        return stats
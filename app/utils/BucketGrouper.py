@@ -0,0 +1,216 @@
+from collections import deque
+from utils import UserGroup, QueueGrouper
+import bisect
+import heapq
+import math
+
+# Scores are only pruned when the lower bound clears the limit by more than float rounding
+EPSILON = 1e-9
+
+class CandidateIndex:
+    '''
+    CandidateIndex: Buckets UserGroup objects by (meeting_size, difficulty, member count)
+    Every group in a bucket shares those values, so a lower bound on the score against the
+    whole bucket is computed once (penalties give theirs through QueueGrouper.Penalty.bound), and buckets that can't get under the limit are skipped.
+    Groups keep a sequence number, candidates are always visited in sequence order.
+
+    Instance Attributes:
+    :buckets dict(tuple=>list(int)): Bucket key => sorted sequence numbers (may hold stale entries)
+    :groups dict(int=>UserGroup): Sequence number => UserGroup for every indexed group
+    :keys dict(int=>tuple): Sequence number => bucket key the group currently lives in
+    :live dict(tuple=>int): Bucket key => number of live groups, empty buckets are dropped
+    :bounds dict(tuple=>float): (group key, bucket key) => cached lower bound
+    '''
+    def __init__(self, weights, penalities=QueueGrouper.PENALTIES):
+        '''
+        :param weights: A dictionary that weighs the attributes (see UserGroup.compare_groupable)
+        :param penalities: Penalties the bound accounts for, see QueueGrouper.PenaltyRegistry
+        '''
+        self.weights = weights
+        self.penalities = QueueGrouper.as_registry(penalities)
+        self.buckets = {}
+        self.groups = {}
+        self.keys = {}
+        self.live = {}
+        self.bounds = {}
+
+    def __len__(self):
+        return len(self.groups)
+
+    @staticmethod
+    def key(group):
+        return (group.meeting_size, group.difficulty, len(group.ids))
+
+    def add(self, seq, group):
+        '''Index a UserGroup under the given sequence number'''
+        key = CandidateIndex.key(group)
+        self.groups[seq] = group
+        self.keys[seq] = key
+        self.live[key] = self.live.get(key, 0) + 1
+        bisect.insort(self.buckets.setdefault(key, []), seq)
+
+    def remove(self, seq):
+        '''Remove a group, its bucket entry is dropped lazily'''
+        del self.groups[seq]
+        self.release(self.keys.pop(seq))
+
+    def update(self, seq):
+        '''Move a group to its new bucket after it was modified (i.e. merged)'''
+        key = CandidateIndex.key(self.groups[seq])
+        if key != self.keys[seq]:
+            self.release(self.keys[seq])
+            self.keys[seq] = key
+            self.live[key] = self.live.get(key, 0) + 1
+            bisect.insort(self.buckets.setdefault(key, []), seq)
+
+    def release(self, key):
+        '''Drop a bucket once its last live group has left'''
+        self.live[key] -= 1
+        if self.live[key] == 0:
+            del self.live[key]
+            del self.buckets[key]
+
+    def lower_bound(self, group, key):
+        '''
+        Lowest score the group can get against any member of the bucket
+        Difficulty, meeting size and member count are exact for a bucket, the topic error
+        is at least 0 so it is left out. Penalties without a bound, or a negative one (scores are
+        clamped at 0), make it 0 (nothing pruned).
+        '''
+        group_key = CandidateIndex.key(group)
+        if (group_key, key) in self.bounds:
+            return self.bounds[(group_key, key)]
+        weights = self.weights
+        meeting_size, difficulty, count = key
+        error_score = 0
+        for att, value, own in (("difficulty", difficulty, group.difficulty), ("meeting_size", meeting_size, group.meeting_size)):
+            if value * own != 0:
+                error_score += weights[att] * abs(value - own)
+        error_score /= sum(weights.values()) * 2
+        values = {"meeting_size": meeting_size, "difficulty": difficulty, "members": count}
+        penalty = self.penalities.bound(group, values, weights)
+        if penalty is None or penalty < 0:
+            penalty = 0
+        self.bounds[(group_key, key)] = error_score * penalty
+        return error_score * penalty
+
+    def candidates(self, group, limit, start):
+        '''
+        Iterate over sequence numbers >= start, in order, that could score <= limit against the group
+        :param limit: The highest score worth comparing, None to visit every bucket
+        '''
+        streams = []
+        for key, seqs in self.buckets.items():
+            if limit is not None and self.lower_bound(group, key) > limit + EPSILON:
+                continue
+            streams.append(self.bucket_members(key, seqs, start))
+        return heapq.merge(*streams)
+
+    def bucket_members(self, key, seqs, start):
+        '''Iterate over the live sequence numbers >= start in one bucket, skipping stale entries'''
+        for seq in seqs[bisect.bisect_left(seqs, start):]:
+            if self.keys.get(seq) == key:
+                yield seq
+
+    def first_match(self, group, limit, start, accept):
+        '''Return the first candidate sequence number >= start that accept(candidate) approves, or None'''
+        for seq in self.candidates(group, limit, start):
+            if accept(self.groups[seq]):
+                return seq
+        return None
+
+def prunable(penalities):
+    '''Buckets can only be pruned when every penalty can give a lower bound'''
+    return all(type(p).bound is not QueueGrouper.Penalty.bound for p in QueueGrouper.as_registry(penalities))
+
+def group_matcher(
+    users_waiting: deque, groups_waiting: deque, weights:dict,
+    compromise_factor: int, match_threshold: float,
+    penalities=QueueGrouper.PENALTIES):
+    '''
+    Drop-in replacement for QueueGrouper.group_matcher that only compares plausible pairs
+    Users and groups are bucketed with a CandidateIndex, and buckets whose lower bound is
+    above the match threshold are never scored. Merge decisions are the same as the original.
+
+    :param users_waiting: A deque of new UserGroup objects, emptied by the matcher
+    :param groups_waiting: A deque of UserGroup objects already waiting, modified in place
+    :param weights: A dictionary that weighs the attributes (see UserGroup.compare_groupable)
+    :param compromise_factor: Controls how fast the match threshold relaxes with timeout
+    :param match_threshold: The highest score that still results in a merge
+    :param penalities: A QueueGrouper.PenaltyRegistry or a list of penalty functions,
+        pruning is turned off when a penalty can't give a lower bound
+    '''
+    penalities = QueueGrouper.as_registry(penalities)
+    pruning = prunable(penalities)
+
+    def compat_score(group, other):
+        # Score: Direct Comparison + Penalties
+        score = UserGroup.compare_groupable(group, other, weights)
+        score *= penalities.pair(group, other, weights)
+        return max(0, score)
+
+    # Rotation 1: Add new users to existing groups
+    # The deque rotation always scans surviving users in arrival order. After a merge, the next
+    # user is rotated past without a comparison, and merging the last user wraps back to the first.
+    users = CandidateIndex(weights, penalities)
+    following = {}
+    for seq, user in enumerate(users_waiting):
+        users.add(seq, user)
+        following[seq] = seq + 1 if seq + 1 < len(users_waiting) else None
+    preceding = {seq: seq - 1 for seq in following}
+    head = 0 if len(users) > 0 else None
+    retry_queue = deque()
+    kept = deque()
+    for group in groups_waiting:
+        accept = lambda user: compat_score(group, user) <= match_threshold
+        start = head
+        while start is not None:
+            seq = users.first_match(group, match_threshold if pruning else None, start, accept)
+            if seq is None:
+                break
+            group.merge(users.groups[seq])
+            users.remove(seq)
+            skipped = following[seq]
+            # Unlink the merged user
+            if preceding[seq] >= 0:
+                following[preceding[seq]] = skipped
+            if skipped is not None:
+                preceding[skipped] = preceding[seq]
+            if seq == head:
+                head = skipped
+            del following[seq]
+            start = head if skipped is None else following[skipped]
+        # Decide whether the current group goes to the retry queue
+        if len(group.ids) <= 1:
+            retry_queue.append(group)
+        else:
+            kept.append(group)
+    groups_waiting.clear()
+    unmatched = [users.groups[seq] for seq in sorted(users.groups)]
+    users_waiting.clear() # Remember to dump the user queue now that we're done with it
+
+    # Place the unmatched users at front of group queue, in reverse like deque.extendleft
+    pool = CandidateIndex(weights, penalities)
+    for seq, group in enumerate(list(reversed(unmatched)) + list(kept)):
+        pool.add(seq, group)
+    front = 0
+
+    # Rotation 2: Try to merge users that couldn't find a group originally
+    for retry in retry_queue:
+        # We use a combination of timeout and compromise factor (CF) to artificially lower thresholds
+        compromise_coeff = min(1, 1 / math.log2((retry.timeout / compromise_factor) + 1))
+        accept = lambda group: compat_score(group, retry) * compromise_coeff <= match_threshold
+        limit = match_threshold / compromise_coeff if pruning else None
+        seq = pool.first_match(retry, limit, front, accept)
+        if seq is not None:
+            pool.groups[seq].merge(retry)
+            pool.update(seq)
+        else:
+            # Re-integrate at the front if a group wasn't found
+            front -= 1
+            pool.add(front, retry)
+
+    groups_waiting.extend(pool.groups[seq] for seq in sorted(pool.groups))
+    # users_waiting should be empty (& can be discarded), groups_waiting modified
+    # Timeout is not incremented here, read-only
+    return
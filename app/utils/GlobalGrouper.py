@@ -0,0 +1,98 @@
+from collections import deque
+from utils import QueueGrouper, MatrixGrouper
+import numpy as np
+import heapq
+import math
+
+# Number of rows scored at once when building the initial edge list, bounds peak memory
+CHUNK = 512
+
+def compromise(group, compromise_factor):
+    '''Compromise coefficient for a group, only single users get one (like the retry rotation)'''
+    if len(group.ids) > 1:
+        return 1
+    return min(1, 1 / math.log2((group.timeout / compromise_factor) + 1))
+
+def group_matcher(
+    users_waiting: deque, groups_waiting: deque, weights:dict,
+    compromise_factor: int, match_threshold: float,
+    penalities=QueueGrouper.PENALTIES, maxsize=4):
+    '''
+    Opt-in alternative to QueueGrouper.group_matcher that merges the best pairs first
+    Every pair (edge) scoring under the match threshold is collected and sorted, then the best
+    remaining edge is merged until none are left. When a group grows, only its own edges are
+    rescored and pushed on a min-heap, outdated edges are skipped using a version counter.
+    Runs in O(E log E) over the candidate edges, scoring is vectorized with MatrixGrouper.
+
+    The result no longer depends on queue order, so early arrivals don't absorb users that
+    fit better elsewhere. Single users get the same compromise coefficient as the retry
+    rotation in QueueGrouper.group_matcher.
+
+    :param users_waiting: A deque of new UserGroup objects, emptied by the matcher
+    :param groups_waiting: A deque of UserGroup objects already waiting, modified in place
+    :param weights: A dictionary that weighs the attributes (see UserGroup.compare_groupable)
+    :param compromise_factor: Controls how fast the match threshold relaxes with timeout
+    :param match_threshold: The highest score that still results in a merge
+    :param penalities: A QueueGrouper.PenaltyRegistry or a list of penalty functions
+    :param maxsize: Groups are never merged past this many members
+    '''
+    pending = list(groups_waiting) + list(users_waiting)
+    groups_waiting.clear()
+    users_waiting.clear()
+    packed = MatrixGrouper.GroupMatrix(pending)
+    coeffs = np.array([compromise(group, compromise_factor) for group in pending])
+    rows = np.arange(len(pending))
+    alive = np.ones(len(pending), dtype=bool)
+    versions = np.zeros(len(pending), dtype=np.int64)
+
+    def edge_scores(block, columns):
+        # Score matrix between two sets of rows, pairs that would be oversized are left out
+        scores = MatrixGrouper.score(packed, block, packed, columns, weights, penalities)
+        scores *= np.minimum(coeffs[block][:, None], coeffs[columns][None, :])
+        scores[packed.size[block][:, None] + packed.size[columns][None, :] > maxsize] = np.inf
+        return scores
+
+    # Initial edges: every pair under the threshold, sorted by (score, row, row)
+    edge_lists = ([], [], [])
+    for start in range(0, len(pending), CHUNK):
+        block = rows[start:start + CHUNK]
+        scores = edge_scores(block, rows)
+        first, second = np.nonzero((scores <= match_threshold) & (rows[None, :] > block[:, None]))
+        edge_lists[0].append(scores[first, second])
+        edge_lists[1].append(block[first])
+        edge_lists[2].append(second)
+    edge_score, edge_first, edge_second = (np.concatenate(x) if x else np.zeros(0) for x in edge_lists)
+    order = np.lexsort((edge_second, edge_first, edge_score))
+    initial = iter(zip(edge_score[order].tolist(), edge_first[order].tolist(), edge_second[order].tolist()))
+    next_initial = next(initial, None)
+
+    # Edges rescored after a merge, (score, row, row, version, version)
+    heap = []
+    while next_initial is not None or heap:
+        # Take the best edge from either the sorted initial edges or the heap
+        if heap and (next_initial is None or heap[0][:3] < next_initial):
+            score, parent, child, parent_version, child_version = heapq.heappop(heap)
+        else:
+            score, parent, child = next_initial
+            parent_version = child_version = 0
+            next_initial = next(initial, None)
+        if not (alive[parent] and alive[child]):
+            continue
+        if versions[parent] != parent_version or versions[child] != child_version:
+            continue
+        # Merge, the earlier arrival keeps its place in the queue
+        pending[parent].merge(pending[child])
+        packed.update(parent)
+        alive[child] = False
+        versions[parent] += 1
+        coeffs[parent] = compromise(pending[parent], compromise_factor)
+        partners = rows[alive & (rows != parent)]
+        scores = edge_scores([parent], partners)[0]
+        for partner, partner_score in zip(partners[scores <= match_threshold].tolist(), scores[scores <= match_threshold].tolist()):
+            first, second = min(parent, partner), max(parent, partner)
+            heapq.heappush(heap, (partner_score, first, second, int(versions[first]), int(versions[second])))
+
+    groups_waiting.extend(pending[row] for row in rows[alive])
+    # users_waiting is empty, groups_waiting modified
+    # Timeout is not incremented here, read-only
+    return
@@ -0,0 +1,54 @@
+import threading
+import time
+from queue import Full
+
+class Handoff:
+    '''
+    Handoff: Hands requests from the listener thread to the worker thread in batches, within one process
+    Replaces the multiprocessing.Queue between the two threads, which pickled every packet through a pipe.
+    Items are kept as they are, with the time they were put in. The worker takes everything pending in
+    one atomic drain instead of one get() per item.
+
+    Instance Attributes:
+    :capacity int: Most items pending at once, put_nowait raises queue.Full past this (None for no limit)
+    :items list((float, object)): Pending (enqueue time, item) pairs, oldest first
+    :clock function: Time source of the enqueue times, time.monotonic by default
+    '''
+    def __init__(self, capacity=None, clock=time.monotonic):
+        self.capacity = capacity
+        self.clock = clock
+        self.items = []
+        self.ready = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def qsize(self):
+        return len(self.items)
+
+    def put_nowait(self, item):
+        '''Add an item, raises queue.Full at capacity (same as Queue.put_nowait)'''
+        with self.ready:
+            if self.capacity is not None and len(self.items) >= self.capacity:
+                raise Full
+            self.items.append((self.clock(), item))
+            self.ready.notify()
+
+    def drain(self):
+        '''
+        Take every pending item at once
+        :return: A list of (enqueue time, item) pairs, oldest first, empty if nothing is pending
+        '''
+        with self.ready:
+            items, self.items = self.items, []
+        return items
+
+    def wait(self, timeout=None):
+        '''
+        Block until something is pending (or timeout seconds pass), then drain
+        :return: See drain, empty on timeout
+        '''
+        with self.ready:
+            self.ready.wait_for(lambda: len(self.items) > 0, timeout)
+            items, self.items = self.items, []
+        return items
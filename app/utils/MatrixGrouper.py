@@ -0,0 +1,166 @@
+from collections import deque
+from utils import UserGroup, QueueGrouper
+import numpy as np
+import math
+
+class GroupMatrix:
+    '''
+    GroupMatrix: Packs UserGroup objects into NumPy arrays so they can be scored all at once
+
+    Instance Attributes:
+    :groups list(UserGroup): The packed UserGroup objects, row i of every array belongs to groups[i]
+    :difficulty ndarray(float): Difficulty attribute of each group (0 is a wildcard)
+    :meeting_size ndarray(float): Meeting size attribute of each group (0 is a wildcard)
+    :size ndarray(int): Number of members in each group
+    :timeout ndarray(int): Timeout counter of each group
+    :topics ndarray(float): Topic weight matrix, one column per topic in UserGroup.TOPICS
+    '''
+    def __init__(self, groups, capacity=None):
+        '''
+        :param groups: An iterable of UserGroup objects to pack
+        :param capacity: Number of rows to allocate, extra rows can be filled with append()
+        '''
+        groups = list(groups)
+        capacity = max(len(groups), capacity or 0)
+        self.groups = []
+        self.difficulty = np.zeros(capacity)
+        self.meeting_size = np.zeros(capacity)
+        self.size = np.zeros(capacity, dtype=np.int64)
+        self.timeout = np.zeros(capacity, dtype=np.int64)
+        self.topics = np.zeros((capacity, len(UserGroup.TOPICS)))
+        for group in groups:
+            self.append(group)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def append(self, group):
+        '''Pack a UserGroup into the next free row and return the row number'''
+        self.groups.append(group)
+        self.update(len(self.groups) - 1)
+        return len(self.groups) - 1
+
+    def update(self, row):
+        '''Re-pack a row after its UserGroup was modified (i.e. merged)'''
+        group = self.groups[row]
+        self.difficulty[row] = group.difficulty
+        self.meeting_size[row] = group.meeting_size
+        self.size[row] = len(group.ids)
+        self.timeout[row] = group.timeout
+        self.topics[row] = group.topics
+
+    def column(self, attribute):
+        '''Array of a named attribute for every row, see QueueGrouper.attribute_value'''
+        if attribute == "members":
+            return self.size
+        return getattr(self, attribute)
+
+def compare_groupable(x: GroupMatrix, xi, y: GroupMatrix, yi, weights: dict):
+    '''
+    Vectorized UserGroup.compare_groupable between rows xi of x and rows yi of y
+    :return: A len(xi) x len(yi) matrix of compatibility scores, lower is better
+    '''
+    # Numeric attributes, a value of 0 on either side is a wildcard
+    error_score = np.zeros((len(xi), len(yi)))
+    for att in ("difficulty", "meeting_size"):
+        x_att = getattr(x, att)[xi][:, None]
+        y_att = getattr(y, att)[yi][None, :]
+        error_score += weights[att] * np.where(x_att * y_att != 0, np.abs(x_att - y_att), 0)
+    # Topic dictionaries, only the topics both groups share reduce the error
+    x_topics, y_topics = x.topics[xi], y.topics[yi]
+    shared = x_topics @ (y_topics > 0).T + (x_topics > 0) @ y_topics.T
+    error_score += weights["topics"] * (2 - shared)
+    return error_score / (sum(weights.values()) * 2)
+
+def score(x: GroupMatrix, xi, y: GroupMatrix, yi, weights: dict, penalities):
+    '''Score matrix between rows xi of x and rows yi of y: Direct Comparison + Penalties'''
+    xi, yi = np.asarray(xi, dtype=np.int64), np.asarray(yi, dtype=np.int64)
+    # Declarative penalties are applied to whole arrays, plain functions are called pair by pair
+    penalty = QueueGrouper.as_registry(penalities).batch(x, xi, y, yi, weights)
+    return np.maximum(0, compare_groupable(x, xi, y, yi, weights) * penalty)
+
+def first_match(scores, match_threshold):
+    '''Return the position of the first score under the threshold, or None'''
+    hits = np.flatnonzero(scores <= match_threshold)
+    return int(hits[0]) if len(hits) > 0 else None
+
+def group_matcher(
+    users_waiting: deque, groups_waiting: deque, weights:dict,
+    compromise_factor: int, match_threshold: float,
+    penalities=QueueGrouper.PENALTIES):
+    '''
+    Drop-in replacement for QueueGrouper.group_matcher that scores with NumPy arrays
+    Merge decisions are the same as the original (first-fit in queue order), but each
+    group is scored against every candidate in a single vectorized operation, and
+    scores are only recomputed for the rows that changed after a merge.
+
+    :param users_waiting: A deque of new UserGroup objects, emptied by the matcher
+    :param groups_waiting: A deque of UserGroup objects already waiting, modified in place
+    :param weights: A dictionary that weighs the attributes (see UserGroup.compare_groupable)
+    :param compromise_factor: Controls how fast the match threshold relaxes with timeout
+    :param match_threshold: The highest score that still results in a merge
+    :param penalities: A QueueGrouper.PenaltyRegistry or a list of penalty functions
+    '''
+    penalities = QueueGrouper.as_registry(penalities)
+    users = GroupMatrix(users_waiting)
+    groups = GroupMatrix(groups_waiting)
+    users_waiting.clear()
+    groups_waiting.clear()
+
+    # Rotation 1: Add new users to existing groups
+    # The user deque is simulated with an array of row numbers, -1 standing in for the sentinel None
+    retry_rows = []
+    kept_rows = []
+    user_queue = np.arange(len(users))
+    scores = score(groups, np.arange(len(groups)), users, user_queue, weights, penalities)
+    for row in range(len(groups)):
+        row_scores = scores[row]
+        user_queue = np.append(user_queue, -1)
+        while user_queue[0] != -1:
+            # Every user up to the sentinel is compared with the group, in order
+            sentinel = int(np.flatnonzero(user_queue == -1)[0])
+            hit = first_match(row_scores[user_queue[:sentinel]], match_threshold)
+            if hit is None:
+                user_queue = np.roll(user_queue, -sentinel)
+                break
+            # Merge, rescore the group (it changed), then rotate past the next user like the deque does
+            user_queue = np.roll(user_queue, -hit)
+            groups.groups[row].merge(users.groups[user_queue[0]])
+            groups.update(row)
+            user_queue = np.roll(user_queue[1:], -1)
+            row_scores = np.zeros(len(users))
+            live = user_queue[user_queue != -1]
+            row_scores[live] = score(groups, [row], users, live, weights, penalities)[0]
+        user_queue = user_queue[1:] # Removes the sentinel
+        # Decide whether the current group goes to the retry queue
+        if groups.size[row] <= 1:
+            retry_rows.append(row)
+        else:
+            kept_rows.append(row)
+
+    # Place the unmatched users at the front of the group queue (mirrors deque.extendleft)
+    pool = GroupMatrix([users.groups[i] for i in reversed(user_queue)] + [groups.groups[i] for i in kept_rows],
+                       capacity=len(user_queue) + len(kept_rows) + len(retry_rows))
+    order = np.arange(len(pool))
+
+    # Rotation 2: Try to merge users that couldn't find a group originally
+    retry = GroupMatrix([groups.groups[i] for i in retry_rows])
+    for row in range(len(retry)):
+        if len(order) > 0:
+            # We use a combination of timeout and compromise factor (CF) to artificially lower thresholds
+            compromise_coeff = 1 / math.log2((retry.groups[row].timeout / compromise_factor) + 1)
+            row_scores = score(pool, order, retry, [row], weights, penalities)[:, 0] * min(1, compromise_coeff)
+            hit = first_match(row_scores, match_threshold)
+        else:
+            hit = None
+        if hit is not None:
+            pool.groups[order[hit]].merge(retry.groups[row])
+            pool.update(order[hit])
+        else:
+            # Re-integrate at the front if a group wasn't found
+            order = np.concatenate(([pool.append(retry.groups[row])], order))
+
+    groups_waiting.extend(pool.groups[i] for i in order)
+    # users_waiting is empty, groups_waiting modified
+    # Timeout is not incremented here, read-only
+    return
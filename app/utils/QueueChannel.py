@@ -0,0 +1,299 @@
+import asyncio
+import hmac
+import json
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+# Frames are a 4 byte big-endian length followed by that many bytes of UTF-8 JSON
+HEADER = struct.Struct("!I")
+MAX_FRAME = 1 << 20             # Largest frame accepted, anything bigger is a broken or hostile peer
+CHALLENGE_BYTES = 32            # Random bytes each side has to sign with the shared authkey
+HANDSHAKE_TIMEOUT = 5           # Seconds a peer has to finish the handshake
+FRAME_TIMEOUT = 5               # Seconds the server waits for the rest of a frame once it started, and for a reply to be sent
+BACKLOG = 512                   # Connections waiting to be accepted, bursts of submissions land here
+
+class ChannelError(ConnectionError):
+    '''Raised when the peer fails the handshake or sends something that isn't a valid frame'''
+    pass
+
+def encode_frame(message):
+    data = json.dumps(message).encode()
+    return HEADER.pack(len(data)) + data
+
+def send_frame(sock, message):
+    sock.sendall(encode_frame(message))
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the peer")
+        data += chunk
+    return bytes(data)
+
+def decode_frame(data):
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise ChannelError("Frame is not valid JSON: {}".format(e))
+
+def frame_size(header):
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ChannelError("Frame of {} bytes is over the limit".format(size))
+    return size
+
+def recv_frame(sock):
+    return decode_frame(recv_exact(sock, frame_size(recv_exact(sock, HEADER.size))))
+
+async def read_frame(reader, idle_timeout=None, frame_timeout=FRAME_TIMEOUT):
+    '''
+    Read a frame from an asyncio stream
+    :param idle_timeout: Seconds to wait for the frame to start, None to wait forever
+    :param frame_timeout: Seconds the rest of the frame may take once it started
+    '''
+    header = await asyncio.wait_for(reader.readexactly(HEADER.size), idle_timeout)
+    return decode_frame(await asyncio.wait_for(reader.readexactly(frame_size(header)), frame_timeout))
+
+async def write_frame(writer, message, timeout=FRAME_TIMEOUT):
+    writer.write(encode_frame(message))
+    await asyncio.wait_for(writer.drain(), timeout)
+
+def new_challenge():
+    return os.urandom(CHALLENGE_BYTES).hex()
+
+def sign(authkey, challenge):
+    '''HMAC-SHA256 of a hex challenge, proves the signer knows the authkey without sending it'''
+    try:
+        return hmac.new(authkey, bytes.fromhex(challenge), "sha256").hexdigest()
+    except (TypeError, ValueError):
+        raise ChannelError("Malformed challenge")
+
+def verify(authkey, challenge, digest):
+    return isinstance(digest, str) and hmac.compare_digest(digest, sign(authkey, challenge))
+
+async def server_handshake(reader, writer, authkey):
+    '''
+    Mutual challenge-response, server side: challenge the client, then answer the client's challenge
+    Same idea as the authkey handshake of multiprocessing.connection, over JSON frames.
+    '''
+    challenge = new_challenge()
+    await write_frame(writer, {"challenge": challenge})
+    reply = await read_frame(reader)
+    if not isinstance(reply, dict) or not verify(authkey, challenge, reply.get("digest")):
+        raise ChannelError("Client failed the authentication challenge")
+    await write_frame(writer, {"digest": sign(authkey, reply.get("challenge"))})
+
+def client_handshake(sock, authkey):
+    '''Mutual challenge-response, client side, see server_handshake'''
+    message = recv_frame(sock)
+    if not isinstance(message, dict):
+        raise ChannelError("Server sent no challenge")
+    challenge = new_challenge()
+    send_frame(sock, {"digest": sign(authkey, message.get("challenge")), "challenge": challenge})
+    reply = recv_frame(sock)
+    if not isinstance(reply, dict) or not verify(authkey, challenge, reply.get("digest")):
+        raise ChannelError("Server failed the authentication challenge")
+
+class QueueServer:
+    '''
+    QueueServer: Serves request frames from long-lived client connections on an asyncio event loop
+    Every connection is authenticated once (server_handshake), then carries any number of requests
+    {"request_id", "packet"}. Each packet is passed to handler, and the return value is sent back as
+    {"request_id", "response"}. Requests on a connection are answered in order, connections don't wait
+    on each other. The handler runs on the event loop, so it must not block (i.e. Queue.put(block=False)).
+
+    A client that stalls in the handshake, in the middle of a frame or while a reply is sent is
+    disconnected after the timeouts, without holding up anyone else.
+
+    Instance Attributes:
+    :sock socket: The listening socket
+    :address tuple: (host, port) the server is bound to, the port is filled in when binding to port 0
+    :authkey bytes: Shared secret clients have to prove they know
+    :handler function: Called with each packet (a dictionary), returns a JSON serializable response
+    :handshake_timeout float: Seconds a new connection has to authenticate
+    :frame_timeout float: Seconds to finish a frame once it started, and to send a reply
+    :idle_timeout float: Seconds a connection may sit between requests, None to keep it open
+    :connections set(StreamWriter): Open client connections, closed along with the server
+    '''
+    def __init__(self, address, authkey, handler, handshake_timeout=HANDSHAKE_TIMEOUT, frame_timeout=FRAME_TIMEOUT,
+                 idle_timeout=None):
+        self.sock = socket.create_server(address, backlog=BACKLOG)
+        self.address = self.sock.getsockname()[:2]
+        self.authkey = authkey
+        self.handler = handler
+        self.handshake_timeout = handshake_timeout
+        self.frame_timeout = frame_timeout
+        self.idle_timeout = idle_timeout
+        self.connections = set()
+        self.loop = None
+        self.stopping = None
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        '''Run the event loop in the calling thread, accepting connections until close() is called'''
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self.serve_connection, sock=self.sock, backlog=BACKLOG)
+            async with server:
+                await self.stopping.wait()
+                for writer in list(self.connections):
+                    writer.close()
+        finally:
+            self.stopped.set()
+
+    async def serve_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            await asyncio.wait_for(server_handshake(reader, writer, self.authkey), self.handshake_timeout)
+            while True:
+                frame = await read_frame(reader, self.idle_timeout, self.frame_timeout)
+                await write_frame(writer, {"request_id": frame["request_id"], "response": self.respond(frame["packet"])},
+                                  self.frame_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, KeyError, TypeError):
+            pass # Client left, stalled, failed the handshake or broke the protocol, drop the connection
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def respond(self, packet):
+        # A failing handler answers -1 (like a rejected request) instead of dropping the connection
+        try:
+            return self.handler(packet)
+        except Exception:
+            return -1
+
+    def close(self, timeout=5):
+        '''Stop accepting and close every client connection (from any thread), clients reconnect to the next server'''
+        if self.loop is None:
+            self.sock.close()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        except RuntimeError:
+            return # Loop already finished
+        self.stopped.wait(timeout)
+
+class QueueClient:
+    '''
+    QueueClient: One persistent, authenticated connection to a QueueServer, shared by every thread
+    Requests get an id and are written as soon as they're submitted, so several can be in flight at once.
+    A reader thread matches the responses to their futures. The connection is opened on first use and
+    opened again on the next request after it breaks, requests that were in flight fail with ConnectionError.
+
+    Instance Attributes:
+    :address tuple: (host, port) of the server
+    :authkey bytes: Shared secret with the server
+    :timeout float: Default seconds request() waits for a response
+    :connect_timeout float: Seconds to connect and finish the handshake
+    :sock socket: The current connection, None when disconnected
+    :pending dict(int=>Future): Request id => future of every request waiting for its response
+    '''
+    def __init__(self, address, authkey, timeout=10, connect_timeout=5):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.pending = {}
+        self.next_id = 0
+        self.lock = threading.Lock()            # Guards sock, pending and next_id, only held for bookkeeping
+        self.connect_lock = threading.Lock()    # Only one thread opens a connection at a time
+        self.write_lock = threading.Lock()      # Orders writes to the socket, frames can't interleave
+
+    def connect(self):
+        '''Open and authenticate a new connection, called with the connect lock held. Returns the socket'''
+        sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+        try:
+            client_handshake(sock, self.authkey)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        with self.lock:
+            self.sock = sock
+        threading.Thread(target=self.read_responses, args=(sock,), daemon=True).start()
+        return sock
+
+    def connection(self):
+        '''The current connection, opened first if there is none'''
+        sock = self.sock
+        if sock is not None:
+            return sock
+        with self.connect_lock:
+            sock = self.sock # Another thread may have connected while this one waited
+            return sock if sock is not None else self.connect()
+
+    def drop(self, sock):
+        '''Forget a broken connection, called with the lock held. Returns the futures left without a response'''
+        if self.sock is not sock:
+            return []
+        self.sock = None
+        failed = list(self.pending.values())
+        self.pending.clear()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        return failed
+
+    def read_responses(self, sock):
+        try:
+            while True:
+                frame = recv_frame(sock)
+                with self.lock:
+                    future = self.pending.pop(frame["request_id"], None)
+                if future is not None:
+                    future.set_result(frame["response"])
+        except (OSError, KeyError, TypeError) as e:
+            with self.lock:
+                failed = self.drop(sock)
+            for future in failed:
+                future.set_exception(ConnectionError("Connection to the queue was lost: {}".format(e)))
+
+    def submit(self, packet):
+        '''
+        Send a packet without waiting for the response
+        A write on a broken connection is retried once on a new connection. Connecting and writing
+        happen outside the lock, so the reader thread can keep resolving other requests meanwhile.
+        :return: A concurrent.futures.Future with the server's response
+        '''
+        for attempt in range(2):
+            sock = self.connection()
+            future = Future()
+            with self.lock:
+                request_id = self.next_id
+                self.next_id += 1
+                self.pending[request_id] = future
+            try:
+                with self.write_lock:
+                    send_frame(sock, {"request_id": request_id, "packet": packet})
+                return future
+            except OSError as e:
+                # The future is thrown away, it may already have failed with the connection
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                    failed = self.drop(sock)
+                error = e
+            for other in failed:
+                other.set_exception(ConnectionError("Connection to the queue was lost: {}".format(error)))
+        raise ConnectionError("Could not send the request: {}".format(error))
+
+    def request(self, packet, timeout=None):
+        '''Send a packet and wait for the response, see submit'''
+        return self.submit(packet).result(self.timeout if timeout is None else timeout)
+
+    def close(self):
+        with self.lock:
+            failed = self.drop(self.sock) if self.sock is not None else []
+        for future in failed:
+            future.set_exception(ConnectionError("Client closed"))
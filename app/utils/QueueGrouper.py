@@ -1,5 +1,6 @@
 from multiprocessing import Queue
 from collections import deque
+from abc import ABC, abstractmethod
 from utils import UserGroup
 import math
 
@@ -9,19 +10,270 @@ class ImproperQueueException(Exception):
 # Penalty functions: Must accept UserGroup objects & weights, and return a numeric penalty
 def meeting_size_penalty(user_x: UserGroup.UserGroup, user_y: UserGroup.UserGroup, weights: dict, maxsize=4):
     full_size = len(user_x.ids) + len(user_y.ids)
-    if full_size < min(user_x.attr["meeting_size"], user_y.attr["meeting_size"]):
+    if full_size < min(user_x.meeting_size, user_y.meeting_size):
         return (1 - (weights["meeting_size"] / sum(weights.values())))
     elif full_size > maxsize:
         return 2000000
     else:
         return 1
 
-PENALTIES = [meeting_size_penalty]
+# Numeric UserGroup attributes a declarative penalty can look at, "members" is the number of group members
+ATTRIBUTES = ("difficulty", "meeting_size", "timeout", "members")
+
+def attribute_value(group, attribute):
+    '''Read a named attribute from a UserGroup, "members" is the number of group members'''
+    return len(group.ids) if attribute == "members" else getattr(group, attribute)
+
+def check_attribute(attribute):
+    '''UserGroup has fixed __slots__, so only the attributes in ATTRIBUTES can be penalized'''
+    if attribute not in ATTRIBUTES:
+        raise ValueError("Unsupported penalty attribute {!r}, expected one of {}".format(attribute, ATTRIBUTES))
+    return attribute
+
+# Declarative penalties: Described by an attribute name and a few numbers instead of code, so they
+# can be applied per pair (calling the penalty, same signature as the functions above) or in batch
+# over the rows of two MatrixGrouper.GroupMatrix objects. Penalties are summed together.
+# NumPy is only imported by the batch methods, the pure Python grouper doesn't need it.
+class Penalty(ABC):
+    '''
+    Penalty: Base class for penalties declared over a named UserGroup attribute
+    Subclasses implement __call__, batch defaults to calling it once per pair.
+
+    Instance Attributes:
+    :attribute String: Name of the attribute the penalty looks at, one of ATTRIBUTES
+    '''
+    attribute = None
+
+    @abstractmethod
+    def __call__(self, user_x, user_y, weights):
+        '''Penalty for one pair of UserGroup objects'''
+
+    def batch(self, x, xi, y, yi, weights):
+        '''Penalty matrix between rows xi of GroupMatrix x and rows yi of GroupMatrix y'''
+        import numpy as np
+        penalty = np.zeros((len(xi), len(yi)))
+        for a, i in enumerate(xi):
+            for b, j in enumerate(yi):
+                penalty[a, b] = self(x.groups[i], y.groups[j], weights)
+        return penalty
+
+    def bound(self, group, values, weights):
+        '''
+        Lowest penalty the group can get against any group with the given attribute values
+        :param values: A dictionary of attribute String=>Numeric known for the other side
+        :return: A lower bound, or None if the penalty can't give one
+        '''
+        return None
+
+class SizePenalty(Penalty):
+    '''
+    SizePenalty: Caps the number of members and rewards groups still under their preferred size
+    Same rule as meeting_size_penalty: a merged group smaller than both preferences gets a discount
+    scaled by the attribute weight, one larger than maxsize gets the over penalty, otherwise 1.
+    '''
+    def __init__(self, attribute="meeting_size", maxsize=4, over=2000000):
+        self.attribute = check_attribute(attribute)
+        self.maxsize = maxsize
+        self.over = over
+
+    def value(self, full_size, preferred, weights):
+        if full_size < preferred:
+            return 1 - (weights[self.attribute] / sum(weights.values()))
+        elif full_size > self.maxsize:
+            return self.over
+        else:
+            return 1
+
+    def __call__(self, user_x, user_y, weights):
+        preferred = min(getattr(user_x, self.attribute), getattr(user_y, self.attribute))
+        return self.value(len(user_x.ids) + len(user_y.ids), preferred, weights)
+
+    def batch(self, x, xi, y, yi, weights):
+        import numpy as np
+        full_size = x.column("members")[xi][:, None] + y.column("members")[yi][None, :]
+        preferred = np.minimum(x.column(self.attribute)[xi][:, None], y.column(self.attribute)[yi][None, :])
+        penalty = np.where(full_size > self.maxsize, float(self.over), 1.0)
+        return np.where(full_size < preferred, 1 - (weights[self.attribute] / sum(weights.values())), penalty)
+
+    def bound(self, group, values, weights):
+        if "members" in values and self.attribute in values:
+            preferred = min(getattr(group, self.attribute), values[self.attribute])
+            return self.value(len(group.ids) + values["members"], preferred, weights)
+        return min(1 - (weights[self.attribute] / sum(weights.values())), 1, self.over)
+
+class ThresholdPenalty(Penalty):
+    '''
+    ThresholdPenalty: Flat penalty once two attribute values are further apart than a threshold
+    i.e. ThresholdPenalty("difficulty", threshold=1, penalty=2000000) keeps groups within 1 difficulty level
+    A value of 0 is treated like a wildcard (never penalized) unless wildcard is False.
+    With weighted, the result is scaled by the attribute's share of the weights.
+    '''
+    def __init__(self, attribute, threshold, penalty, otherwise=0, wildcard=True, weighted=False):
+        self.attribute = check_attribute(attribute)
+        self.threshold = threshold
+        self.penalty = penalty
+        self.otherwise = otherwise
+        self.wildcard = wildcard
+        self.weighted = weighted
+
+    def scale(self, weights):
+        return weights.get(self.attribute, 0) / sum(weights.values()) if self.weighted else 1
+
+    def value(self, x_value, y_value, weights):
+        if self.wildcard and x_value * y_value == 0:
+            return self.otherwise * self.scale(weights)
+        return (self.penalty if abs(x_value - y_value) > self.threshold else self.otherwise) * self.scale(weights)
+
+    def __call__(self, user_x, user_y, weights):
+        return self.value(attribute_value(user_x, self.attribute), attribute_value(user_y, self.attribute), weights)
+
+    def batch(self, x, xi, y, yi, weights):
+        import numpy as np
+        x_values = x.column(self.attribute)[xi][:, None]
+        y_values = y.column(self.attribute)[yi][None, :]
+        penalty = np.where(np.abs(x_values - y_values) > self.threshold, float(self.penalty), float(self.otherwise))
+        if self.wildcard:
+            penalty = np.where(x_values * y_values == 0, float(self.otherwise), penalty)
+        return penalty * self.scale(weights)
+
+    def bound(self, group, values, weights):
+        if self.attribute in values:
+            return self.value(attribute_value(group, self.attribute), values[self.attribute], weights)
+        return min(self.penalty, self.otherwise) * self.scale(weights)
+
+class DistancePenalty(Penalty):
+    '''
+    DistancePenalty: Penalty that grows with the distance between two attribute values, up to a cap
+    i.e. DistancePenalty("members", scale=0.25, cap=0.5) adds 0.25 for every member apart, at most 0.5
+    A value of 0 is treated like a wildcard (no penalty) unless wildcard is False.
+    With weighted, the result is scaled by the attribute's share of the weights.
+    '''
+    def __init__(self, attribute, scale=1, cap=None, wildcard=True, weighted=False):
+        self.attribute = check_attribute(attribute)
+        self.scale = scale
+        self.cap = cap
+        self.wildcard = wildcard
+        self.weighted = weighted
+
+    def share(self, weights):
+        return weights.get(self.attribute, 0) / sum(weights.values()) if self.weighted else 1
+
+    def value(self, x_value, y_value, weights):
+        if self.wildcard and x_value * y_value == 0:
+            return 0
+        penalty = self.scale * abs(x_value - y_value)
+        return (penalty if self.cap is None else min(self.cap, penalty)) * self.share(weights)
+
+    def __call__(self, user_x, user_y, weights):
+        return self.value(attribute_value(user_x, self.attribute), attribute_value(user_y, self.attribute), weights)
+
+    def batch(self, x, xi, y, yi, weights):
+        import numpy as np
+        x_values = x.column(self.attribute)[xi][:, None]
+        y_values = y.column(self.attribute)[yi][None, :]
+        penalty = self.scale * np.abs(x_values - y_values)
+        if self.cap is not None:
+            penalty = np.minimum(self.cap, penalty)
+        if self.wildcard:
+            penalty = np.where(x_values * y_values == 0, 0.0, penalty)
+        return penalty * self.share(weights)
+
+    def bound(self, group, values, weights):
+        if self.attribute in values:
+            return self.value(attribute_value(group, self.attribute), values[self.attribute], weights)
+        # The cap only limits from above, a negative scale has no lower bound
+        return 0 if self.scale >= 0 else -math.inf
+
+class CallablePenalty(Penalty):
+    '''
+    CallablePenalty: Slow path for arbitrary penalty functions (user_x, user_y, weights) => Numeric
+    Batches call the function once per pair, and no bound is known for it.
+    '''
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, user_x, user_y, weights):
+        return self.function(user_x, user_y, weights)
+
+def as_penalty(penalty):
+    '''Wrap a penalty function, functions with a declarative equivalent get the fast version'''
+    if isinstance(penalty, Penalty):
+        return penalty
+    if penalty is meeting_size_penalty:
+        return SizePenalty("meeting_size", maxsize=4)
+    return CallablePenalty(penalty)
+
+class PenaltyRegistry:
+    '''
+    PenaltyRegistry: Named, ordered collection of penalties, summed per pair or in batch
+    Iterating over the registry gives callable penalties, so it can stand in for a list of functions.
+
+    Instance Attributes:
+    :penalties dict(String=>Penalty): Registered penalties, in registration order
+    '''
+    def __init__(self, penalties=None):
+        '''
+        :param penalties: A dictionary of String=>Penalty (or penalty function) to start with
+        '''
+        self.penalties = {}
+        for name, penalty in (penalties or {}).items():
+            self.register(name, penalty)
+
+    def register(self, name, penalty):
+        '''Add (or replace) a named penalty, plain functions go through the slow path'''
+        self.penalties[name] = as_penalty(penalty)
+        return self.penalties[name]
+
+    def unregister(self, name):
+        del self.penalties[name]
+
+    def __getitem__(self, name):
+        return self.penalties[name]
+
+    def __iter__(self):
+        return iter(self.penalties.values())
+
+    def __len__(self):
+        return len(self.penalties)
+
+    def pair(self, user_x, user_y, weights):
+        '''Sum of every penalty for one pair of UserGroup objects'''
+        total = 0
+        for penalty in self.penalties.values():
+            total += penalty(user_x, user_y, weights)
+        return total
+
+    def batch(self, x, xi, y, yi, weights):
+        '''Sum of every penalty between rows xi of GroupMatrix x and rows yi of GroupMatrix y'''
+        import numpy as np
+        total = np.zeros((len(xi), len(yi)))
+        for penalty in self.penalties.values():
+            total += penalty.batch(x, xi, y, yi, weights)
+        return total
+
+    def bound(self, group, values, weights):
+        '''Lower bound of the summed penalty (see Penalty.bound), None if any penalty can't give one'''
+        total = 0
+        for penalty in self.penalties.values():
+            lowest = penalty.bound(group, values, weights)
+            if lowest is None:
+                return None
+            total += lowest
+        return total
+
+def as_registry(penalities):
+    '''Accept either a PenaltyRegistry or a list of penalty functions'''
+    if isinstance(penalities, PenaltyRegistry):
+        return penalities
+    return PenaltyRegistry({str(i): penalty for i, penalty in enumerate(penalities)})
+
+PENALTIES = PenaltyRegistry({"meeting_size": SizePenalty("meeting_size", maxsize=4)})
 def group_matcher(
     users_waiting: deque, groups_waiting: deque, weights:dict,
     compromise_factor: int, match_threshold: float,
     penalities=PENALTIES):
     # Go down the group wait queue
+    penalities = as_registry(penalities)
 
     retry_queue = deque()
     # Rotation 1: Add new users to existing groups
@@ -31,7 +283,7 @@ def group_matcher(
         while users_waiting[0] is not None:
             # Score: Direct Comparison + Penalties
             compat_score = UserGroup.compare_groupable(groups_waiting[0], users_waiting[0], weights)
-            compat_score *= sum((p(groups_waiting[0], users_waiting[0], weights)) for p in penalities)
+            compat_score *= penalities.pair(groups_waiting[0], users_waiting[0], weights)
             compat_score = max(0, compat_score)
             # Decide whether to merge or not
             if compat_score <= match_threshold:
@@ -57,7 +309,7 @@ def group_matcher(
         while (groups_waiting[0] is not None) and not_matched:
             # Use the original comparison + penalty as a basis
             compat_score = UserGroup.compare_groupable(groups_waiting[0], retry_queue[0], weights)
-            compat_score *= sum((p(groups_waiting[0], retry_queue[0], weights)) for p in penalities)
+            compat_score *= penalities.pair(groups_waiting[0], retry_queue[0], weights)
             compat_score = max(0, compat_score)
             # We use a combination of timeout and compromise factor (CF) to artificially lower thresholds
             # The +2/-1 combo works with compromise factor 2 to resemble a natural log curve 
@@ -82,4 +334,29 @@ def group_matcher(
 
     # users_waiting should be empty (& can be discarded), groups_waiting modified
     # Timeout is not incremented here, read-only
-    return
\ No newline at end of file
+    return
+
+def match_user(
+    user: UserGroup.UserGroup, groups_waiting: deque, weights: dict,
+    match_threshold: float, penalities=PENALTIES):
+    '''
+    Match one new user against the waiting groups as soon as they arrive (incremental matching)
+    Uses the same first-fit comparison as Rotation 1 of group_matcher, but from the user's side.
+    Compromise/timeout relaxation is left to group_matcher, which still runs periodically.
+
+    :param user: The new UserGroup object
+    :param groups_waiting: A deque (or WaitingPool.WaitingPool) of UserGroup objects already waiting, modified in place
+    :return: The UserGroup the user ended up in (the user itself if no group was found)
+    '''
+    penalities = as_registry(penalities)
+    for group in groups_waiting:
+        # Score: Direct Comparison + Penalties
+        compat_score = UserGroup.compare_groupable(group, user, weights)
+        compat_score *= penalities.pair(group, user, weights)
+        compat_score = max(0, compat_score)
+        if compat_score <= match_threshold:
+            group.merge(user)
+            return group
+    # Unmatched users go to the front of the group queue, like in group_matcher
+    groups_waiting.appendleft(user)
+    return user
@@ -1,7 +1,17 @@
 import re
+import os
 import math
 import heapq
+import random
+import hashlib
 import sqlite3
+import threading
+import time
+import queue
+import json
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
 def create_temporary_database(sql_script_path, db_path=":memory:"):
     '''
@@ -21,34 +31,581 @@ def create_temporary_database(sql_script_path, db_path=":memory:"):
     sql_script.close()
     return db_connection
 
+# Indexes added to prebuilt databases, covering the difficulty and tag lookups
+DATABASE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS problems_difficulty ON problems (difficulty)",
+    "CREATE INDEX IF NOT EXISTS taggings_pid ON taggings (pid)",
+    "CREATE INDEX IF NOT EXISTS taggings_tid ON taggings (tid)",
+    "CREATE INDEX IF NOT EXISTS tags_tag_name ON tags (tag_name)",
+)
+MMAP_SIZE = 64 * 1024 * 1024    # Bytes of the prebuilt database read through mmap
+# Full text index over problem titles and tag names (search_problems), prefix indexes speed up partial words
+SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS problem_search USING fts5(pid UNINDEXED, title, tags, prefix='2 3')",
+    "DELETE FROM problem_search",
+    re.sub(r'\s+', ' ', """
+    INSERT INTO problem_search (pid, title, tags)
+    SELECT pid, title, GROUP_CONCAT(tag_name, char(31)) FROM problems
+    LEFT JOIN taggings USING (pid) LEFT JOIN tags USING (tid)
+    GROUP BY pid
+    """).strip(),
+)
+
+def script_checksum(sql_script_path):
+    '''
+    SHA-256 hex digest of the sql script and the build statements, a prebuilt database is rebuilt
+    when either changes
+    '''
+    digest = hashlib.sha256()
+    for statement in DATABASE_INDEXES + SEARCH_INDEX:
+        digest.update(statement.encode())
+    with open(sql_script_path, 'rb') as sql_script:
+        for chunk in iter(lambda: sql_script.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def database_checksum(db_path):
+    '''Checksum of the script a prebuilt database was built from, None if there's no usable database'''
+    if not os.path.exists(db_path):
+        return None
+    try:
+        db_connection = sqlite3.connect("file:{}?mode=ro".format(pathname2url(os.path.abspath(db_path))), uri=True)
+        try:
+            return db_connection.execute("SELECT checksum FROM resource_build").fetchone()[0]
+        finally:
+            db_connection.close()
+    except (sqlite3.Error, TypeError):
+        return None
+
+def build_database(sql_script_path, db_path):
+    '''
+    Compile the sql script into an indexed database file, with the script checksum stored alongside
+    The file is built next to db_path and moved in place once complete, so a failed build
+    never leaves a half-written database behind.
+
+    :param sql_script_path: A filepath string to the sql script for making the database
+    :param db_path: A filepath string to the database file (i.e. /app/db/resource.db)
+    :return: The checksum of the script the database was built from
+    '''
+    checksum = script_checksum(sql_script_path)
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    build_path = db_path + ".build"
+    if os.path.exists(build_path):
+        os.remove(build_path)
+    db_connection = sqlite3.connect(build_path)
+    try:
+        with open(sql_script_path, 'r') as sql_script:
+            db_connection.executescript(sql_script.read())
+        for statement in DATABASE_INDEXES:
+            db_connection.execute(statement)
+        create_search_index(db_connection)
+        db_connection.execute("CREATE TABLE resource_build (checksum TEXT NOT NULL)")
+        db_connection.execute("INSERT INTO resource_build VALUES (?)", (checksum,))
+        db_connection.commit()
+        db_connection.execute("ANALYZE")
+        db_connection.commit()
+    finally:
+        db_connection.close()
+    os.replace(build_path, db_path)
+    return checksum
+
+def create_search_index(db_connection):
+    '''Build the full text index of a writable database (done by build_database), needs SQLite with FTS5'''
+    for statement in SEARCH_INDEX:
+        db_connection.execute(statement)
+    db_connection.commit()
+
+def open_database(sql_script_path, db_path, check_same_thread=True):
+    '''
+    Open the prebuilt resource database read-only, building it first if it's missing or out of date
+    Replaces create_temporary_database for long running services, restarts only pay for a build
+    when the sql script changed. Without the script, an existing database is opened as is.
+
+    :param sql_script_path: A filepath string to the sql script for making the database
+    :param db_path: A filepath string to the database file (i.e. /app/db/resource.db)
+    :param check_same_thread: Passed to sqlite3.connect, False to share the connection between threads
+    :return: Read-only sqlite3 connection object to the database
+    '''
+    prepare_database(sql_script_path, db_path)
+    return connect_read_only(db_path, check_same_thread)
+
+def prepare_database(sql_script_path, db_path):
+    '''Build the database file if it's missing or out of date, see open_database'''
+    if sql_script_path is not None and os.path.exists(sql_script_path):
+        if database_checksum(db_path) != script_checksum(sql_script_path):
+            build_database(sql_script_path, db_path)
+    elif database_checksum(db_path) is None:
+        raise FileNotFoundError("No sql script at {} to build {} from".format(sql_script_path, db_path))
+
+def connect_read_only(db_path, check_same_thread=True, cached_statements=128):
+    '''Open a read-only connection to an existing database file, reads go through mmap'''
+    db_connection = sqlite3.connect("file:{}?mode=ro".format(pathname2url(os.path.abspath(db_path))), uri=True,
+                                    check_same_thread=check_same_thread, cached_statements=cached_statements)
+    db_connection.execute("PRAGMA mmap_size = {}".format(MMAP_SIZE))
+    return db_connection
+
+# Separator for the tag names aggregated by GROUP_CONCAT, a control character that can't appear in a tag
+TAG_SEPARATOR = "\x1f"
+
 def create_problem_set(res):
     '''
-    Fetch rows from a query result and return them as dictionaries w/ the following
+    Read rows from a query result and return them as dictionaries w/ the following
     {
         "link": External link to the problem/resource
         "title": Title of the resource/problem
         "difficulty": Numeric difficulty rating (1 for easy, 2 for medium, 3 for hard)
         "tags": Set of strings, each representing a unique tag associated with the problem
     }
-    Expected row placements from query result: (pid, link, title, difficulty, tid, tag_name)
+    Expected row placements from query result: (pid, link, title, difficulty, tag_names)
+    tag_names holds every tag of the problem joined with TAG_SEPARATOR (GROUP_CONCAT),
+    rows are read straight off the cursor and rows sharing a link are merged.
 
     :return: A list of dictionaries with the above format
     '''
-    sql_listing = res.fetchall()
     output = {}
-    # Condense the entry tags (from the natural join with the tag table)
-    for entry in sql_listing:
-        if entry in output:
-            output[entry[1]]["tags"].add(str(entry[5]))
+    for pid, link, title, difficulty, tag_names in res:
+        tags = set(str(tag_names).split(TAG_SEPARATOR)) if tag_names is not None else set()
+        if str(link) in output:
+            output[str(link)]["tags"].update(tags)
         else:
-            output[entry[1]] = {"link": str(entry[1]), "title": str(entry[2]), "difficulty": entry[3], "tags": set([str(entry[5])])}
+            output[str(link)] = {"link": str(link), "title": str(title), "difficulty": difficulty, "tags": tags}
     return list(output.values())
 
+# Candidate queries, one row per problem with its tags aggregated (see create_problem_set)
+# Difficulty Query: (separator, difficulty, count) => count random problems with the difficulty
+DIFF_QUERY = re.sub(r'\s+', ' ', """
+SELECT pid, link, title, difficulty, GROUP_CONCAT(tag_name, ?) FROM
+    (SELECT * FROM problems WHERE difficulty = ? ORDER BY random() LIMIT ?)
+NATURAL JOIN taggings NATURAL JOIN tags
+GROUP BY pid
+""").strip()
+# Tag Query: (separator, tag name, count) => count random problems with the tag
+TAG_QUERY = re.sub(r'\s+', ' ', """
+SELECT pid, link, title, difficulty, GROUP_CONCAT(tag_name, ?) FROM
+    (SELECT * FROM problems
+    WHERE pid IN
+        (SELECT pid FROM tags NATURAL JOIN taggings
+        WHERE tag_name = ? ORDER BY random() LIMIT ?))
+NATURAL JOIN taggings NATURAL JOIN tags
+GROUP BY pid
+""").strip()
+
+# Search Query: (FTS5 query, count, offset) => matching problems, best match first (title counts double)
+SEARCH_QUERY = re.sub(r'\s+', ' ', """
+SELECT link, problems.title, difficulty, tags FROM problem_search
+JOIN problems USING (pid)
+WHERE problem_search MATCH ?
+ORDER BY bm25(problem_search, 0.0, 2.0, 1.0)
+LIMIT ? OFFSET ?
+""").strip()
+
+def search_query(text):
+    '''
+    Convert user text into an FTS5 query, every word has to match the start of a title word or tag
+    :return: The query string, None if the text has no words
+    '''
+    words = re.findall(r"\w+", text.lower())
+    if len(words) == 0:
+        return None
+    return " ".join('"{}"*'.format(word) for word in words)
+
+def search_problems(db_connection, text, page=0, page_size=5):
+    '''
+    Search problem titles and tag names, with prefix matching and ranked results
+    The database needs the full text index (see create_search_index), prebuilt databases have it.
+
+    :param db_connection: A valid sqlite3 database connection
+    :param text: The words to look for, i.e. "binary tre"
+    :param page: Page of results to return, starting at 0
+    :param page_size: Number of problems per page
+    :return: (problems, more), a list of problem dictionaries (see suggest_resource) and
+        whether there's another page after this one
+    '''
+    query = search_query(text)
+    if query is None:
+        return [], False
+    rows = db_connection.execute(SEARCH_QUERY, (query, page_size + 1, page * page_size)).fetchall()
+    problems = [{"link": link, "title": title, "difficulty": difficulty, "tags": set(tags.split(TAG_SEPARATOR)) if tags else set()}
+                for link, title, difficulty, tags in rows[:page_size]]
+    return problems, len(rows) > page_size
+
+class ProblemIndex:
+    '''
+    ProblemIndex: In-memory copy of the resource database, built once and searched without queries
+    Stands in for the two ORDER BY random() queries in suggest_resource, which scan and sort the
+    whole problem table on every call. rank() scores the problems of every group topic through the
+    inverted tag index in one pass. Only problems with at least one tag are indexed, like the
+    natural join with the taggings table in those queries.
+
+    Instance Attributes:
+    :problems dict(int=>dict): Problem id => problem dictionary (see create_problem_set), tags are complete
+    :by_difficulty dict(int=>list(int)): Difficulty => problem ids with that difficulty
+    :by_tag dict(String=>list(int)): Tag name => problem ids with that tag
+    '''
+    def __init__(self, db_connection):
+        '''
+        :param db_connection: A valid sqlite3 database connection, only read while building the index
+        '''
+        cur = db_connection.cursor()
+        tags = {}
+        self.by_tag = {}
+        for pid, tag_name in cur.execute("SELECT pid, tag_name FROM taggings NATURAL JOIN tags"):
+            tags.setdefault(pid, set()).add(str(tag_name))
+            self.by_tag.setdefault(str(tag_name), []).append(pid)
+        self.problems = {}
+        self.by_difficulty = {}
+        for pid, link, title, difficulty in cur.execute("SELECT pid, link, title, difficulty FROM problems"):
+            if pid in tags:
+                self.problems[pid] = {"link": str(link), "title": str(title), "difficulty": difficulty, "tags": tags[pid]}
+                self.by_difficulty.setdefault(difficulty, []).append(pid)
+
+    def __len__(self):
+        return len(self.problems)
+
+    def sample(self, pids, count):
+        '''Pick up to count problems at random from a list of ids, as copies'''
+        chosen = random.sample(pids, min(count, len(pids)))
+        return [dict(self.problems[pid], tags=set(self.problems[pid]["tags"])) for pid in chosen]
+
+    def sample_difficulty(self, difficulty, count=5):
+        return self.sample(self.by_difficulty.get(difficulty, []), count)
+
+    def sample_tag(self, tag_name, count=5):
+        return self.sample(self.by_tag.get(tag_name, []), count)
+
+    def rank(self, group_attr, count=3, exclude=()):
+        '''
+        Score problems by weighted topic overlap and difficulty distance (see problem_error), best first
+        Candidates are the problems tagged with any of the group topics, merged with random problems of
+        every difficulty. Untagged problems of one difficulty all score the same, so enough of each bucket
+        is sampled for the top count to be exact. Equal scores are ordered at random.
+        :param exclude: A set of problem links to leave out (i.e. SeenHistory.seen_by_all)
+        :return: Up to count problem dictionaries, as copies
+        '''
+        overlap = {}        # Problem id => summed weight of the group topics it is tagged with
+        for topic, weight in group_attr["topics"].items():
+            for pid in self.by_tag.get(topic, ()):
+                overlap[pid] = overlap.get(pid, 0) + weight
+        for pid in self.by_tag.get("any", ()):
+            overlap.setdefault(pid, 0) # Scored by problem_error with the "any" weight
+        tagged = Counter(self.problems[pid]["difficulty"] for pid in overlap)
+        for difficulty, bucket in self.by_difficulty.items():
+            needed = count + len(exclude) + tagged[difficulty] # Enough untagged problems, whatever was drawn
+            for pid in random.sample(bucket, min(len(bucket), needed)):
+                overlap.setdefault(pid, 0)
+        if exclude:
+            overlap = {pid: weight for pid, weight in overlap.items() if self.problems[pid]["link"] not in exclude}
+        scored = ((problem_error(group_attr, self.problems[pid], weight), random.random(), pid) for pid, weight in overlap.items())
+        return [dict(self.problems[pid], tags=set(self.problems[pid]["tags"])) for _, _, pid in heapq.nsmallest(count, scored)]
+
+def query_values(group_attr):
+    '''
+    Convert group attributes into the values used to look up problems
+    :return: (difficulty, topic), difficulty is an integer between 1 and 3, topic is the
+        heaviest topic (first one on a tie), None for groups without topics
+    '''
+    topics = group_attr["topics"]
+    query_difficulty = math.ceil(group_attr["difficulty"] - 0.5) # Round half-down to integer
+    query_difficulty = max(1, min(3, query_difficulty)) # Ensure integer is between difficulty interval
+    query_topic = max(topics, key=topics.get) if len(topics) > 0 else None
+    return query_difficulty, query_topic
+
+def problem_error(group_attr, prob, overlap=None):
+    '''
+    Error of a problem for a group, lower is better
+    Uses difficulty as a base, and the weighted topic overlap as a coefficient to scale down:
+    (|group difficulty - problem difficulty| + 1) * (1 - overlap / (total topic weight + any weight))
+    The "any" weight is the mean topic weight (1 for groups without topics). A problem tagged "any" gets it
+    toward the overlap of topics it misses, but the overlap never goes past the total topic weight, so the
+    coefficient never reaches 0 and the difficulty distance always counts.
+    :param overlap: Summed weight of the group topics the problem is tagged with, computed if None
+    '''
+    topics = group_attr["topics"]
+    if overlap is None:
+        overlap = sum(weight for topic, weight in topics.items() if topic in prob["tags"])
+    topic_total = sum(topics.values())
+    any_weight = topic_total / len(topics) if len(topics) > 0 else 1
+    if "any" in prob["tags"] and "any" not in topics:
+        overlap += any_weight
+    total = topic_total + any_weight
+    cur_error = abs(group_attr["difficulty"] - prob["difficulty"]) + 1
+    return cur_error * (1 - (min(overlap, topic_total) / total)) if total > 0 else cur_error
+
+def rank_problems(group_attr, candidates, PROBLEMS=3):
+    '''
+    Rank candidate problems against the group attributes, best first
+    :param candidates: A list of problem dictionaries, duplicates (by link) are skipped
+    :return: The best PROBLEMS problem dictionaries
+    '''
+    problem_list = []       # Min-heap for ranking the problem choices
+    name_set = set()        # Ensure that there aren't problem duplicates across 2 queries
+    value_set = set()       # Ensure that there aren't value duplicates for proper heapq implementation
+    DELTA = 0.0005          # Used to solve value duplicate issues
+    for prob in candidates:
+        if prob["link"] not in name_set:
+            cur_error = problem_error(group_attr, prob)
+            # Prevent duplicate errors with heapq
+            while cur_error in value_set:
+                cur_error += DELTA
+            value_set.add(cur_error)
+            name_set.add(prob["link"])
+            heapq.heappush(problem_list, (cur_error, prob))
+    # Remove the ranking number, the output is just the problem data
+    return [x[1] for x in heapq.nsmallest(PROBLEMS, problem_list)]
+
+class RecommendationCache:
+    '''
+    RecommendationCache: Bounded LRU cache of candidate pools, keyed by a quantized group profile
+    Groups with the same rounded difficulty and nearly the same topic weights share one pool of
+    candidate problems. The pool is larger than a single fetch, and each group still draws its own
+    random candidates from it, so suggestions stay varied. Entries expire after ttl seconds.
+
+    Instance Attributes:
+    :entries OrderedDict(tuple=>(float, list)): Profile key => (time added, candidate pool), least recently used first
+    :maxsize int: Most profiles kept, the least recently used is dropped past this
+    :ttl float: Seconds before a pool is fetched again
+    :pool_size int: Number of problems fetched per query when filling a pool
+    :quantum float: Step topic weights are rounded to, i.e. 0.5 treats 0.3 and 0.6 as the same weight and drops 0.2
+    :hits int: Lookups answered from the cache
+    :misses int: Lookups that had to fetch (including expired entries)
+    '''
+    def __init__(self, maxsize=256, ttl=300, pool_size=15, quantum=0.5, clock=time.monotonic):
+        self.entries = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self.quantum = quantum
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, group_attr):
+        '''Rounded difficulty plus the quantized topic vector, topics that round to 0 are left out'''
+        query_difficulty, query_topic = query_values(group_attr)
+        topics = []
+        for topic, weight in sorted(group_attr["topics"].items()):
+            level = round(weight / self.quantum)
+            if level > 0:
+                topics.append((topic, level))
+        return (query_difficulty, query_topic, tuple(topics))
+
+    def pool(self, group_attr, fetch):
+        '''
+        Return the candidate pool for a group profile, calling fetch() to fill it on a miss
+        :param fetch: A function with no arguments that returns a list of problem dictionaries
+        '''
+        key = self.key(group_attr)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.clock() - entry[0] < self.ttl:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.misses += 1
+        candidates = fetch()
+        with self.lock:
+            self.entries[key] = (self.clock(), candidates)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return candidates
+
+    def __getstate__(self):
+        # Copies (i.e. in a process pool) start empty with their own lock
+        state = self.__dict__.copy()
+        state["entries"] = OrderedDict()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        '''Drop every pool, i.e. after the database changed'''
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''Hit/miss counters and the hit rate'''
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries),
+                "hit_rate": self.hits / lookups if lookups > 0 else 0}
+
+class RecommendationTable:
+    '''
+    RecommendationTable: Ranked candidate lists precomputed for every rounded difficulty x primary topic
+    Groups only come in a few shapes (see UserGroup.DIFFICULTIES and TOPIC_LIST), so the best k problems
+    of every (difficulty, topic) pair are ranked once from a ProblemIndex. Serving a group is a lookup
+    of its query_values, plus a random draw from that list re-ranked against the full topic dictionary.
+    Built again (rebuild) whenever the database checksum changes, see ResourceService.refresh.
+
+    Instance Attributes:
+    :rows dict((int, String)=>list): (difficulty, topic) => best k problem dictionaries, topic None for no topics
+    :k int: Most problems in every list, lists are shorter when the database has fewer problems
+    :draw int: Problems drawn from a list before re-ranking, keeps suggestions varied
+    :checksum String: Checksum of the database the table was built from (see database_checksum)
+    '''
+    def __init__(self, index, k=30, draw=10, checksum=None):
+        '''
+        :param index: A ProblemIndex of the database, every tag in it gets a row per difficulty
+        '''
+        self.k = k
+        self.draw = draw
+        self.rebuild(index, checksum)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def rebuild(self, index, checksum=None):
+        rows = {}
+        for difficulty in (1, 2, 3):
+            rows[(difficulty, None)] = index.rank({"difficulty": difficulty, "topics": {}}, self.k)
+            for topic in index.by_tag:
+                rows[(difficulty, topic)] = index.rank({"difficulty": difficulty, "topics": {topic: 1}}, self.k)
+        self.rows = rows
+        self.checksum = checksum
+
+    def lookup(self, group_attr):
+        '''Candidate list of a group, topics missing from the database fall back to the difficulty row'''
+        query_difficulty, query_topic = query_values(group_attr)
+        row = self.rows.get((query_difficulty, query_topic))
+        return row if row is not None else self.rows[(query_difficulty, None)]
+
+class SeenHistory:
+    '''
+    SeenHistory: Problems already suggested to each user, as one bitmap per user
+    Every problem link gets a bit position the first time it's recorded, a user's bitmap is a Python
+    int with the bits of the problems they were sent. Users are kept in LRU order and the least recently
+    active are dropped past max_users, so memory stays around max_users * problems / 8 bytes.
+    The history is saved to a JSON file (i.e. on the database volume) to survive restarts.
+
+    Instance Attributes:
+    :path String: Filepath the history is saved to and loaded from, None to keep it in memory only
+    :max_users int: Most users remembered
+    :users OrderedDict(String=>int): Slack id => bitmap of seen problems, least recently active first
+    :slots dict(String=>int): Problem link => bit position
+    :links list(String): Problem link of every bit position
+    '''
+    def __init__(self, path=None, max_users=10000):
+        self.path = path
+        self.max_users = max_users
+        self.users = OrderedDict()
+        self.slots = {}
+        self.links = []
+        self.lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self.users)
+
+    def seen_by_all(self, members):
+        '''
+        Links of the problems every member was already sent, empty if any member is new
+        :param members: A list of slack ids
+        '''
+        if not members:
+            return set()
+        with self.lock:
+            common = -1     # All bits set
+            for slack_id in members:
+                common &= self.users.get(slack_id, 0)
+                if common == 0:
+                    return set()
+        seen = set()
+        while common:
+            low = common & -common
+            seen.add(self.links[low.bit_length() - 1])
+            common ^= low
+        return seen
+
+    def record(self, members, problems):
+        '''Mark problems (dictionaries with a link) as sent to every member'''
+        with self.lock:
+            bits = 0
+            for prob in problems:
+                slot = self.slots.get(prob["link"])
+                if slot is None:
+                    slot = self.slots[prob["link"]] = len(self.links)
+                    self.links.append(prob["link"])
+                bits |= 1 << slot
+            for slack_id in members:
+                self.users[slack_id] = self.users.get(slack_id, 0) | bits
+                self.users.move_to_end(slack_id)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def save(self):
+        '''Write the history to path, through a temporary file so a crash never leaves half a file'''
+        with self.lock:
+            state = {"links": list(self.links), "users": {slack_id: format(bits, "x") for slack_id, bits in self.users.items()}}
+        with open(self.path + ".tmp", "w") as history_file:
+            json.dump(state, history_file)
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self):
+        '''Read the history back from path, a missing or unreadable file starts an empty history'''
+        try:
+            with open(self.path) as history_file:
+                state = json.load(history_file)
+            links = state["links"]
+            users = OrderedDict((slack_id, int(bits, 16)) for slack_id, bits in state["users"].items())
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        with self.lock:
+            self.links = links
+            self.slots = {link: slot for slot, link in enumerate(links)}
+            self.users = users
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+def unseen(candidates, seen, count):
+    '''Candidates without the seen links, unless that leaves fewer than count'''
+    if not seen:
+        return candidates
+    fresh = [prob for prob in candidates if prob["link"] not in seen]
+    return fresh if len(fresh) >= count else candidates
+
+def fetch_candidates(db_connection, query_difficulty, query_topic, index=None, count=5):
+    '''
+    Fetch the candidate problems for a difficulty and topic: count random problems with the difficulty,
+    and count random problems with the topic (skipped if topic is None)
+    :param index: A ProblemIndex built from the same database, samples in memory instead of querying
+    :return: A list of problem dictionaries (see create_problem_set), may hold duplicates
+    '''
+    if index is not None:
+        diff_list = index.sample_difficulty(query_difficulty, count)
+        if query_topic is not None:
+            diff_list.extend(index.sample_tag(query_topic, count))
+        return diff_list
+
+    # DB Connection
+    cur = db_connection.cursor()
+    diff_list = create_problem_set(cur.execute(DIFF_QUERY, (TAG_SEPARATOR, query_difficulty, count)))
+    if query_topic is not None:
+        diff_list.extend(create_problem_set(cur.execute(TAG_QUERY, (TAG_SEPARATOR, query_topic, count))))
+    return diff_list
+
 # Relevant Attribute Keys = ["topics", "difficulty"]
-def suggest_resource(db_connection, group_attr, PROBLEMS=3):
+def suggest_resource(db_connection, group_attr, PROBLEMS=3, index=None, cache=None, history=None, table=None):
     '''
     Provide problem suggestions with the given sqlite3 database and group preferences
-    Algorithm runs two queries, difficulty-based and tag-based, choose best of PROBLEMS
+    Algorithm runs two queries, difficulty-based and tag-based (heaviest topic), choose best of PROBLEMS
+    With an index, every topic of the group is scored in one pass instead (ProblemIndex.rank)
 
     :param db_connection: A valid sqlite3 database connection
     :param group_attr: A dictionary with the group attributes for recommendation
@@ -57,6 +614,10 @@ def suggest_resource(db_connection, group_attr, PROBLEMS=3):
             "topics": A dicionary of String=>Numeric values that correlate to topic weight
         }
     :param PROBLEMS: The number of problems to fetch, max 10
+    :param index: A ProblemIndex built from the same database, ranks in memory instead of querying
+    :param cache: A RecommendationCache, candidates are drawn from its pools instead of fetched each time
+    :param history: A SeenHistory, problems every member (group_attr["members"]) was sent are left out
+    :param table: A RecommendationTable, candidates are looked up instead of fetched (ahead of cache and index)
     :return: A list of diciontaries containing problem attributes
         {
             "link": External link to the problem/resource
@@ -65,57 +626,181 @@ def suggest_resource(db_connection, group_attr, PROBLEMS=3):
             "tags": Set of strings, each representing a unique tag associated with the problem
         }
     '''
-    # DB Connection
-    cur = db_connection.cursor()
+    return suggest_resources(db_connection, [group_attr], PROBLEMS, index, cache, history, table)[0]
 
-    # Convert group into values for queries + create the topic set
-    query_difficulty = math.ceil(group_attr["difficulty"] - 0.5) # Round half-down to integer
-    query_difficulty = max(1, min(3, query_difficulty)) # Ensure integer is between difficulty interval
-    query_topic = max(group_attr["topics"]) if len(group_attr["topics"]) > 0 else None
-    group_topics = set(group_attr["topics"].keys())
-    group_topics.add("any") # Make sure that we won't have 0 denominator
-
-    # Difficulty Query: Get list of 5 possible problems
-    diff_query = """
-    SELECT * FROM
-        (SELECT * FROM
-            (SELECT * FROM problems WHERE difficulty = ?)
-        ORDER BY random() LIMIT 5)
-    NATURAL JOIN taggings NATURAL JOIN tags;
-    """
-    diff_query = re.sub(r'\s+', ' ', diff_query).strip()
-    diff_list = create_problem_set(cur.execute(diff_query, (query_difficulty,)))
-
-    # Tag Query: Get a list of 5 possible problems
-    tag_query = """
-    SELECT * FROM
-        (SELECT * FROM problems
-        WHERE pid IN
-            (SELECT pid FROM
-                (SELECT * FROM tags NATURAL JOIN taggings)
-            WHERE tag_name = ? ORDER BY random() LIMIT 5))
-    NATURAL JOIN taggings NATURAL JOIN tags
-    """
-    tag_query = re.sub(r'\s+', ' ', tag_query).strip()
-    if query_topic is not None:
-        tag_list = create_problem_set(cur.execute(tag_query, (query_topic,)))
-        diff_list.extend(tag_list)
+def suggest_resources(db_connection, group_attrs, PROBLEMS=3, index=None, cache=None, history=None, table=None):
+    '''
+    Provide problem suggestions for several groups at once (i.e. the whole exit queue)
+    Groups with the same rounded difficulty and top topic share one set of candidate problems,
+    so the queries run once per distinct pair, then every group is ranked against its candidates.
+    With an index (and no cache), each group is ranked directly with ProblemIndex.rank.
+    With a table, candidates come from its precomputed lists, the database isn't touched at all.
+    With a history, problems already sent to every member are skipped (while enough others are left),
+    and the suggestions are recorded for the members.
 
-    # Rank the problems, comparing to the group attributes
-    problem_list = []       # Min-heap for ranking the problem choices
-    name_set = set()        # Ensure that there aren't problem duplicates across 2 queries
-    value_set = set()       # Ensure that there aren't value duplicates for proper heapq implementation
-    DELTA = 0.0005          # Used to solve value duplicate issues
-    for prob in diff_list:
-        if prob["link"] not in name_set:
-            # Error uses difficulty as a base, and the topic difference as a coefficient to scale down
-            cur_error = abs(group_attr["difficulty"] - prob["difficulty"]) + 1
-            cur_error *= 1 - (len(group_topics.intersection(prob["tags"])) / len(group_topics))
-            # Prevent duplicate errors with heapq
-            while cur_error in value_set:
-                cur_error += DELTA
-            value_set.add(cur_error)
-            name_set.add(prob["link"])
-            heapq.heappush(problem_list, (cur_error, prob))
-    # Remove the ranking number, the output is just the problem data
-    return [x[1] for x in heapq.nsmallest(PROBLEMS, problem_list)]
\ No newline at end of file
+    :param db_connection: A valid sqlite3 database connection
+    :param group_attrs: A list of group attribute dictionaries, see suggest_resource
+    :param PROBLEMS: The number of problems to fetch per group, max 10
+    :param index: A ProblemIndex built from the same database, ranks in memory instead of querying
+    :param cache: A RecommendationCache, candidates are drawn from its pools instead of fetched each time
+    :param history: A SeenHistory, group attributes list the slack ids of the group under "members"
+    :param table: A RecommendationTable, candidates are looked up instead of fetched (ahead of cache and index)
+    :return: A list with one list of problem dictionaries per group, in the same order
+    '''
+    candidates = {}     # (difficulty, topic) => candidate problems shared by those groups
+    suggestions = []
+    for group_attr in group_attrs:
+        suggestions.append(suggest_group(db_connection, group_attr, PROBLEMS, index, cache, history, table, candidates))
+    return suggestions
+
+def suggest_group(db_connection, group_attr, PROBLEMS, index, cache, history, table, candidates):
+    '''Suggestions for one group of suggest_resources, candidates is shared by the groups of one call'''
+    # Convert group into values for queries + the problems every member has seen
+    query_difficulty, query_topic = query_values(group_attr)
+    members = group_attr.get("members", ())
+    seen = history.seen_by_all(members) if history is not None else set()
+    if table is not None:
+        # Precomputed list of the (difficulty, topic) pair, a random draw of it is re-ranked for the group
+        row = unseen(table.lookup(group_attr), seen, PROBLEMS)
+        problems = rank_problems(group_attr, random.sample(row, min(len(row), table.draw)), PROBLEMS)
+    elif cache is not None:
+        # Every group draws its own random candidates from the cached pool (the best scored ones with an index)
+        if index is not None:
+            fetch = lambda: index.rank(group_attr, 2 * cache.pool_size)
+        else:
+            fetch = lambda: fetch_candidates(db_connection, query_difficulty, query_topic, None, cache.pool_size)
+        pool = unseen(cache.pool(group_attr, fetch), seen, PROBLEMS)
+        sample = random.sample(pool, min(len(pool), 5 if query_topic is None else 10))
+        problems = rank_problems(group_attr, sample, PROBLEMS)
+    elif index is not None:
+        problems = index.rank(group_attr, PROBLEMS, exclude=seen)
+        if len(problems) < PROBLEMS:
+            problems = index.rank(group_attr, PROBLEMS)
+    else:
+        if (query_difficulty, query_topic) not in candidates:
+            candidates[(query_difficulty, query_topic)] = fetch_candidates(db_connection, query_difficulty, query_topic)
+        # Rank the problems, comparing to the group attributes
+        problems = rank_problems(group_attr, unseen(candidates[(query_difficulty, query_topic)], seen, PROBLEMS), PROBLEMS)
+    if history is not None:
+        history.record(members, problems)
+    return problems
+
+class ResourceService:
+    '''
+    ResourceService: Thread-safe access to the prebuilt resource database through a pool of read-only connections
+    Connections are opened lazily (up to size) with check_same_thread off, and handed to one thread at a
+    time, each keeps its own prepared statement cache. Threads wait for a free connection once all are
+    in use. The service can be pickled for a process pool, every process opens its own connections.
+
+    Instance Attributes:
+    :db_path String: Filepath to the prebuilt database file
+    :size int: Most connections open at once
+    :cached_statements int: Prepared statements cached per connection
+    :index ProblemIndex: Optional in-memory index, passed on to suggest_resources
+    :cache RecommendationCache: Optional candidate cache, passed on to suggest_resources
+    :history SeenHistory: Optional record of the problems each user was sent, passed on to suggest_resources
+    :table RecommendationTable: Optional precomputed candidate lists, passed on to suggest_resources (see refresh)
+    '''
+    def __init__(self, db_path, sql_script_path=None, size=4, cached_statements=128, index=None, cache=None, history=None,
+                 table=None):
+        '''
+        :param db_path: A filepath string to the database file (i.e. /app/db/resource.db)
+        :param sql_script_path: Build (or rebuild) the database from this script first, see open_database
+        '''
+        prepare_database(sql_script_path, db_path)
+        self.db_path = db_path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.index = index
+        self.cache = cache
+        self.history = history
+        self.table = table
+        self.start_pool()
+
+    def start_pool(self):
+        self.idle = queue.LifoQueue()   # Most recently used first, keeps statement caches warm
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections and locks stay behind, the copy opens its own
+        state = self.__dict__.copy()
+        for name in ("idle", "opened", "lock"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.start_pool()
+
+    def acquire(self):
+        '''Take a connection from the pool, opening a new one while under size'''
+        try:
+            return self.idle.get(block=False)
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                try:
+                    return connect_read_only(self.db_path, check_same_thread=False, cached_statements=self.cached_statements)
+                except Exception:
+                    self.opened -= 1
+                    raise
+        return self.idle.get()
+
+    def release(self, db_connection):
+        self.idle.put(db_connection)
+
+    @contextmanager
+    def connection(self):
+        '''Borrow a read-only connection for the duration of a with block'''
+        db_connection = self.acquire()
+        try:
+            yield db_connection
+        finally:
+            self.release(db_connection)
+
+    def suggest_resource(self, group_attr, PROBLEMS=3):
+        '''suggest_resource on a pooled connection, safe to call from any thread'''
+        return self.suggest_resources([group_attr], PROBLEMS)[0]
+
+    def suggest_resources(self, group_attrs, PROBLEMS=3):
+        '''suggest_resources on a pooled connection, safe to call from any thread'''
+        with self.connection() as db_connection:
+            return suggest_resources(db_connection, group_attrs, PROBLEMS, self.index, self.cache, self.history, self.table)
+
+    def search_problems(self, text, page=0, page_size=5):
+        '''search_problems on a pooled connection, safe to call from any thread'''
+        with self.connection() as db_connection:
+            return search_problems(db_connection, text, page, page_size)
+
+    def refresh(self):
+        '''
+        Build the index and the recommendation table, again whenever the database checksum changed
+        (i.e. the database file was rebuilt from a new script). The pooled connections are reopened on
+        the new file, and cached candidate pools from the old one are dropped. Call from the thread that
+        owns the service, like close.
+        :return: True if the index and table were (re)built
+        '''
+        checksum = database_checksum(self.db_path)
+        if self.table is not None and self.table.checksum == checksum:
+            return False
+        self.close()
+        self.start_pool()
+        if self.cache is not None:
+            self.cache.clear()
+        with self.connection() as db_connection:
+            self.index = ProblemIndex(db_connection)
+        self.table = RecommendationTable(self.index, checksum=checksum)
+        return True
+
+    def close(self):
+        '''Close the pooled connections, call once no thread is using the service'''
+        with self.lock:
+            while True:
+                try:
+                    self.idle.get(block=False).close()
+                except queue.Empty:
+                    break
+                self.opened -= 1
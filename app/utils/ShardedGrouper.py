@@ -0,0 +1,142 @@
+from collections import deque
+import multiprocessing
+from utils import QueueGrouper, MatrixGrouper, GlobalGrouper
+import numpy as np
+import math
+
+# Below this many users + groups the shards are matched in this process, a pool round trip costs more
+INLINE_BELOW = 400
+# Workers are started fresh instead of forked, forking the threaded grouping queue could copy held locks
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def shard_of(group, key):
+    '''
+    Shard a UserGroup belongs to, None for the wildcard shard
+    Wildcards (0) aren't sharded, averaged values (i.e. 2.5 after merging sizes 2 and 3) are rounded
+    half up to the nearest key, so merged groups keep being matched within a shard
+    '''
+    value = getattr(group, key)
+    if value == 0:
+        return None
+    return max(1, math.floor(value + 0.5))
+
+def wants_members(group):
+    '''Groups that are still under their preferred size get another look in the cross-shard pass'''
+    return len(group.ids) <= 1 or len(group.ids) < group.meeting_size
+
+def match_shard(matcher, users, groups, weights, compromise_factor, match_threshold, penalities):
+    '''Run a matcher over one shard, runs in a pool worker so it only deals in picklable lists'''
+    users_waiting, groups_waiting = deque(users), deque(groups)
+    matcher(users_waiting, groups_waiting, weights, compromise_factor=compromise_factor,
+            match_threshold=match_threshold, penalities=penalities)
+    return list(groups_waiting)
+
+def cross_match(wildcards, leftovers, weights, compromise_factor, match_threshold, penalities):
+    '''
+    Merge each wildcard group into the first leftover it fits with, scored with MatrixGrouper
+    Single users get the same compromise coefficient as the retry rotation.
+    :return: The wildcard groups that didn't fit anywhere, in order
+    '''
+    packed = MatrixGrouper.GroupMatrix(leftovers)
+    rows = np.arange(len(packed))
+    unmatched = []
+    for group in wildcards:
+        hit = None
+        if len(packed) > 0:
+            scores = MatrixGrouper.score(packed, rows, MatrixGrouper.GroupMatrix([group]), [0], weights, penalities)[:, 0]
+            hit = MatrixGrouper.first_match(scores * GlobalGrouper.compromise(group, compromise_factor), match_threshold)
+        if hit is not None:
+            packed.groups[hit].merge(group)
+            packed.update(hit)
+        else:
+            unmatched.append(group)
+    return unmatched
+
+class ShardedMatcher:
+    '''
+    ShardedMatcher: Splits the waiting pool by an attribute and matches each shard in its own process
+    Callable like QueueGrouper.group_matcher. Users and groups are partitioned by the shard key
+    (i.e. meeting_size), every shard runs the wrapped matcher independently on a multiprocessing
+    Pool. Wildcard users form their own shard, then a cross-shard pass tries them against the shard
+    groups that still want members.
+
+    Shards never see each other, so a user can't be merged with a better fit in another shard
+    until the cross-shard pass, decisions differ from the single process matchers.
+    UserGroup objects come back from the workers as copies, groups_waiting holds the new objects.
+    Penalties have to be picklable (module level functions or declarative QueueGrouper penalties).
+    The pool is only started by the first call that needs it, with the START_METHOD context, and has
+    to be stopped with close() (or by using the matcher in a with statement).
+
+    Instance Attributes:
+    :key String: UserGroup attribute the pool is partitioned by
+    :processes int: Number of worker processes, None for one per core
+    :matcher function: The group_matcher each shard runs
+    :inline_below int: Total size under which shards are matched without the pool
+    :start_method String: multiprocessing start method of the workers, see START_METHOD
+    :pool Pool: The worker pool, started on first use
+    '''
+    def __init__(self, key="meeting_size", processes=None, matcher=MatrixGrouper.group_matcher, inline_below=INLINE_BELOW,
+                 start_method=START_METHOD):
+        self.key = key
+        self.processes = processes
+        self.matcher = matcher
+        self.inline_below = inline_below
+        self.start_method = start_method
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __call__(
+        self, users_waiting: deque, groups_waiting: deque, weights: dict,
+        compromise_factor: int, match_threshold: float,
+        penalities=QueueGrouper.PENALTIES):
+        '''
+        :param users_waiting: A deque of new UserGroup objects, emptied by the matcher
+        :param groups_waiting: A deque of UserGroup objects already waiting, replaced in place
+        :param weights: A dictionary that weighs the attributes (see UserGroup.compare_groupable)
+        :param compromise_factor: Controls how fast the match threshold relaxes with timeout
+        :param match_threshold: The highest score that still results in a merge
+        :param penalities: A QueueGrouper.PenaltyRegistry or a list of penalty functions
+        '''
+        # Partition, queue order is kept within every shard. Shard None holds the wildcards
+        shards = {}
+        for group in groups_waiting:
+            shards.setdefault(shard_of(group, self.key), ([], []))[1].append(group)
+        for user in users_waiting:
+            shards.setdefault(shard_of(user, self.key), ([], []))[0].append(user)
+        users_waiting.clear()
+        groups_waiting.clear()
+
+        # Match every shard independently, the wildcard shard included
+        order = sorted(shards, key=lambda shard: -1 if shard is None else shard)
+        jobs = [(self.matcher, shards[shard][0], shards[shard][1], weights, compromise_factor, match_threshold, penalities)
+                for shard in order]
+        total = sum(len(users) + len(groups) for users, groups in shards.values())
+        if total < self.inline_below or len(jobs) <= 1:
+            results = dict(zip(order, (match_shard(*job) for job in jobs)))
+        else:
+            if self.pool is None:
+                self.pool = multiprocessing.get_context(self.start_method).Pool(self.processes)
+            results = dict(zip(order, self.pool.starmap(match_shard, jobs)))
+
+        # Cross-shard pass: Wildcard groups try the shard groups that still want members
+        wildcards = results.pop(None, [])
+        leftovers = [group for shard in results.values() for group in shard if wants_members(group)]
+        unmatched = cross_match(wildcards, leftovers, weights, compromise_factor, match_threshold, penalities)
+        groups_waiting.extend(unmatched)
+        for shard in results.values():
+            groups_waiting.extend(shard)
+        # users_waiting is empty, groups_waiting modified
+        # Timeout is not incremented here, read-only
+        return
+
+    def close(self):
+        '''Stop the worker pool, it is started again if the matcher is called afterwards'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,187 @@
+import random
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from slack_sdk.errors import SlackApiError
+
+# (requests per second, burst) allowed per Web API method, after Slack's rate limit tiers
+# conversations.open is Tier 3 (50+ per minute), chat.postMessage is special (about 1 per second per channel,
+# see PER_CHANNEL). Unlisted methods get Tier 2 (20+ per minute)
+METHOD_LIMITS = {
+    "conversations_open": (50 / 60, 10),
+    "chat_postMessage": (1.0, 3),
+}
+DEFAULT_LIMIT = (20 / 60, 5)
+PER_CHANNEL = {"chat_postMessage"}      # Methods limited per channel, every channel gets its own limiter
+NON_IDEMPOTENT = {"chat_postMessage"}   # Methods not sent again after a timeout, the first call may have gone through
+CHANNEL_LIMITERS = 1000         # Most per-channel limiters kept, the least recently used are dropped
+LATENCY_SAMPLES = 1000          # Most recent message latencies kept for stats()
+
+class RateLimiter:
+    '''
+    RateLimiter: Token bucket shared by every thread calling one method
+    acquire() waits for a token, pause() holds every caller back (i.e. for a Retry-After header).
+
+    Instance Attributes:
+    :rate float: Tokens added per second
+    :burst int: Most tokens saved up
+    :tokens float: Tokens available now
+    :paused_until float: Clock time before which nobody gets a token
+    '''
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated = clock()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+def never_sent(error):
+    '''Whether a connection error happened before the request reached Slack (i.e. connection refused)'''
+    return isinstance(getattr(error, "reason", error), ConnectionRefusedError)
+
+def retry_after(error, default=1):
+    '''Seconds from the Retry-After header of a rate limited response'''
+    headers = getattr(error.response, "headers", None) or {}
+    for name, value in headers.items():
+        if name.lower() == "retry-after":
+            value = value[0] if isinstance(value, list) else value
+            try:
+                return max(0, int(value))
+            except (TypeError, ValueError):
+                return default
+    return default
+
+class SlackDispatcher:
+    '''
+    SlackDispatcher: Sends group messages from a bounded pool of worker threads, off the cron thread
+    Every Web API call waits for its method's rate limiter. A 429 response pauses that method for the
+    Retry-After time and the call is sent again, server and connection errors are retried with
+    exponential backoff (with jitter). Errors that retrying won't fix (i.e. channel_not_found) fail at once,
+    and so do timeouts of NON_IDEMPOTENT methods, so a group never gets the same message twice.
+    Methods in PER_CHANNEL (chat.postMessage) get one limiter per channel instead of one in total.
+
+    Instance Attributes:
+    :client WebClient: Slack Web API client (slack_sdk), its base_url can point at a stub server for tests
+    :workers int: Most calls in flight at once
+    :limits dict(String=>(float, int)): Method name => (rate, burst), see METHOD_LIMITS
+    :max_retries int: Retries of one call before it fails
+    :backoff float: Seconds before the first retry, doubled every retry
+    :limiters dict(String=>RateLimiter): Method name (or (method, channel) in PER_CHANNEL) => its limiter,
+        created on first use, CHANNEL_LIMITERS per-channel limiters at most
+    :latencies deque(float): Seconds from send_group to delivery of the most recent messages
+    :sent int: Messages delivered
+    :failed int: Messages given up on
+    '''
+    def __init__(self, client, workers=4, limits=METHOD_LIMITS, max_retries=3, backoff=1.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.client = client
+        self.workers = workers
+        self.limits = limits
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.limiters = OrderedDict()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="slack-dispatch")
+
+    def limiter(self, method, channel=None):
+        key = (method, channel) if method in PER_CHANNEL else method
+        with self.lock:
+            if key not in self.limiters:
+                rate, burst = self.limits.get(method, DEFAULT_LIMIT)
+                self.limiters[key] = RateLimiter(rate, burst, self.clock, self.sleep)
+                if method in PER_CHANNEL and len(self.limiters) > CHANNEL_LIMITERS:
+                    # Channels are only posted to once per group, the oldest limiters are idle
+                    oldest = next(name for name in self.limiters if isinstance(name, tuple))
+                    del self.limiters[oldest]
+            self.limiters.move_to_end(key)
+            return self.limiters[key]
+
+    def call(self, method, **kwargs):
+        '''
+        Call a WebClient method (i.e. "chat_postMessage") within its rate limit, retrying what can be retried
+        :return: The SlackResponse
+        '''
+        limiter = self.limiter(method, kwargs.get("channel"))
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            try:
+                return getattr(self.client, method)(**kwargs)
+            except SlackApiError as e:
+                status = getattr(e.response, "status_code", 200)
+                if attempt == self.max_retries or (status != 429 and status < 500):
+                    raise
+                if status == 429:
+                    limiter.pause(retry_after(e))
+                else:
+                    self.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            except OSError as e:
+                # Connection errors (urllib.error.URLError, timeouts) are retried like server errors,
+                # unless the request may have gone through and sending it again would repeat it
+                if attempt == self.max_retries or (method in NON_IDEMPOTENT and not never_sent(e)):
+                    raise
+                self.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def deliver(self, users, blocks, text, submitted):
+        try:
+            result = self.call("conversations_open", users=",".join(users))
+            self.call("chat_postMessage", channel=result["channel"]["id"], blocks=blocks, text=text)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        latency = self.clock() - submitted
+        with self.lock:
+            self.sent += 1
+            self.latencies.append(latency)
+        return latency
+
+    def send_group(self, users, blocks, text):
+        '''
+        Open a conversation with the users and post the blocks there, without waiting
+        :param users: A list of slack ids
+        :param blocks: Slack message blocks (a list, or a JSON string of it)
+        :param text: Notification text of the message
+        :return: A concurrent.futures.Future with the latency in seconds, or the error if the message failed
+        '''
+        return self.executor.submit(self.deliver, users, blocks, text, self.clock())
+
+    def stats(self):
+        '''Delivery counts and latency percentiles (seconds) of the most recent messages'''
+        with self.lock:
+            ordered = sorted(self.latencies)
+            stats = {"sent": self.sent, "failed": self.failed}
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+        stats.update({"latency_p50": pick(0.5), "latency_p99": pick(0.99), "latency_max": ordered[-1] if ordered else None})
+        return stats
+
+    def close(self, wait=True):
+        '''Stop the worker threads, waiting for the messages already sent to finish by default'''
+        self.executor.shutdown(wait=wait)
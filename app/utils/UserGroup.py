@@ -1,4 +1,4 @@
-from copy import deepcopy
+from array import array
 
 class DuplicateUserException(Exception):
     pass
@@ -6,20 +6,28 @@ class DuplicateUserException(Exception):
 class UserConversionFailedException(Exception):
     pass
 
+# Fixed topic vocabulary, topic weights are stored as an array with one slot per topic
+TOPICS = ("array", "string", "sorting", "tree", "greedy", "stack",
+          "recursion", "math", "geometry", "divide-and-conquer", "any")
+TOPIC_INDEX = {topic: i for i, topic in enumerate(TOPICS)}
+
 class UserGroup:
     '''
     UserGroup: Represents users and group when forming groups together
+    Uses __slots__ and flat numeric attributes, since thousands of these are compared every cycle
     
     Class Attributes
     :user set(String): A set of strings, representing unique ids of all users waiting
 
     Instance Atrributes:
     :ids list(String): A list of slack ids that represent the group members
-    :attr dict(String=>Numeric -OR- String=>dict(String=>Numeric)): A dictionary of attributes
-        - String=>Numeric are values compared directly
-        - String=>dict(String=>Numeric) are dictionary where all values add up to 1. Normalize when merging.
+    :difficulty Numeric: Difficulty code (1 easy, 2 medium, 3 hard, 0 any), averaged when merging
+    :meeting_size Numeric: Meeting size code (2, 3, 4, 0 any), averaged when merging
+    :topics array(float): Topic weights that add up to 1, indexed by TOPIC_INDEX. Averaged when merging.
+    :mask int: Bitmask of the topics with a weight, bit i is set when topics[i] is in use
     :timeout int: The number of cycles that a UserGroup object has iterated through
     '''
+    __slots__ = ("ids", "difficulty", "meeting_size", "topics", "mask", "timeout")
     users = set()
 
     def __init__(self, slack_id, att_dict):
@@ -27,13 +35,33 @@ class UserGroup:
         Defines a UserGroup object from the provided id and comparison attributes
         :param slack_id: The unique id associated with each member (App uses the slack id)
         :param att_dict: The attribute dictionary for the instance
+            {
+                "difficulty": Numeric difficulty code
+                "meeting_size": Numeric meeting size code
+                "topics": A dictionary of String=>Numeric topic weights, topics must be in TOPICS
+            }
         '''
         if slack_id in UserGroup.users: raise DuplicateUserException
+        self.topics = array("d", bytes(8 * len(TOPICS)))
+        self.mask = 0
+        for topic, weight in att_dict["topics"].items():
+            self.topics[TOPIC_INDEX[topic]] = weight
+            self.mask |= 1 << TOPIC_INDEX[topic]
+        self.difficulty = att_dict["difficulty"]
+        self.meeting_size = att_dict["meeting_size"]
         UserGroup.users.add(slack_id)
         self.ids = [slack_id]
-        self.attr = deepcopy(att_dict)
         self.timeout = 1
 
+    @property
+    def attr(self):
+        '''Dictionary version of the attributes, kept for callers that work on attribute names'''
+        return {"difficulty": self.difficulty, "meeting_size": self.meeting_size, "topics": self.topic_dict()}
+
+    def topic_dict(self):
+        '''Create a dictionary of topic String=>Numeric weights for the topics in use'''
+        return {TOPICS[i]: self.topics[i] for i in mask_indexes(self.mask)}
+
     def expire(self):
         '''Remove all group ids from the set of users'''
         for id in self.ids:
@@ -46,20 +74,13 @@ class UserGroup:
         '''
         self.ids.extend(other.ids)
         self.timeout = (self.timeout + other.timeout) // 2
-        for att in self.attr.keys():
-            if type(self.attr[att]) == dict:
-                # Key => {Key => Numeric} takes the average for each internal key 
-                for key in self.attr[att]:
-                    self.attr[att][key] = self.attr[att][key] / 2
-                # Note that the other UserGroup can add dictionary keys
-                for key in other.attr[att]:
-                    if key in self.attr[att].keys():
-                        self.attr[att][key] += other.attr[att][key] / 2
-                    else:
-                        self.attr[att][key] = other.attr[att][key] / 2
-            else:
-                # Key => Numeric is just the average
-                self.attr[att] = (self.attr[att] + other.attr[att]) / 2
+        # Numeric attributes are just the average
+        self.difficulty = (self.difficulty + other.difficulty) / 2
+        self.meeting_size = (self.meeting_size + other.meeting_size) / 2
+        # Topic weights take the average for each topic, the other UserGroup can add topics
+        self.mask |= other.mask
+        for i in mask_indexes(self.mask):
+            self.topics[i] = self.topics[i] / 2 + other.topics[i] / 2
     
     def step(self, n=1):
         '''Increment (or decrement) the timeout counter for checking group cohesion'''
@@ -68,13 +89,38 @@ class UserGroup:
     # TODO: Consider streamlining this process so we don't have to adapt to old code
     def to_group_form(self):
         '''Create dictionary version of UserGroup, used in GroupFormResponse'''
-        return {"members": self.ids, "topics": self.attr["topics"], "meeting_type": "Mock Interview"}
+        return {"members": self.ids, "topics": self.topic_dict(), "meeting_type": "Mock Interview"}
+
+    @staticmethod
+    def from_codes(slack_id, difficulty, meeting_size, mask, weight):
+        '''
+        Build a single user straight from converted codes, every topic in the mask gets the same weight
+        Skips the attribute dictionary, the caller is responsible for the duplicate check
+        '''
+        group = UserGroup.__new__(UserGroup)
+        group.topics = array("d", bytes(8 * len(TOPICS)))
+        for i in mask_indexes(mask):
+            group.topics[i] = weight
+        group.mask = mask
+        group.difficulty = difficulty
+        group.meeting_size = meeting_size
+        UserGroup.users.add(slack_id)
+        group.ids = [slack_id]
+        group.timeout = 1
+        return group
 
     @staticmethod
     def reset():
         '''Reset the unique id set to an empty if needed'''
         UserGroup.users = set()
 
+def mask_indexes(mask):
+    '''Iterate over the positions of the set bits in a topic bitmask'''
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
 # Compatibility Rating Function
 def compare_groupable(user_x, user_y, weights):
     '''
@@ -97,18 +143,17 @@ def compare_groupable(user_x, user_y, weights):
     - Currently uses linear error, squaring the error may be better
     '''
     try:
+        # Numeric attributes, use the weights to control how the error contributes to the net error
         error_score = 0
-        atts = list(set(user_x.attr.keys()) & set(user_y.attr.keys()))
-        for att in atts:
-            # Use the weights to control how the error contributes to the net error
-            if isinstance(user_x.attr[att], dict):
-                # Assume that the sum of a single dictionary's values is 1, i.e. floats
-                fields = list(set(user_x.attr[att].keys()) & set(user_y.attr[att].keys()))
-                dict_score = 2 - sum((user_x.attr[att][field] + user_y.attr[att][field] for field in fields))
-                error_score += weights[att] * (dict_score)
-            else:
-                # Assume the internal dictionary is Key => Numeric
-                error_score += weights[att] * (abs(user_x.attr[att] - user_y.attr[att]) if user_x.attr[att] * user_y.attr[att] != 0 else 0)
+        if user_x.difficulty * user_y.difficulty != 0:
+            error_score += weights["difficulty"] * abs(user_x.difficulty - user_y.difficulty)
+        if user_x.meeting_size * user_y.meeting_size != 0:
+            error_score += weights["meeting_size"] * abs(user_x.meeting_size - user_y.meeting_size)
+        # Topic weights, only the topics both have in use (the bitmask intersection) count
+        shared = 0
+        for i in mask_indexes(user_x.mask & user_y.mask):
+            shared += user_x.topics[i] + user_y.topics[i]
+        error_score += weights["topics"] * (2 - shared)
         return error_score / (sum(weights.values()) * 2)
     except AttributeError:
         # logger.error("Attribute mismatch when comparing " + str(user_x) + " and " + str(user_y))
@@ -117,12 +162,63 @@ def compare_groupable(user_x, user_y, weights):
         # logger.error("Attribute values are not compatible when comparing " + str(user_x) + " and " + str(user_y))
         return 2000000 # Some arbitrarily high number
 
+# Slack Conversion Key, maps the modal option values to attribute codes
+DIFFICULTIES = {"dif-hard": 3, "dif-medium": 2, "dif-easy": 1, "dif-any": 0}
+MEETING_SIZES = {"siz-small": 2, "siz-medium": 3, "siz-large": 4, "siz-any": 0}
+TOPIC_LIST = {"top-array": "array", "top-string": "string", "top-sorting": "sorting",
+              "top-tree": "tree", "top-greedy": "greedy", "top-stack": "stack",
+              "top-recursion": "recursion", "top-math": "math", "top-geometry": "geometry",
+              "top-divide_and_conquer": "divide-and-conquer", "top-any": "any"}
+TOPIC_BITS = {option: 1 << TOPIC_INDEX[topic] for option, topic in TOPIC_LIST.items()}
+
+# Rejection reasons reported by convert_batch, and the exception convert_to_usergroup raises for each
+REJECT_DUPLICATE = "duplicate"
+REJECT_INVALID = "invalid"
+REJECTIONS = {REJECT_DUPLICATE: DuplicateUserException, REJECT_INVALID: UserConversionFailedException}
+
 # Convert packets into UserGroup objects (Moved here to make testing easier)
 # You need to check the slack modal
+def convert_batch(packets):
+    '''
+    Converts a list of packets recieved from Slack into UserGroup objects in one pass
+    Packets are validated against the conversion tables, and ids already waiting (or repeated
+    in the batch) are rejected, without stopping the rest of the batch.
+    :param packets: An iterable of packet dictionaries, see convert_to_usergroup
+    :return: (groups, rejected), the new UserGroup objects in packet order, and a list of
+        {"slack_id", "reason", "detail", "packet"} dictionaries, reason is REJECT_DUPLICATE or REJECT_INVALID
+    '''
+    groups = []
+    rejected = []
+    for packet in packets:
+        try:
+            # Get basic packet content, topics have weight 1 / size of the topic list
+            slack_id = packet["slack_id"]
+            difficulty = DIFFICULTIES[packet["difficulty"]]
+            meeting_size = MEETING_SIZES[packet["meeting_size"]]
+            mask = 0
+            for topic in packet["topics"]:
+                mask |= TOPIC_BITS[topic]
+            weight = 1 / len(packet["topics"])
+            duplicate = slack_id in UserGroup.users
+        except (KeyError, TypeError, ZeroDivisionError) as e:
+            slack_id = packet.get("slack_id") if isinstance(packet, dict) else None
+            rejected.append({"slack_id": slack_id, "reason": REJECT_INVALID,
+                             "detail": "User packet could not be converted correctly ({}: {})".format(type(e).__name__, e),
+                             "packet": packet})
+            continue
+        if duplicate:
+            rejected.append({"slack_id": slack_id, "reason": REJECT_DUPLICATE,
+                             "detail": "User " + str(slack_id) + " is already in the queue", "packet": packet})
+            continue
+        groups.append(UserGroup.from_codes(slack_id, difficulty, meeting_size, mask, weight))
+    return groups, rejected
+
 def convert_to_usergroup(packet):
     '''
     Converts a packet recieved from Slack into a UserGroup object for easy matching
     :param packet: A dictionary with string keys and variable content
+    :raises DuplicateUserException: The slack id is already waiting
+    :raises UserConversionFailedException: The packet content isn't valid
 
     Expected Packet Contents {
         slack_id (String): The slack id retrieve from the Slack API
@@ -131,23 +227,7 @@ def convert_to_usergroup(packet):
         topics (List(String)): A list of topics strings, we give these numeric weights
     }
     '''
-    # Slack Conversion Key
-    difficulties = {"dif-hard": 3, "dif-medium": 2, "dif-easy": 1, "dif-any": 0}
-    meeting_sizes = {"siz-small": 2, "siz-medium": 3, "siz-large": 4, "siz-any": 0}
-    topic_list = {"top-array": "array", "top-string": "string", "top-sorting": "sorting",
-                  "top-tree": "tree", "top-greedy": "greedy", "top-stack": "stack",
-                  "top-recursion": "recursion", "top-math": "math", "top-geometry": "geometry",
-                  "top-divide_and_conquer": "divide-and-conquer", "top-any": "any"}
-    try:
-        # Get basic packet content
-        id = packet["slack_id"]
-        diff = int(difficulties[packet["difficulty"]])
-        sz = int(meeting_sizes[packet["meeting_size"]])
-        # Create the topic dictionary, topics have weight 1 / size of the topic list
-        ls = dict()
-        ls_size = len(packet["topics"])
-        for topic in packet["topics"]:
-            ls[topic_list[topic]] = 1 / ls_size
-        return UserGroup(id, {"difficulty":diff, "meeting_size":sz, "topics":ls})
-    except:
-        raise UserConversionFailedException("User packet could not be converted correctly")
\ No newline at end of file
+    groups, rejected = convert_batch([packet])
+    if rejected:
+        raise REJECTIONS[rejected[0]["reason"]](rejected[0]["detail"])
+    return groups[0]
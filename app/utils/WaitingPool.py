@@ -0,0 +1,113 @@
+from collections import OrderedDict, deque
+
+class WaitingPool:
+    '''
+    WaitingPool: Groups waiting to be matched, in arrival order, indexed by the slack ids of their members
+    Replaces the bounded deques in GroupQueue. Inserting at either end, removing a group and looking up
+    a member are O(1), so the pool stays cheap with tens of thousands of users. Nothing is dropped when
+    the pool gets big, soft_cap is only checked by full() so new requests can be turned away instead.
+
+    Matchers work on a deque copy (to_deque) and hand the result back with replace(). Groups that are
+    merged in place (i.e. by QueueGrouper.match_user) should be passed to reindex() afterwards.
+
+    Instance Attributes:
+    :groups OrderedDict(String=>UserGroup): Leader slack id (ids[0]) => UserGroup, in queue order
+    :members dict(String=>String): Slack id of every waiting user => leader slack id of its group
+    :soft_cap int: Number of waiting users at which full() starts returning True, None for no cap
+    '''
+    def __init__(self, groups=(), soft_cap=None):
+        '''
+        :param groups: An iterable of UserGroup objects to start with, in queue order
+        :param soft_cap: Number of waiting users before the pool reports itself as full
+        '''
+        self.groups = OrderedDict()
+        self.members = {}
+        self.soft_cap = soft_cap
+        self.extend(groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups.values())
+
+    def __contains__(self, slack_id):
+        return slack_id in self.members
+
+    @property
+    def population(self):
+        '''Number of users waiting, across every group'''
+        return len(self.members)
+
+    def full(self):
+        '''True once the soft cap is reached, new requests should be turned away'''
+        return self.soft_cap is not None and len(self.members) >= self.soft_cap
+
+    def reindex(self, group):
+        '''Register the members of a group again after it was merged in place'''
+        for slack_id in group.ids:
+            self.members[slack_id] = group.ids[0]
+
+    def append(self, group):
+        '''Add a group at the back of the queue'''
+        self.groups[group.ids[0]] = group
+        self.reindex(group)
+
+    def appendleft(self, group):
+        '''Add a group at the front of the queue'''
+        self.append(group)
+        self.groups.move_to_end(group.ids[0], last=False)
+
+    def extend(self, groups):
+        for group in groups:
+            self.append(group)
+
+    def clear(self):
+        self.groups.clear()
+        self.members.clear()
+
+    def find(self, slack_id):
+        '''Return the group a user is waiting in, or None'''
+        leader = self.members.get(slack_id)
+        return None if leader is None else self.groups[leader]
+
+    def remove(self, slack_id):
+        '''
+        Take the group a user is waiting in out of the pool
+        :return: The removed UserGroup, or None if the user isn't waiting
+        '''
+        leader = self.members.get(slack_id)
+        if leader is None:
+            return None
+        group = self.groups.pop(leader)
+        for member in group.ids:
+            self.members.pop(member, None)
+        return group
+
+    def to_deque(self):
+        '''Deque copy in queue order, for the group matchers'''
+        return deque(self.groups.values())
+
+    def replace(self, groups):
+        '''Replace the contents with the groups a matcher returned, in their new order'''
+        self.clear()
+        self.extend(groups)
+
+    def sweep(self, timeout_threshold):
+        '''
+        Increase the timeout of every group, and take out the groups that passed their expiration date
+        Expired groups have their ids removed from the UserGroup user set (UserGroup.expire)
+        :param timeout_threshold: Number of cycles a group waits before it expires
+        :return: A list of the expired groups, in queue order
+        '''
+        expired = []
+        for leader, group in list(self.groups.items()):
+            if group.timeout < timeout_threshold:
+                group.step()
+            else:
+                group.expire() # Remove users from the no-repeat set
+                del self.groups[leader]
+                for member in group.ids:
+                    self.members.pop(member, None)
+                expired.append(group)
+        return expired
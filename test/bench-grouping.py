@@ -0,0 +1,231 @@
+# Install files from the main application, using the .env file
+import sys
+import os
+from dotenv import load_dotenv
+load_dotenv()
+locs = os.getenv("testfiles").split(",")
+for loc in locs:
+    sys.path.append(loc)
+
+# Install necessary libraries
+from utils import UserGroup, ResourceFinder, WaitingPool
+from collections import deque
+import argparse
+import datetime
+import importlib
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+sql_script = os.getenv("databasescriptpath")
+
+# Benchmark suite for the grouping pipeline
+# Generates seeded request streams with the dummyreq pattern from test-grouping.py, feeds them
+# through the same steps as GroupQueue.worker_thread, and times each step per cycle.
+# Results are written as JSON so runs on different commits can be compared with --baseline.
+# > python bench-grouping.py --sizes 100,1000,10000 --matchers QueueGrouper,MatrixGrouper
+# > python bench-grouping.py --sizes 10000 --matchers MatrixGrouper,ShardedGrouper --shard-key meeting_size --processes 4
+
+# Dummy requests and tag listings are shared with the grouping tests (the file name has a hyphen)
+test_grouping = importlib.import_module("test-grouping")
+dummyreq = test_grouping.dummyreq
+topic_options = test_grouping.topic_options
+diff_options = test_grouping.diff_options + ["dif-any"]
+size_options = test_grouping.size_options + ["siz-any"]
+
+# Constants (match GroupQueue.py)
+WEIGHTS = {"meeting_size": 6, "difficulty": 4, "topics": 1}
+CF = 4
+MT = 0.22
+TIMEOUT_THRESHOLD = 12
+STAGES = ("convert", "match", "expire", "suggest")
+
+def parse_distribution(text, options):
+    '''Turn "easy=2,hard=1" into weights lined up with options, missing options get 0'''
+    weights = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    return [weights.get(option.split("-", 1)[1], 0) for option in options]
+
+def generate_stream(total, cycles, seed, diff_weights, size_weights, topic_skew, max_topics):
+    '''
+    Create a seeded request stream, split into one list of packets per cycle
+    Topics follow a Zipf-like distribution, topic_skew = 0 makes every topic equally likely
+    '''
+    rng = random.Random(seed)
+    topic_weights = [1 / ((rank + 1) ** topic_skew) for rank in range(len(topic_options))]
+    stream = [[] for _ in range(cycles)]
+    for x in range(total):
+        topics = set()
+        for _ in range(rng.randint(1, max_topics)):
+            topics.add(rng.choices(topic_options, weights=topic_weights)[0])
+        req = dummyreq(str(x), rng.choices(diff_options, weights=diff_weights)[0],
+                       rng.choices(size_options, weights=size_weights)[0], sorted(topics))
+        stream[rng.randrange(cycles)].append(req)
+    return stream
+
+def percentiles(samples):
+    '''p50/p90/p99/max of a list of seconds'''
+    if len(samples) == 0:
+        return {"p50": 0, "p90": 0, "p99": 0, "max": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": ordered[-1]}
+
+def run_pipeline(matcher, stream, db_conn, problem_index, track_memory, cache=None, table=None):
+    '''Run every cycle of the stream through the pipeline, return the timing record'''
+    UserGroup.UserGroup.reset()
+    timings = {stage: [] for stage in STAGES}
+    cycle_times = []
+    waiting_pool = WaitingPool.WaitingPool()
+    exit_total = []
+    if track_memory:
+        tracemalloc.start()
+    # Keep going after the last arrivals until everyone has expired out of the queue
+    cycles = stream + [[] for _ in range(TIMEOUT_THRESHOLD + 1)]
+    for packets in cycles:
+        cycle_start = time.perf_counter()
+        start = time.perf_counter()
+        user_queue = deque(UserGroup.convert_batch(packets)[0])
+        timings["convert"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        group_queue = waiting_pool.to_deque()
+        matcher(user_queue, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        waiting_pool.replace(group_queue)
+        timings["match"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        exit_queue = waiting_pool.sweep(TIMEOUT_THRESHOLD)
+        timings["expire"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if db_conn is not None:
+            ResourceFinder.suggest_resources(db_conn, [{"difficulty": group.difficulty, "topics": group.topic_dict()} for group in exit_queue],
+                                             index=problem_index, cache=cache, table=table)
+        timings["suggest"].append(time.perf_counter() - start)
+        exit_total.extend(exit_queue)
+        cycle_times.append(time.perf_counter() - cycle_start)
+    peak_memory = None
+    if track_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    users = sum(len(packets) for packets in stream)
+    total_time = sum(cycle_times)
+    return {
+        "users": users,
+        "cycles": len(cycles),
+        "total_seconds": total_time,
+        "throughput_users_per_second": users / total_time if total_time > 0 else None,
+        "cycle_latency": percentiles(cycle_times),
+        "stages": {stage: dict(total_seconds=sum(timings[stage]), **percentiles(timings[stage])) for stage in STAGES},
+        "peak_memory_bytes": peak_memory,
+        "groups_formed": sum(len(grp.ids) > 1 for grp in exit_total),
+        "unmatched_users": sum(len(grp.ids) <= 1 for grp in exit_total),
+    }
+
+def load_matcher(name, shard_key="meeting_size", processes=None):
+    '''
+    Matchers are named after their utils module, i.e. "MatrixGrouper" => MatrixGrouper.group_matcher
+    "ShardedGrouper" builds a ShardedGrouper.ShardedMatcher, close it after the run (close_matcher)
+    '''
+    module = importlib.import_module("utils." + name)
+    if name == "ShardedGrouper":
+        return module.ShardedMatcher(key=shard_key, processes=processes)
+    return module.group_matcher
+
+def close_matcher(matcher):
+    '''Stop the worker pool of a matcher that has one'''
+    if hasattr(matcher, "close"):
+        matcher.close()
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    '''Print the ratio of every stage against a previous results file (> 1 means slower)'''
+    with open(baseline_path, "r") as baseline_file:
+        baseline = json.load(baseline_file)
+    previous = {(r["matcher"], r["size"], r["seed"]): r for r in baseline["results"]}
+    for result in results:
+        old = previous.get((result["matcher"], result["size"], result["seed"]))
+        if old is None:
+            continue
+        line = "{} n={}:".format(result["matcher"], result["size"])
+        for stage in STAGES:
+            if old["stages"][stage]["total_seconds"] > 0:
+                line += " {} x{:.2f}".format(stage, result["stages"][stage]["total_seconds"] / old["stages"][stage]["total_seconds"])
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the grouping pipeline")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Comma separated numbers of users per run")
+    parser.add_argument("--matchers", default="QueueGrouper,MatrixGrouper", help="Comma separated utils modules with a group_matcher, or ShardedGrouper")
+    parser.add_argument("--shard-key", default="meeting_size", help="UserGroup attribute ShardedGrouper partitions the queue by")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes of ShardedGrouper, one per core by default")
+    parser.add_argument("--cycles", type=int, default=20, help="Number of cycles the arrivals are spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--difficulty", default="easy=1,medium=1,hard=1,any=1", help="Relative weights of the difficulty options")
+    parser.add_argument("--meeting-size", default="small=1,medium=1,large=1,any=1", help="Relative weights of the meeting size options")
+    parser.add_argument("--topic-skew", type=float, default=1.0, help="Zipf exponent of the topic choice, 0 is uniform")
+    parser.add_argument("--max-topics", type=int, default=3, help="Most topics a single request picks")
+    parser.add_argument("--sql-only", action="store_true", help="Query the database for every suggestion instead of using ResourceFinder.ProblemIndex")
+    parser.add_argument("--cache", action="store_true", help="Draw suggestions from a ResourceFinder.RecommendationCache")
+    parser.add_argument("--table", action="store_true", help="Look suggestions up in a ResourceFinder.RecommendationTable")
+    parser.add_argument("--memory", action="store_true", help="Track peak memory with tracemalloc (slows every stage down)")
+    parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "benchmark-results.json"),
+                        help="Path of the JSON results file, in the temporary directory by default")
+    parser.add_argument("--baseline", default=None, help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    db_conn = ResourceFinder.create_temporary_database(sql_script) if sql_script and os.path.exists(sql_script) else None
+    if db_conn is None:
+        print("No database script found (databasescriptpath), suggest_resource is not timed")
+    problem_index = ResourceFinder.ProblemIndex(db_conn) if db_conn is not None and not args.sql_only else None
+    table = ResourceFinder.RecommendationTable(problem_index) if args.table and problem_index is not None else None
+    results = []
+    for size in (int(x) for x in args.sizes.split(",")):
+        stream = generate_stream(size, args.cycles, args.seed,
+                                 parse_distribution(args.difficulty, diff_options),
+                                 parse_distribution(args.meeting_size, size_options),
+                                 args.topic_skew, args.max_topics)
+        for name in args.matchers.split(","):
+            matcher = load_matcher(name, args.shard_key, args.processes)
+            try:
+                result = run_pipeline(matcher, stream, db_conn, problem_index, args.memory,
+                                      ResourceFinder.RecommendationCache() if args.cache else None, table)
+            finally:
+                close_matcher(matcher)
+            result.update({"matcher": name, "size": size, "seed": args.seed})
+            results.append(result)
+            print("{} n={}: {:.3f}s total, {:.0f} users/s, cycle p50 {:.4f}s p99 {:.4f}s".format(
+                name, size, result["total_seconds"], result["throughput_users_per_second"] or 0,
+                result["cycle_latency"]["p50"], result["cycle_latency"]["p99"]))
+    if db_conn is not None:
+        db_conn.close()
+
+    report = {
+        "meta": {
+            "commit": current_commit(),
+            "python": platform.python_version(),
+            "timestamp": datetime.datetime.now().isoformat(),
+            "arguments": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
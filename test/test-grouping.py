@@ -8,7 +8,7 @@ for loc in locs:
     sys.path.append(loc)
 
 # Install necessary libraries
-from utils import UserGroup, QueueGrouper
+from utils import UserGroup, QueueGrouper, MatrixGrouper, BucketGrouper, GlobalGrouper, ShardedGrouper
 from collections import deque
 import unittest
 
@@ -63,6 +63,48 @@ class TestGroupingBasic(unittest.TestCase):
         self.assertAlmostEqual(group_queue[0].attr["topics"]["string"], 0.5, delta=0.0001)
         self.assertAlmostEqual(group_queue[0].attr["topics"]["array"], 0.5, delta=0.0001)
 
+    def test_compact_representation(self):
+        '''Test that UserGroup stores integer codes and topic weights without a per-instance dictionary'''
+        UserGroup.UserGroup.reset()
+        x = UserGroup.convert_to_usergroup(dummyreq("a", "dif-hard", "siz-large", ["top-tree", "top-any"]))
+        y = UserGroup.convert_to_usergroup(dummyreq("b", "dif-easy", "siz-small", ["top-tree"]))
+        self.assertFalse(hasattr(x, "__dict__"))
+        self.assertTrue(x.difficulty == 3 and x.meeting_size == 4)
+        self.assertTrue(x.mask == (1 << UserGroup.TOPIC_INDEX["tree"]) | (1 << UserGroup.TOPIC_INDEX["any"]))
+        self.assertTrue(x.attr == {"difficulty": 3, "meeting_size": 4, "topics": {"tree": 0.5, "any": 0.5}})
+        # Only the shared topic reduces the error: (4 * 2 + 6 * 2 + 1 * (2 - 1.5)) / 22
+        self.assertAlmostEqual(UserGroup.compare_groupable(x, y, WEIGHTS), 20.5 / 22, delta=0.0001)
+        x.merge(y)
+        self.assertTrue(x.difficulty == 2 and x.meeting_size == 3)
+        self.assertTrue(x.topic_dict() == {"tree": 0.75, "any": 0.25})
+
+    def test_convert_batch(self):
+        '''Test that batch conversion creates valid users and reports rejected packets with a reason'''
+        UserGroup.UserGroup.reset()
+        waiting = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))
+        packets = [dummyreq("b", "dif-hard", "siz-large", ["top-tree", "top-any"]),
+                   dummyreq("a", "dif-easy", "siz-small", ["top-array"]),        # Already waiting
+                   dummyreq("c", "dif-impossible", "siz-small", ["top-array"]),  # Unknown difficulty
+                   dummyreq("d", "dif-easy", "siz-small", []),                   # No topics
+                   {"slack_id": "e", "difficulty": "dif-easy"},                  # Missing fields
+                   dummyreq("b", "dif-easy", "siz-small", ["top-array"]),        # Repeated in the batch
+                   dummyreq("f", "dif-any", "siz-any", ["top-math", "top-math"])]
+        groups, rejected = UserGroup.convert_batch(packets)
+        self.assertTrue([grp.ids for grp in groups] == [["b"], ["f"]])
+        self.assertTrue(groups[0].attr == {"difficulty": 3, "meeting_size": 4, "topics": {"tree": 0.5, "any": 0.5}})
+        self.assertTrue(groups[1].attr == {"difficulty": 0, "meeting_size": 0, "topics": {"math": 0.5}})
+        self.assertTrue([(r["slack_id"], r["reason"]) for r in rejected] == [
+            ("a", UserGroup.REJECT_DUPLICATE), ("c", UserGroup.REJECT_INVALID), ("d", UserGroup.REJECT_INVALID),
+            ("e", UserGroup.REJECT_INVALID), ("b", UserGroup.REJECT_DUPLICATE)])
+        self.assertTrue(rejected[1]["packet"] is packets[2])
+        self.assertTrue(UserGroup.UserGroup.users == {"a", "b", "f"})
+        # Single packets raise the exception that matches the reason
+        with self.assertRaises(UserGroup.DuplicateUserException):
+            UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))
+        with self.assertRaises(UserGroup.UserConversionFailedException):
+            UserGroup.convert_to_usergroup(dummyreq("g", "dif-easy", "siz-huge", ["top-array"]))
+        waiting.expire()
+
     def test_basic_mismatch(self):
         '''Test that the grouping function can refuse to merge two users together'''
         UserGroup.UserGroup.reset()
@@ -100,6 +142,22 @@ class TestGroupingBasic(unittest.TestCase):
         QueueGrouper.group_matcher(user_queue, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
         self.assertTrue(len(group_queue) == 2)
     
+    def test_match_user(self):
+        '''Test that a single user is matched against the waiting groups on arrival'''
+        UserGroup.UserGroup.reset()
+        x = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-string", "top-array"]))
+        y = UserGroup.convert_to_usergroup(dummyreq("b", "dif-hard", "siz-large", ["top-tree", "top-recursion"]))
+        z = UserGroup.convert_to_usergroup(dummyreq("c", "dif-easy", "siz-small", ["top-string"]))
+        group_queue = deque()
+        # No group to join, users wait at the front of the queue
+        self.assertTrue(QueueGrouper.match_user(x, group_queue, WEIGHTS, match_threshold=MT) is x)
+        self.assertTrue(QueueGrouper.match_user(y, group_queue, WEIGHTS, match_threshold=MT) is y)
+        self.assertTrue(list(group_queue) == [y, x])
+        # A compatible user joins the existing group right away
+        self.assertTrue(QueueGrouper.match_user(z, group_queue, WEIGHTS, match_threshold=MT) is x)
+        self.assertTrue(len(group_queue) == 2)
+        self.assertTrue(x.ids == ["a", "c"])
+
     # TODO: Consider changing weights to improve group performance, as well as compromise factor & match forgiveness
     # This test is biased towards forgiveness (one-at-a-time), so it owuld be helpful to write tests to find balance
     def test_many_users_1by1(self):
@@ -154,6 +212,242 @@ class TestGroupingBasic(unittest.TestCase):
             print(grp.ids)
         print(len(exit_queue))
 
+# Run the same request stream through a matcher, return the group formations in exit order
+def simulate_matcher(matcher, total=100, cycles=24):
+    UserGroup.UserGroup.reset()
+    users = [dummyreq(str(x), diff_options[x % 3], size_options[((x // 3) % 3)], [topic_options[x % 10], topic_options[(x * 7) % 11]])
+             for x in range(total)]
+    user_queue = deque()
+    group_queue = deque()
+    exit_queue = deque()
+    for i in range(cycles):
+        # Users arrive a few at a time, so the matcher sees both new users and waiting groups
+        for req in users[i * 5:(i + 1) * 5]:
+            user_queue.append(UserGroup.convert_to_usergroup(req))
+        matcher(user_queue, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        update_queue_timeout(group_queue, exit_queue)
+    return [grp.ids for grp in exit_queue] + [grp.ids for grp in group_queue]
+
+class TestPenaltyRegistry(unittest.TestCase):
+    def registry(self):
+        return QueueGrouper.PenaltyRegistry({
+            "meeting_size": QueueGrouper.SizePenalty("meeting_size", maxsize=4),
+            "difficulty": QueueGrouper.ThresholdPenalty("difficulty", threshold=1, penalty=2000000),
+            "members": QueueGrouper.DistancePenalty("members", scale=0.25, cap=0.5, weighted=True),
+        })
+
+    def test_batch_matches_pairs(self):
+        '''Test that declarative and plain function penalties give the same values per pair and in batch'''
+        UserGroup.UserGroup.reset()
+        users = [UserGroup.convert_to_usergroup(dummyreq(str(x), (diff_options + ["dif-any"])[x % 4],
+                 (size_options + ["siz-any"])[(x // 2) % 4], [topic_options[x % 11]])) for x in range(12)]
+        users[0].merge(users[1])
+        registry = self.registry()
+        registry.register("timeout", lambda x, y, weights: 0.01 * (x.timeout + y.timeout))
+        self.assertIsInstance(registry["timeout"], QueueGrouper.CallablePenalty)
+        packed = MatrixGrouper.GroupMatrix(users)
+        rows = list(range(len(users)))
+        penalty = registry.batch(packed, rows, packed, rows, WEIGHTS)
+        for i in rows:
+            for j in rows:
+                self.assertAlmostEqual(penalty[i, j], registry.pair(users[i], users[j], WEIGHTS), delta=0.0001)
+
+    def test_function_list(self):
+        '''Test that a list of penalty functions still works, meeting_size_penalty gets its declarative version'''
+        self.assertIsInstance(QueueGrouper.as_penalty(QueueGrouper.meeting_size_penalty), QueueGrouper.SizePenalty)
+        expected = simulate_matcher(QueueGrouper.group_matcher)
+        for matcher in (QueueGrouper.group_matcher, MatrixGrouper.group_matcher, BucketGrouper.group_matcher):
+            with_list = lambda *args, **kwargs: matcher(*args, penalities=[QueueGrouper.meeting_size_penalty], **kwargs)
+            self.assertEqual(simulate_matcher(with_list), expected)
+
+    def test_declared_attributes(self):
+        '''Test that penalties only accept UserGroup attributes, and subclasses get a working batch'''
+        with self.assertRaises(TypeError):
+            QueueGrouper.Penalty()
+        with self.assertRaises(ValueError):
+            QueueGrouper.ThresholdPenalty("timezone", threshold=3, penalty=2000000)
+        class TimeoutPenalty(QueueGrouper.Penalty):
+            attribute = "timeout"
+            def __call__(self, user_x, user_y, weights):
+                return abs(user_x.timeout - user_y.timeout)
+        UserGroup.UserGroup.reset()
+        users = [UserGroup.convert_to_usergroup(dummyreq(str(x), "dif-easy", "siz-small", ["top-array"])) for x in range(3)]
+        users[1].step()
+        packed = MatrixGrouper.GroupMatrix(users)
+        penalty = TimeoutPenalty().batch(packed, [0, 1], packed, [1, 2], WEIGHTS)
+        self.assertTrue(penalty.tolist() == [[1, 0], [0, 1]])
+
+    def test_custom_registry(self):
+        '''Test that every backend makes the same decisions with extra declarative penalties'''
+        registry = self.registry()
+        self.assertTrue(BucketGrouper.prunable(registry))
+        expected = simulate_matcher(lambda *args, **kwargs: QueueGrouper.group_matcher(*args, penalities=registry, **kwargs))
+        self.assertNotEqual(expected, simulate_matcher(QueueGrouper.group_matcher))
+        for matcher in (MatrixGrouper.group_matcher, BucketGrouper.group_matcher):
+            with_registry = lambda *args, **kwargs: matcher(*args, penalities=registry, **kwargs)
+            self.assertEqual(simulate_matcher(with_registry), expected)
+
+    def test_negative_bound(self):
+        '''Test that a penalty with a negative scale has no lower bound, and buckets aren't pruned by it'''
+        UserGroup.UserGroup.reset()
+        user = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))
+        reward = QueueGrouper.DistancePenalty("members", scale=-0.05)
+        self.assertTrue(reward.bound(user, {}, WEIGHTS) == float("-inf"))
+        self.assertTrue(reward.bound(user, {"members": 3}, WEIGHTS) == -0.1)
+        registry = self.registry()
+        registry.register("reward", reward)
+        expected = simulate_matcher(lambda *args, **kwargs: QueueGrouper.group_matcher(*args, penalities=registry, **kwargs))
+        with_registry = lambda *args, **kwargs: BucketGrouper.group_matcher(*args, penalities=registry, **kwargs)
+        self.assertEqual(simulate_matcher(with_registry), expected)
+
+class TestMatrixGrouper(unittest.TestCase):
+    def test_basic(self):
+        '''Test that the vectorized matcher can merge two users together'''
+        UserGroup.UserGroup.reset()
+        x = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-string", "top-array"]))
+        y = UserGroup.convert_to_usergroup(dummyreq("b", "dif-easy", "siz-small", ["top-string", "top-array"]))
+        user_queue = deque([x,y])
+        group_queue = deque()
+        MatrixGrouper.group_matcher(user_queue, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        self.assertTrue(len(group_queue) == 2)
+        self.assertTrue(len(user_queue) == 0)
+        MatrixGrouper.group_matcher(user_queue, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        self.assertTrue(len(group_queue) == 1)
+        self.assertTrue(set(group_queue[0].ids) == {"a", "b"})
+        self.assertAlmostEqual(group_queue[0].attr["topics"]["string"], 0.5, delta=0.0001)
+
+    def test_same_decisions(self):
+        '''Test that the vectorized matcher forms the same groups as QueueGrouper.group_matcher'''
+        expected = simulate_matcher(QueueGrouper.group_matcher)
+        self.assertEqual(simulate_matcher(MatrixGrouper.group_matcher), expected)
+
+    def test_score_matrix(self):
+        '''Test that the packed score matrix matches the pair by pair scores'''
+        UserGroup.UserGroup.reset()
+        users = [UserGroup.convert_to_usergroup(dummyreq(str(x), (diff_options + ["dif-any"])[x % 4],
+                 (size_options + ["siz-any"])[x % 4], [topic_options[x % 11], topic_options[(x * 3) % 11]])) for x in range(12)]
+        users[0].merge(users[1])
+        packed = MatrixGrouper.GroupMatrix(users)
+        rows = list(range(len(users)))
+        scores = MatrixGrouper.score(packed, rows, packed, rows, WEIGHTS, QueueGrouper.PENALTIES)
+        for i in rows:
+            for j in rows:
+                expected = UserGroup.compare_groupable(users[i], users[j], WEIGHTS)
+                expected *= sum(p(users[i], users[j], WEIGHTS) for p in QueueGrouper.PENALTIES)
+                self.assertAlmostEqual(scores[i, j], max(0, expected), delta=0.0001)
+
+class TestBucketGrouper(unittest.TestCase):
+    def test_same_decisions(self):
+        '''Test that the bucketed matcher forms the same groups as QueueGrouper.group_matcher'''
+        expected = simulate_matcher(QueueGrouper.group_matcher)
+        self.assertEqual(simulate_matcher(BucketGrouper.group_matcher), expected)
+
+    def test_lower_bound(self):
+        '''Test that bucket lower bounds never exceed the real score, wildcards included'''
+        UserGroup.UserGroup.reset()
+        users = [UserGroup.convert_to_usergroup(dummyreq(str(x), (diff_options + ["dif-any"])[x % 4],
+                 (size_options + ["siz-any"])[(x // 4) % 4], [topic_options[x % 11]])) for x in range(32)]
+        index = BucketGrouper.CandidateIndex(WEIGHTS, QueueGrouper.PENALTIES)
+        for seq, user in enumerate(users):
+            index.add(seq, user)
+        for user in users:
+            for other in users:
+                score = UserGroup.compare_groupable(user, other, WEIGHTS)
+                score *= sum(p(user, other, WEIGHTS) for p in QueueGrouper.PENALTIES)
+                self.assertLessEqual(index.lower_bound(user, index.keys[users.index(other)]), score + BucketGrouper.EPSILON)
+
+    def test_pruning(self):
+        '''Test that oversized and far apart buckets are skipped, but wildcards are kept'''
+        UserGroup.UserGroup.reset()
+        group = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))
+        group.merge(UserGroup.convert_to_usergroup(dummyreq("b", "dif-easy", "siz-small", ["top-array"])))
+        index = BucketGrouper.CandidateIndex(WEIGHTS, QueueGrouper.PENALTIES)
+        index.add(0, UserGroup.convert_to_usergroup(dummyreq("c", "dif-hard", "siz-large", ["top-array"])))
+        index.add(1, UserGroup.convert_to_usergroup(dummyreq("d", "dif-any", "siz-any", ["top-tree"])))
+        index.add(2, UserGroup.convert_to_usergroup(dummyreq("e", "dif-easy", "siz-small", ["top-array"])))
+        # A close difficulty is still plausible for a pair, but not once the merge would be oversized
+        trio = UserGroup.convert_to_usergroup(dummyreq("f", "dif-medium", "siz-small", ["top-array"]))
+        index.add(3, UserGroup.convert_to_usergroup(dummyreq("g", "dif-medium", "siz-small", ["top-array"])))
+        trio.merge(UserGroup.convert_to_usergroup(dummyreq("h", "dif-medium", "siz-small", ["top-array"])))
+        trio.merge(UserGroup.convert_to_usergroup(dummyreq("i", "dif-medium", "siz-small", ["top-array"])))
+        index.add(4, trio)
+        self.assertEqual(list(index.candidates(group, MT, 0)), [1, 2, 3])
+        self.assertEqual(list(index.candidates(group, MT, 2)), [2, 3])
+        self.assertEqual(list(index.candidates(group, None, 0)), [0, 1, 2, 3, 4])
+
+class TestGlobalGrouper(unittest.TestCase):
+    def test_best_pair(self):
+        '''Test that the best pair is merged, even when a worse match comes first in the queue'''
+        UserGroup.UserGroup.reset()
+        a = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))
+        b = UserGroup.convert_to_usergroup(dummyreq("b", "dif-easy", "siz-small", ["top-string"]))
+        c = UserGroup.convert_to_usergroup(dummyreq("c", "dif-easy", "siz-small", ["top-array"]))
+        # First-fit merges a with b, the first user under the threshold
+        QueueGrouper.group_matcher(deque([b, c]), deque([a]), WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        self.assertTrue(a.ids == ["a", "b"])
+        UserGroup.UserGroup.reset()
+        a = UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))
+        b = UserGroup.convert_to_usergroup(dummyreq("b", "dif-easy", "siz-small", ["top-string"]))
+        c = UserGroup.convert_to_usergroup(dummyreq("c", "dif-easy", "siz-small", ["top-array"]))
+        group_queue = deque([a])
+        GlobalGrouper.group_matcher(deque([b, c]), group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        # The identical user is merged first, b still fits the grown group afterwards
+        self.assertTrue(a.ids == ["a", "c", "b"])
+        self.assertTrue(len(group_queue) == 1)
+
+    def test_size_limit(self):
+        '''Test that groups never grow past the size limit, even for identical users'''
+        UserGroup.UserGroup.reset()
+        users = deque(UserGroup.convert_to_usergroup(dummyreq(str(x), "dif-any", "siz-any", ["top-any"])) for x in range(10))
+        group_queue = deque()
+        GlobalGrouper.group_matcher(users, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        self.assertTrue(len(users) == 0)
+        self.assertTrue(sorted(len(grp.ids) for grp in group_queue) == [2, 4, 4])
+
+    def test_many_users(self):
+        '''Test that the global matcher forms groups for a large queue'''
+        groups = simulate_matcher(GlobalGrouper.group_matcher)
+        self.assertTrue(sorted(x for grp in groups for x in grp) == sorted(str(x) for x in range(100)))
+        self.assertTrue(sum(len(grp) <= 1 for grp in groups) < 10)
+        self.assertTrue(max(len(grp) for grp in groups) <= 4)
+
+class TestShardedGrouper(unittest.TestCase):
+    def test_shards_stay_apart(self):
+        '''Test that users with different meeting sizes are only grouped through a wildcard'''
+        UserGroup.UserGroup.reset()
+        users = deque(UserGroup.convert_to_usergroup(dummyreq(str(x), "dif-easy", ["siz-small", "siz-large"][x % 2], ["top-array"])) for x in range(8))
+        group_queue = deque()
+        matcher = ShardedGrouper.ShardedMatcher(key="meeting_size")
+        matcher(users, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        matcher(users, group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        self.assertTrue(len(users) == 0)
+        self.assertTrue(sorted(x for grp in group_queue for x in grp.ids) == [str(x) for x in range(8)])
+        for grp in group_queue:
+            self.assertTrue(len({int(x) % 2 for x in grp.ids}) == 1)
+        # The cross-shard pass lets a wildcard join a group from any shard
+        UserGroup.UserGroup.reset()
+        group_queue = deque([UserGroup.convert_to_usergroup(dummyreq("a", "dif-easy", "siz-small", ["top-array"]))])
+        wildcard = UserGroup.convert_to_usergroup(dummyreq("w", "dif-easy", "siz-any", ["top-array"]))
+        matcher(deque([wildcard]), group_queue, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        self.assertTrue(len(group_queue) == 1)
+        self.assertTrue(group_queue[0].ids == ["a", "w"])
+        # Averaged values are sharded by the nearest key, only wildcards go to the wildcard shard
+        small = UserGroup.convert_to_usergroup(dummyreq("s", "dif-easy", "siz-small", ["top-array"]))
+        small.merge(UserGroup.convert_to_usergroup(dummyreq("m", "dif-easy", "siz-medium", ["top-array"])))
+        self.assertTrue(small.meeting_size == 2.5 and ShardedGrouper.shard_of(small, "meeting_size") == 3)
+        self.assertTrue(ShardedGrouper.shard_of(wildcard, "meeting_size") is None)
+
+    def test_pool_same_as_inline(self):
+        '''Test that matching the shards on a worker pool gives the same groups as matching them in process'''
+        expected = simulate_matcher(ShardedGrouper.ShardedMatcher(inline_below=10 ** 6))
+        with ShardedGrouper.ShardedMatcher(processes=2, inline_below=0) as matcher:
+            groups = simulate_matcher(matcher)
+            self.assertTrue(matcher.pool is not None)
+        self.assertTrue(matcher.pool is None)
+        self.assertEqual(groups, expected)
+        self.assertTrue(sorted(x for grp in groups for x in grp) == sorted(str(x) for x in range(100)))
+        self.assertTrue(max(len(grp) for grp in groups) <= 4)
+
 if __name__ == "__main__":
     unittest.main()
     print("All tests passed")
\ No newline at end of file
@@ -0,0 +1,199 @@
+# Install files from the main application, using the .env file
+import sys
+import os
+from dotenv import load_dotenv
+load_dotenv()
+locs = os.getenv("testfiles").split(",")
+for loc in locs:
+    sys.path.append(loc)
+
+# Install necessary libraries
+from utils import QueueChannel, Admission, WaitingPool, UserGroup, Handoff
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import socket
+import time
+import unittest
+
+AUTHKEY = b'password'
+
+# Server on a free local port, answers with the packet number doubled
+def start_server(handler=lambda packet: packet["number"] * 2, address=("127.0.0.1", 0)):
+    server = QueueChannel.QueueServer(address, AUTHKEY, handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class TestQueueChannel(unittest.TestCase):
+    def test_frames(self):
+        '''Test that frames survive a round trip and oversized frames are refused'''
+        left, right = socket.socketpair()
+        with left, right:
+            QueueChannel.send_frame(left, {"header": "user_queue_request", "topics": ["top-array"]})
+            self.assertTrue(QueueChannel.recv_frame(right) == {"header": "user_queue_request", "topics": ["top-array"]})
+            left.sendall(QueueChannel.HEADER.pack(QueueChannel.MAX_FRAME + 1))
+            with self.assertRaises(QueueChannel.ChannelError):
+                QueueChannel.recv_frame(right)
+
+    def test_pipelined(self):
+        '''Test that many threads share one connection and every response reaches its own request'''
+        server = start_server()
+        client = QueueChannel.QueueClient(server.address, AUTHKEY)
+        try:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                responses = list(executor.map(lambda x: client.request({"number": x}), range(500)))
+            self.assertTrue(responses == [x * 2 for x in range(500)])
+            futures = [client.submit({"number": x}) for x in range(100)] # In flight at once
+            self.assertTrue([future.result(5) for future in futures] == [x * 2 for x in range(100)])
+            self.assertTrue(client.request({"wrong": 1}) == -1) # Handler errors are answered, not fatal
+            self.assertTrue(client.request({"number": 1}) == 2)
+        finally:
+            client.close()
+            server.close()
+
+    def test_blocked_writer(self):
+        '''Test that responses still arrive while another thread is stuck writing its request'''
+        server = start_server()
+        client = QueueChannel.QueueClient(server.address, AUTHKEY)
+        try:
+            first = client.submit({"number": 1})
+            with client.write_lock: # Stands in for a sendall blocked on a full socket buffer
+                writer = ThreadPoolExecutor(max_workers=1)
+                second = writer.submit(client.request, {"number": 2})
+                self.assertTrue(first.result(5) == 2)
+            self.assertTrue(second.result(5) == 4)
+            writer.shutdown()
+        finally:
+            client.close()
+            server.close()
+
+    def test_authkey(self):
+        '''Test that a client with the wrong authkey is refused'''
+        server = start_server()
+        client = QueueChannel.QueueClient(server.address, b'wrong')
+        try:
+            with self.assertRaises(ConnectionError):
+                client.request({"number": 1})
+        finally:
+            client.close()
+            server.close()
+
+    def test_reconnect(self):
+        '''Test that the client connects again after the server restarts'''
+        server = start_server()
+        address = server.address
+        client = QueueChannel.QueueClient(address, AUTHKEY)
+        try:
+            self.assertTrue(client.request({"number": 1}) == 2)
+            server.close()
+            for _ in range(100):
+                if client.sock is None:
+                    break
+                time.sleep(0.01)
+            server = start_server(lambda packet: packet["number"] * 3, address)
+            self.assertTrue(client.request({"number": 1}) == 3)
+        finally:
+            client.close()
+            server.close()
+
+    def test_many_clients(self):
+        '''Test that hundreds of clients are served at once, and stalled clients don't hold anyone up'''
+        server = QueueChannel.QueueServer(("127.0.0.1", 0), AUTHKEY, lambda packet: packet["number"] * 2,
+                                          handshake_timeout=0.5, frame_timeout=0.5)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # One client never authenticates, another stops in the middle of a frame
+        silent = socket.create_connection(server.address)
+        partial = QueueChannel.QueueClient(server.address, AUTHKEY)
+        clients = [QueueChannel.QueueClient(server.address, AUTHKEY) for _ in range(200)]
+        try:
+            partial.request({"number": 0})
+            partial.sock.sendall(QueueChannel.HEADER.pack(100) + b"{")
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=50) as executor:
+                responses = list(executor.map(lambda x: clients[x].request({"number": x}, timeout=5), range(200)))
+            self.assertTrue(responses == [x * 2 for x in range(200)])
+            self.assertTrue(time.time() - start < 5)
+            # Both stalled connections get dropped by the timeouts
+            silent.settimeout(5)
+            silent.recv(4096) # Challenge
+            self.assertTrue(silent.recv(4096) == b"")
+            for _ in range(200):
+                if partial.sock is None:
+                    break
+                time.sleep(0.01)
+            self.assertTrue(partial.sock is None)
+        finally:
+            silent.close()
+            partial.close()
+            for client in clients:
+                client.close()
+            server.close()
+
+class TestAdmissionController(unittest.TestCase):
+    def test_admission(self):
+        '''Test that requests past capacity are shed with a retry time and counted, and nothing raises'''
+        UserGroup.UserGroup.reset()
+        requests = Queue(maxsize=3)
+        pool = WaitingPool.WaitingPool(soft_cap=1)
+        admission = Admission.AdmissionController(requests, pool, retry_after=5, pool_retry_after=60)
+        responses = [admission.admit({"number": x}) for x in range(5)]
+        self.assertTrue(responses[:3] == [Admission.ACCEPTED] * 3)
+        self.assertTrue(all(Admission.parse_response(response) == (Admission.BUSY, 5) for response in responses[3:]))
+        self.assertTrue(requests.qsize() == 3)
+        # A full waiting pool asks for a longer wait
+        pool.append(UserGroup.convert_to_usergroup({"slack_id": "a", "difficulty": "dif-easy", "meeting_size": "siz-small", "topics": ["top-array"]}))
+        requests.get()
+        self.assertTrue(Admission.parse_response(admission.admit({"number": 5})) == (Admission.BUSY, 60))
+        self.assertTrue(admission.reject() == Admission.REJECTED)
+        self.assertTrue(admission.stats() == {"accepted": 3, "shed_queue": 2, "shed_pool": 1, "rejected": 1, "shed": 3})
+        self.assertTrue(Admission.parse_response(Admission.ACCEPTED) == (Admission.ACCEPTED, None))
+
+    def test_busy_over_channel(self):
+        '''Test that a burst past capacity gets busy responses through the channel instead of errors'''
+        admission = Admission.AdmissionController(Queue(maxsize=10))
+        server = start_server(admission.admit)
+        client = QueueChannel.QueueClient(server.address, AUTHKEY)
+        try:
+            futures = [client.submit({"number": x}) for x in range(50)]
+            codes = [Admission.parse_response(future.result(5))[0] for future in futures]
+            self.assertTrue(codes.count(Admission.ACCEPTED) == 10 and codes.count(Admission.BUSY) == 40)
+        finally:
+            client.close()
+            server.close()
+
+class TestHandoff(unittest.TestCase):
+    def test_handoff(self):
+        '''Test that the handoff keeps items as they are, with enqueue times, and drains everything at once'''
+        now = [0.0]
+        handoff = Handoff.Handoff(capacity=3, clock=lambda: now[0])
+        packets = [{"slack_id": str(x)} for x in range(4)]
+        for packet in packets[:3]:
+            handoff.put_nowait(packet)
+            now[0] += 1
+        with self.assertRaises(Handoff.Full):
+            handoff.put_nowait(packets[3])
+        batch = handoff.drain()
+        self.assertTrue(batch == [(0.0, packets[0]), (1.0, packets[1]), (2.0, packets[2])])
+        self.assertTrue(all(item is packet for (queued, item), packet in zip(batch, packets))) # No copies
+        self.assertTrue(handoff.drain() == [] and len(handoff) == 0)
+        self.assertTrue(handoff.wait(timeout=0.01) == [])
+
+    def test_wait(self):
+        '''Test that a waiting worker wakes up for items put from other threads and loses none of them'''
+        handoff = Handoff.Handoff()
+        def produce(start):
+            for x in range(start, start + 1000):
+                handoff.put_nowait(x)
+        threads = [threading.Thread(target=produce, args=(x * 1000,)) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        received = []
+        while len(received) < 4000:
+            received.extend(item for queued, item in handoff.wait(timeout=5))
+        for thread in threads:
+            thread.join()
+        self.assertTrue(sorted(received) == list(range(4000)))
+
+if __name__ == "__main__":
+    unittest.main()
+    print("All tests passed")
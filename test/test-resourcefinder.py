@@ -10,6 +10,11 @@ for loc in locs:
 # Install necessary libraries
 from utils import ResourceFinder
 import unittest
+import sqlite3
+import tempfile
+import shutil
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 sql_script = os.getenv("databasescriptpath")
 
 # Note that the function has randomness (non-deterministic)
@@ -52,6 +57,328 @@ class TestResourceFinderBasic(unittest.TestCase):
         finally:
             db_conn.close()
 
+class TestProblemSet(unittest.TestCase):
+    def test_tags_merged(self):
+        '''Test that the queries return one entry per problem with every one of its tags'''
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            tag_name = db_conn.execute("SELECT tag_name FROM tags LIMIT 1").fetchone()[0]
+            problems = ResourceFinder.fetch_candidates(db_conn, 2, tag_name)
+            self.assertTrue(len(problems) > 0)
+            for prob in problems:
+                tags = {row[0] for row in db_conn.execute(
+                    "SELECT tag_name FROM problems NATURAL JOIN taggings NATURAL JOIN tags WHERE link = ?", (prob["link"],))}
+                self.assertTrue(prob["tags"] == tags)
+            self.assertTrue(any(tag_name in prob["tags"] for prob in problems))
+            # Rows for the same link are merged, tags aggregated with the separator are split
+            sep = ResourceFinder.TAG_SEPARATOR
+            rows = [(1, "a", "A", 1, "x" + sep + "y"), (2, "b", "B", 2, "z"), (1, "a", "A", 1, "w")]
+            self.assertTrue(ResourceFinder.create_problem_set(iter(rows)) == [
+                {"link": "a", "title": "A", "difficulty": 1, "tags": {"x", "y", "w"}},
+                {"link": "b", "title": "B", "difficulty": 2, "tags": {"z"}}])
+        finally:
+            db_conn.close()
+
+class TestBatchSuggestions(unittest.TestCase):
+    def test_batch(self):
+        '''Test that groups with the same rounded difficulty and top topic share their queries'''
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            statements = []
+            db_conn.set_trace_callback(statements.append)
+            groups = [{"difficulty": 1, "topics": {"array": 1}}, {"difficulty": 1.25, "topics": {"array": 1}},
+                      {"difficulty": 3, "topics": {}}, {"difficulty": 2.75, "topics": {}}]
+            suggestions = ResourceFinder.suggest_resources(db_conn, groups)
+            # (1, array) and (3, None): two queries for the first pair, one for the second
+            self.assertTrue(len(statements) == 3)
+            self.assertTrue(len(suggestions) == len(groups))
+            for problems in suggestions:
+                self.assertTrue(len(problems) == 3)
+                for prob in problems:
+                    self.assertTrue(set(prob.keys()) == {"link", "title", "difficulty", "tags"})
+            self.assertTrue(ResourceFinder.suggest_resources(db_conn, []) == [])
+        finally:
+            db_conn.close()
+
+class TestRecommendationCache(unittest.TestCase):
+    def test_cache(self):
+        '''Test that similar profiles share a pool, and that entries are evicted by size and age'''
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            now = [0]
+            cache = ResourceFinder.RecommendationCache(maxsize=2, ttl=60, clock=lambda: now[0])
+            statements = []
+            db_conn.set_trace_callback(statements.append)
+            near = [{"difficulty": 1, "topics": {"array": 0.5, "string": 0.5}}, {"difficulty": 1.2, "topics": {"array": 0.55, "string": 0.45}}]
+            suggestions = ResourceFinder.suggest_resources(db_conn, near, cache=cache)
+            self.assertTrue(len(statements) == 2) # One fetch (two queries) for both groups
+            self.assertTrue(all(len(problems) == 3 for problems in suggestions))
+            self.assertTrue(cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1)
+            # A different profile is a miss, a third one evicts the least recently used
+            ResourceFinder.suggest_resource(db_conn, {"difficulty": 3, "topics": {}}, cache=cache)
+            ResourceFinder.suggest_resource(db_conn, {"difficulty": 2, "topics": {"tree": 1}}, cache=cache)
+            self.assertTrue(len(cache) == 2 and cache.stats()["misses"] == 3)
+            ResourceFinder.suggest_resource(db_conn, near[0], cache=cache)
+            self.assertTrue(cache.stats()["misses"] == 4)
+            # Entries older than the ttl are fetched again
+            ResourceFinder.suggest_resource(db_conn, near[0], cache=cache)
+            self.assertTrue(cache.stats()["hits"] == 2)
+            now[0] = 61
+            ResourceFinder.suggest_resource(db_conn, near[0], cache=cache)
+            self.assertTrue(cache.stats()["misses"] == 5)
+        finally:
+            db_conn.close()
+
+    def test_variety(self):
+        '''Test that groups sharing a pool don't all get the same suggestions'''
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            index = ResourceFinder.ProblemIndex(db_conn)
+            cache = ResourceFinder.RecommendationCache()
+            seen = set()
+            for _ in range(20):
+                problems = ResourceFinder.suggest_resource(db_conn, {"difficulty": 2, "topics": {}}, index=index, cache=cache)
+                seen.add(tuple(prob["link"] for prob in problems))
+            self.assertTrue(len(seen) > 1)
+            self.assertTrue(cache.stats()["misses"] == 1)
+        finally:
+            db_conn.close()
+
+class TestProblemIndex(unittest.TestCase):
+    def test_index(self):
+        '''Test that the in-memory index matches the database and gives the same output shape'''
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            index = ResourceFinder.ProblemIndex(db_conn)
+            tagged = db_conn.execute("SELECT COUNT(DISTINCT pid) FROM taggings").fetchone()[0]
+            self.assertTrue(len(index) == tagged)
+            # Every problem in a bucket has that difficulty/tag
+            for difficulty, pids in index.by_difficulty.items():
+                self.assertTrue(all(index.problems[pid]["difficulty"] == difficulty for pid in pids))
+            for tag_name, pids in index.by_tag.items():
+                self.assertTrue(all(tag_name in index.problems[pid]["tags"] for pid in pids))
+            self.assertTrue(len(index.sample_difficulty(1, 5)) == min(5, len(index.by_difficulty.get(1, []))))
+            self.assertTrue(index.sample_tag("not-a-tag") == [])
+
+            EXPECTED_ATTR = {"link", "title", "difficulty", "tags"}
+            for attributes in ({"difficulty": 1, "topics": {"string": 0.5, "array": 0.5}}, {"difficulty": 0, "topics": {}}):
+                problems = ResourceFinder.suggest_resource(db_conn, attributes, index=index)
+                self.assertTrue(len(problems) == 3)
+                for prob in problems:
+                    self.assertTrue(set(prob.keys()) == EXPECTED_ATTR)
+                    self.assertTrue(prob["difficulty"] in {1,2,3})
+                    self.assertTrue(isinstance(prob["tags"], set) and len(prob["tags"]) > 0)
+                    prob["tags"].add("changed") # Results are copies, the index isn't affected
+            self.assertTrue(all("changed" not in prob["tags"] for prob in index.problems.values()))
+        finally:
+            db_conn.close()
+
+    def test_weighted_rank(self):
+        '''Test that every topic counts by its weight, and the index rank agrees with a full scan'''
+        self.assertTrue(ResourceFinder.query_values({"difficulty": 2, "topics": {"array": 0.7, "tree": 0.3}}) == (2, "array"))
+        self.assertTrue(ResourceFinder.query_values({"difficulty": 2, "topics": {}}) == (2, None))
+        group_attr = {"difficulty": 2, "topics": {"array": 0.6, "tree": 0.3, "string": 0.1}}
+        prob = {"difficulty": 2, "tags": {"tree", "string"}}
+        self.assertTrue(abs(ResourceFinder.problem_error(group_attr, prob) - 0.7) < 1e-9)
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            index = ResourceFinder.ProblemIndex(db_conn)
+            best = min(ResourceFinder.problem_error(group_attr, prob) for prob in index.problems.values())
+            problems = index.rank(group_attr, 3)
+            self.assertTrue(len(problems) == 3)
+            self.assertTrue(abs(ResourceFinder.problem_error(group_attr, problems[0]) - best) < 1e-9)
+            errors = [ResourceFinder.problem_error(group_attr, prob) for prob in problems]
+            self.assertTrue(errors == sorted(errors))
+            # Unknown topics fall back to the difficulty bucket
+            self.assertTrue(len(index.rank({"difficulty": 1, "topics": {"not-a-tag": 1}}, 3)) == 3)
+        finally:
+            db_conn.close()
+
+    def test_difficulty_counts(self):
+        '''Test that an easy group ranks an easy problem above a hard one with the same tags'''
+        group_attr = {"difficulty": 1, "topics": {"tree": 1}}
+        easy = ResourceFinder.problem_error(group_attr, {"difficulty": 1, "tags": {"tree"}})
+        hard = ResourceFinder.problem_error(group_attr, {"difficulty": 3, "tags": {"tree"}})
+        self.assertTrue(0 < easy < hard)
+        # The "any" tag can't make up for the difficulty, whether the group asked for "any" or not
+        hard_any = ResourceFinder.problem_error(group_attr, {"difficulty": 3, "tags": {"tree", "any"}})
+        self.assertTrue(easy < hard_any and 0 < ResourceFinder.problem_error(group_attr, {"difficulty": 1, "tags": {"tree", "any"}}))
+        any_group = {"difficulty": 1, "topics": {"tree": 0.5, "any": 0.5}}
+        self.assertTrue(0 < ResourceFinder.problem_error(any_group, {"difficulty": 1, "tags": {"tree", "any"}}) <
+                        ResourceFinder.problem_error(any_group, {"difficulty": 3, "tags": {"tree", "any"}}))
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            index = ResourceFinder.ProblemIndex(db_conn)
+            matches = [pid for pid in index.by_tag["tree"] if index.problems[pid]["difficulty"] == 1]
+            problems = index.rank(group_attr, 3)
+            self.assertTrue(len(problems) == 3)
+            self.assertTrue(all(prob["difficulty"] == 1 for prob in problems[:min(3, len(matches))]))
+            # Problems without the topic are candidates too, and beat tagged problems that are too hard
+            hard_group = {"difficulty": 3, "topics": {"tree": 1}}
+            best = min(ResourceFinder.problem_error(hard_group, prob) for prob in index.problems.values())
+            self.assertTrue(abs(ResourceFinder.problem_error(hard_group, index.rank(hard_group, 1)[0]) - best) < 1e-9)
+            # Hard problems tagged "any" as well still lose to easy problems with the topic
+            for pid in index.by_tag["tree"]:
+                if index.problems[pid]["difficulty"] == 3:
+                    index.problems[pid]["tags"].add("any")
+                    index.by_tag.setdefault("any", []).append(pid)
+            problems = index.rank(group_attr, 3)
+            self.assertTrue(all(prob["difficulty"] == 1 for prob in problems[:min(3, len(matches))]))
+        finally:
+            db_conn.close()
+
+class TestPrebuiltDatabase(unittest.TestCase):
+    def test_build_and_open(self):
+        '''Test that the prebuilt database is indexed, read-only, and only rebuilt when the script changes'''
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, "resource_database.sql")
+            db_path = os.path.join(directory, "db", "resource.db")
+            shutil.copyfile(sql_script, script_path)
+            db_conn = ResourceFinder.open_database(script_path, db_path)
+            try:
+                indexes = {row[0] for row in db_conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+                self.assertTrue({"problems_difficulty", "taggings_pid", "taggings_tid", "tags_tag_name"} <= indexes)
+                self.assertTrue(len(ResourceFinder.suggest_resource(db_conn, {"difficulty": 2, "topics": {"tree": 1}})) == 3)
+                with self.assertRaises(sqlite3.OperationalError):
+                    db_conn.execute("DELETE FROM problems")
+            finally:
+                db_conn.close()
+            self.assertTrue(ResourceFinder.database_checksum(db_path) == ResourceFinder.script_checksum(script_path))
+
+            # Unchanged script: The file is reused
+            built = (os.stat(db_path).st_ino, os.stat(db_path).st_mtime_ns)
+            ResourceFinder.open_database(script_path, db_path).close()
+            self.assertTrue((os.stat(db_path).st_ino, os.stat(db_path).st_mtime_ns) == built)
+            # Changed script: The file is rebuilt with the new checksum
+            with open(script_path, "a") as script:
+                script.write("\n-- changed\n")
+            ResourceFinder.open_database(script_path, db_path).close()
+            self.assertTrue(ResourceFinder.database_checksum(db_path) == ResourceFinder.script_checksum(script_path))
+            self.assertFalse(os.path.exists(db_path + ".build"))
+            # No script: The existing file is still usable
+            os.remove(script_path)
+            ResourceFinder.open_database(script_path, db_path).close()
+        finally:
+            shutil.rmtree(directory)
+
+class TestResourceService(unittest.TestCase):
+    def test_threads(self):
+        '''Test that many threads can share a small pool of read-only connections'''
+        directory = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(directory, "resource.db")
+            service = ResourceFinder.ResourceService(db_path, sql_script, size=2)
+            groups = [{"difficulty": 1 + x % 3, "topics": {"array": 0.5, "tree": 0.5}} for x in range(40)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                suggestions = list(executor.map(service.suggest_resource, groups))
+            self.assertTrue(all(len(problems) == 3 for problems in suggestions))
+            self.assertTrue(service.opened <= 2)
+            with service.connection() as db_conn:
+                with self.assertRaises(sqlite3.OperationalError):
+                    db_conn.execute("DELETE FROM problems")
+            # A copy for another process opens its own connections
+            copy = pickle.loads(pickle.dumps(service))
+            self.assertTrue(copy.opened == 0)
+            self.assertTrue(len(copy.suggest_resources(groups[:5])) == 5)
+            copy.close()
+            service.close()
+            self.assertTrue(service.opened == 0)
+        finally:
+            shutil.rmtree(directory)
+
+class TestRecommendationTable(unittest.TestCase):
+    def test_table(self):
+        '''Test that the table has a ranked list per difficulty and topic, and is rebuilt when the database changes'''
+        directory = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(directory, "resource.db")
+            service = ResourceFinder.ResourceService(db_path, sql_script)
+            self.assertTrue(service.refresh())
+            self.assertTrue(not service.refresh())
+            table = service.table
+            self.assertTrue(len(table) == 3 * (len(service.index.by_tag) + 1))
+            row = table.rows[(1, "array")]
+            matches = sum(1 for pid in service.index.by_tag["array"] if service.index.problems[pid]["difficulty"] == 1)
+            self.assertTrue(len(row) == min(table.k, len(service.index)))
+            # Problems with the topic at the row difficulty come first, as many as the bank has
+            best = row[:min(table.k, matches)]
+            self.assertTrue(all("array" in prob["tags"] and prob["difficulty"] == 1 for prob in best))
+            self.assertTrue(table.lookup({"difficulty": 1.2, "topics": {"array": 0.6, "tree": 0.4}}) is row)
+            self.assertTrue(table.lookup({"difficulty": 3, "topics": {"not-a-tag": 1}}) is table.rows[(3, None)])
+            groups = [{"difficulty": 1 + x % 3, "topics": {"array": 0.5, "tree": 0.5}} for x in range(10)]
+            self.assertTrue(all(len(problems) == 3 for problems in service.suggest_resources(groups)))
+
+            # A database built from another script gets a new table
+            other = os.path.join(directory, "other.sql")
+            with open(sql_script) as original, open(other, "w") as copy:
+                copy.write(original.read() + "\n-- changed\n")
+            service.cache = ResourceFinder.RecommendationCache()
+            with service.connection() as db_conn:
+                ResourceFinder.suggest_resource(db_conn, groups[0], cache=service.cache)
+            ResourceFinder.build_database(other, db_path)
+            self.assertTrue(service.refresh() and service.table is not table)
+            self.assertTrue(len(service.cache) == 0) # Pools of the old database are dropped
+            service.close()
+        finally:
+            shutil.rmtree(directory)
+
+class TestProblemSearch(unittest.TestCase):
+    def test_search(self):
+        '''Test that search matches word prefixes in titles and tags, ranks title matches first and pages results'''
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            ResourceFinder.create_search_index(db_conn)
+            problems, more = ResourceFinder.search_problems(db_conn, "Tre", page_size=5)
+            self.assertTrue(len(problems) == 5 and more)
+            self.assertTrue(all("tree" in prob["title"].lower() for prob in problems))
+            self.assertTrue(set(problems[0].keys()) == {"link", "title", "difficulty", "tags"})
+            # Pages don't overlap, and together give every match
+            total = db_conn.execute("SELECT COUNT(*) FROM problem_search WHERE problem_search MATCH 'tree*'").fetchone()[0]
+            links, page, more = [], 0, True
+            while more:
+                problems, more = ResourceFinder.search_problems(db_conn, "tree", page, 7)
+                links.extend(prob["link"] for prob in problems)
+                page += 1
+            self.assertTrue(len(links) == len(set(links)) == total)
+            self.assertTrue(ResourceFinder.search_problems(db_conn, "divide conq")[0][0]["tags"] >= {"divide-and-conquer"})
+            self.assertTrue(ResourceFinder.search_problems(db_conn, " ?! ") == ([], False))
+            self.assertTrue(ResourceFinder.search_problems(db_conn, "zzzz") == ([], False))
+        finally:
+            db_conn.close()
+
+class TestSeenHistory(unittest.TestCase):
+    def test_history(self):
+        '''Test that problems every member was sent are skipped, and the history survives a restart'''
+        directory = tempfile.mkdtemp()
+        db_conn = ResourceFinder.create_temporary_database(sql_script)
+        try:
+            path = os.path.join(directory, "seen_history.json")
+            history = ResourceFinder.SeenHistory(path, max_users=3)
+            history.record(["a", "b"], [{"link": "x"}, {"link": "y"}])
+            history.record(["b"], [{"link": "z"}])
+            self.assertTrue(history.seen_by_all(["a", "b"]) == {"x", "y"})
+            self.assertTrue(history.seen_by_all(["b"]) == {"x", "y", "z"})
+            self.assertTrue(history.seen_by_all(["a", "new"]) == set())
+            history.save()
+            history = ResourceFinder.SeenHistory(path, max_users=3)
+            self.assertTrue(history.seen_by_all(["b"]) == {"x", "y", "z"})
+            history.record(["c", "d"], [{"link": "x"}])
+            self.assertTrue(len(history) == 3 and "a" not in history.users) # Least recently active dropped
+
+            # Repeated suggestions for the same group don't repeat problems, on every path
+            index = ResourceFinder.ProblemIndex(db_conn)
+            group_attr = {"difficulty": 1, "topics": {"array": 1}, "members": ["e", "f"]}
+            for options in ({}, {"index": index}, {"index": index, "cache": ResourceFinder.RecommendationCache()}):
+                history = ResourceFinder.SeenHistory()
+                first = ResourceFinder.suggest_resource(db_conn, group_attr, history=history, **options)
+                second = ResourceFinder.suggest_resource(db_conn, group_attr, history=history, **options)
+                self.assertTrue(len(second) == 3)
+                self.assertTrue(not {prob["link"] for prob in first} & {prob["link"] for prob in second})
+        finally:
+            db_conn.close()
+            shutil.rmtree(directory)
+
 if __name__ == "__main__":
     unittest.main()
     print("All tests passed")
\ No newline at end of file
@@ -0,0 +1,155 @@
+# Install files from the main application, using the .env file
+import sys
+import os
+from dotenv import load_dotenv
+load_dotenv()
+locs = os.getenv("testfiles").split(",")
+for loc in locs:
+    sys.path.append(loc)
+
+# Install necessary libraries
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import threading
+import socket
+import json
+import time
+import unittest
+try:
+    from slack_sdk import WebClient
+    from slack_sdk.errors import SlackApiError
+    from utils import SlackDispatcher
+except ImportError:
+    SlackDispatcher = None # slack_sdk isn't installed, the dispatcher can't be tested
+
+# Stub of the Slack Web API, the first responses of a method can be scripted (status code, headers)
+class StubSlack(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        params = json.loads(body) if self.headers.get("Content-Type", "").startswith("application/json") else \
+            {key: values[0] for key, values in parse_qs(body).items()}
+        with self.server.lock:
+            self.server.calls.append((method, params))
+            script = self.server.scripts.get(method, [])
+            status, headers, payload = script.pop(0) if script else (200, {}, None)
+        if payload is None and method == "conversations.open":
+            payload = {"ok": True, "channel": {"id": "D-" + params["users"]}}
+        elif payload is None:
+            payload = {"ok": True, "channel": params.get("channel"), "ts": "1.0"}
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub(scripts={}):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSlack)
+    server.lock = threading.Lock()
+    server.calls = []
+    server.scripts = {method: list(script) for method, script in scripts.items()}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = WebClient(token="xoxb-test", base_url="http://127.0.0.1:{}/api/".format(server.server_address[1]))
+    return server, client
+
+FAST = {"conversations_open": (1000, 100), "chat_postMessage": (1000, 100)}
+RATE_LIMITED = (429, {"Retry-After": "1"}, {"ok": False, "error": "ratelimited"})
+SERVER_ERROR = (500, {}, {"ok": False, "error": "internal_error"})
+
+@unittest.skipIf(SlackDispatcher is None, "slack_sdk is not installed")
+class TestSlackDispatcher(unittest.TestCase):
+    def test_delivery(self):
+        '''Test that every group gets a conversation and a message, and latencies are reported'''
+        server, client = start_stub()
+        dispatcher = SlackDispatcher.SlackDispatcher(client, workers=4, limits=FAST)
+        try:
+            futures = [dispatcher.send_group(["U1", "U" + str(x)], json.dumps([]), "Hello") for x in range(2, 22)]
+            self.assertTrue(all(future.result(10) >= 0 for future in futures))
+            methods = [method for method, params in server.calls]
+            self.assertTrue(methods.count("conversations.open") == 20 and methods.count("chat.postMessage") == 20)
+            channels = {params["channel"] for method, params in server.calls if method == "chat.postMessage"}
+            self.assertTrue(channels == {"D-U1,U" + str(x) for x in range(2, 22)})
+            stats = dispatcher.stats()
+            self.assertTrue(stats["sent"] == 20 and stats["failed"] == 0 and stats["latency_max"] >= stats["latency_p50"])
+        finally:
+            dispatcher.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_retries(self):
+        '''Test that 429s wait for Retry-After, server errors are retried, and other errors fail at once'''
+        server, client = start_stub({"chat.postMessage": [RATE_LIMITED, SERVER_ERROR],
+                                     "conversations.open": [(200, {}, {"ok": False, "error": "user_not_found"})]})
+        dispatcher = SlackDispatcher.SlackDispatcher(client, workers=1, limits=FAST, backoff=0.01)
+        try:
+            with self.assertRaises(SlackApiError):
+                dispatcher.send_group(["U0"], "[]", "Hello").result(10)
+            start = time.monotonic()
+            self.assertTrue(dispatcher.send_group(["U1"], "[]", "Hello").result(10) >= 1)
+            self.assertTrue(time.monotonic() - start >= 1) # Waited for Retry-After
+            self.assertTrue([method for method, params in server.calls].count("chat.postMessage") == 3)
+            self.assertTrue(dispatcher.stats()["sent"] == 1 and dispatcher.stats()["failed"] == 1)
+        finally:
+            dispatcher.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_channels_and_timeouts(self):
+        '''Test that messages are limited per channel, and timed out messages aren't sent twice'''
+        now = [0.0]
+        waits = []
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+        calls = []
+        class Client:
+            def chat_postMessage(self, channel, **kwargs):
+                calls.append(("chat_postMessage", channel))
+                if channel == "slow":
+                    raise socket.timeout("timed out")
+            def conversations_open(self, users):
+                calls.append(("conversations_open", users))
+                if calls.count(("conversations_open", users)) == 1:
+                    raise ConnectionRefusedError()
+        limits = {"chat_postMessage": (1, 1), "conversations_open": (1000, 100)}
+        dispatcher = SlackDispatcher.SlackDispatcher(Client(), workers=1, limits=limits, backoff=0.01,
+                                                     clock=lambda: now[0], sleep=sleep)
+        try:
+            for channel in ("C1", "C2", "C3"):
+                dispatcher.call("chat_postMessage", channel=channel, text="Hello")
+            self.assertTrue(waits == []) # Every channel has its own limiter
+            dispatcher.call("chat_postMessage", channel="C1", text="Hello")
+            self.assertTrue(waits == [1.0])
+            with self.assertRaises(socket.timeout):
+                dispatcher.call("chat_postMessage", channel="slow", text="Hello")
+            self.assertTrue(calls.count(("chat_postMessage", "slow")) == 1)
+            # Other methods (and requests that never reached Slack) are still retried
+            dispatcher.call("conversations_open", users="U1")
+            self.assertTrue(calls.count(("conversations_open", "U1")) == 2)
+        finally:
+            dispatcher.close()
+
+    def test_rate_limiter(self):
+        '''Test that the limiter spaces calls at its rate after the burst, and a pause holds them back'''
+        now = [0.0]
+        waits = []
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+        limiter = SlackDispatcher.RateLimiter(rate=2, burst=2, clock=lambda: now[0], sleep=sleep)
+        for _ in range(4):
+            limiter.acquire()
+        self.assertTrue(waits == [0.5, 0.5])
+        limiter.pause(10)
+        limiter.acquire()
+        self.assertTrue(abs(now[0] - 11) < 1e-9)
+
+if __name__ == "__main__":
+    unittest.main()
+    print("All tests passed")
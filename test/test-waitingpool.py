@@ -0,0 +1,93 @@
+# Install files from the main application, using the .env file
+import sys
+import os
+from dotenv import load_dotenv
+load_dotenv()
+locs = os.getenv("testfiles").split(",")
+for loc in locs:
+    sys.path.append(loc)
+
+# Install necessary libraries
+from utils import UserGroup, QueueGrouper, MatrixGrouper, WaitingPool
+from collections import deque
+import importlib
+import unittest
+
+# Dummy requests are shared with the grouping tests (the file name has a hyphen)
+dummyreq = importlib.import_module("test-grouping").dummyreq
+
+# Constants
+WEIGHTS = {"meeting_size": 6, "difficulty": 4, "topics": 1}
+CF = 4
+MT = 0.22
+
+class TestWaitingPool(unittest.TestCase):
+    def test_order(self):
+        '''Test that the pool keeps queue order at both ends and finds users by slack id'''
+        UserGroup.UserGroup.reset()
+        users = [UserGroup.convert_to_usergroup(dummyreq(x, "dif-easy", "siz-small", ["top-array"])) for x in "abcd"]
+        pool = WaitingPool.WaitingPool(users[1:3])
+        pool.append(users[3])
+        pool.appendleft(users[0])
+        self.assertTrue([grp.ids[0] for grp in pool] == ["a", "b", "c", "d"])
+        users[1].merge(users[2])
+        pool.remove("c")
+        pool.reindex(users[1])
+        self.assertTrue("c" in pool and pool.find("c") is users[1])
+        self.assertTrue(pool.remove("c") is users[1])
+        self.assertTrue(pool.remove("b") is None)
+        self.assertTrue([grp.ids[0] for grp in pool] == ["a", "d"])
+        self.assertTrue(pool.population == 2)
+
+    def test_sweep(self):
+        '''Test that the sweep ages every group and only takes out the expired ones, in order'''
+        UserGroup.UserGroup.reset()
+        users = [UserGroup.convert_to_usergroup(dummyreq(str(x), "dif-easy", "siz-small", ["top-array"])) for x in range(6)]
+        for x, user in enumerate(users):
+            user.step(x)
+        pool = WaitingPool.WaitingPool(users)
+        expired = pool.sweep(4)
+        self.assertTrue([grp.ids[0] for grp in expired] == ["3", "4", "5"])
+        self.assertTrue([grp.ids[0] for grp in pool] == ["0", "1", "2"])
+        self.assertTrue([grp.timeout for grp in pool] == [2, 3, 4])
+        self.assertTrue(UserGroup.UserGroup.users == {"0", "1", "2"})
+        self.assertTrue("3" not in pool)
+
+    def test_soft_cap(self):
+        '''Test that the soft cap is reported without dropping anyone'''
+        UserGroup.UserGroup.reset()
+        pool = WaitingPool.WaitingPool(soft_cap=3)
+        for x in range(5):
+            self.assertTrue(pool.full() == (x >= 3))
+            pool.append(UserGroup.convert_to_usergroup(dummyreq(str(x), "dif-easy", "siz-small", ["top-array"])))
+        self.assertTrue(len(pool) == 5)
+
+    def test_matchers(self):
+        '''Test that the pool works with match_user and with a group matcher round trip'''
+        UserGroup.UserGroup.reset()
+        pool = WaitingPool.WaitingPool()
+        for x in range(6):
+            user = UserGroup.convert_to_usergroup(dummyreq(str(x), "dif-easy", ["siz-small", "siz-large"][x % 2], ["top-array"]))
+            pool.reindex(QueueGrouper.match_user(user, pool, WEIGHTS, match_threshold=MT))
+        self.assertTrue(len(pool) == 2)
+        self.assertTrue(pool.find("4") is pool.find("0"))
+        self.assertTrue(pool.population == 6)
+        groups_waiting = pool.to_deque()
+        MatrixGrouper.group_matcher(deque(), groups_waiting, WEIGHTS, compromise_factor=CF, match_threshold=MT)
+        pool.replace(groups_waiting)
+        self.assertTrue(sorted(x for grp in pool for x in grp.ids) == [str(x) for x in range(6)])
+
+    def test_many_users(self):
+        '''Test that the pool handles tens of thousands of users'''
+        UserGroup.UserGroup.reset()
+        users, rejected = UserGroup.convert_batch(dummyreq(str(x), "dif-easy", "siz-small", ["top-array"]) for x in range(50000))
+        pool = WaitingPool.WaitingPool(users)
+        for x in range(0, 50000, 2):
+            pool.remove(str(x))
+        self.assertTrue(len(pool) == 25000 and pool.population == 25000)
+        self.assertTrue(len(pool.sweep(1)) == 25000)
+        self.assertTrue(len(pool) == 0)
+
+if __name__ == "__main__":
+    unittest.main()
+    print("All tests passed")